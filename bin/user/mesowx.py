@@ -28,12 +28,41 @@ try:
     import queue
 except ImportError:
     import Queue as queue
+import array
+import base64
+import collections
+import gzip
+import hashlib
 import json
+import io
 import itertools
+import os
+import os.path
+import random
+import select
+import sqlite3
+import struct
 import time
 import threading
+import zlib
 import urllib3
+try:
+    from urllib.parse import parse_qsl, urlencode
+except ImportError:
+    from urllib import urlencode
+    from urlparse import parse_qsl
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+try:
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
+import weedb
 import weewx
 import weewx.restx
 import weewx.manager
@@ -159,6 +188,117 @@ class AbortAndExit(Exception):
     """
 
 
+class SyncOutbox(object):
+    """
+    A durable stand-in for queue.Queue used by the sync threads.
+
+    Records are appended to an SQLite table (WAL journal) as they are put and
+    stay there until the sync thread acknowledges them with ack(), so nothing
+    is lost over a restart. Each stream (archive, raw) keeps a cursor holding
+    the id of the last acknowledged record, and the dateTime of the last
+    record known to be on the remote server, which lets back_fill() carry on
+    where it stopped without asking the remote server.
+
+    A None put on the outbox is not stored, it is handed straight back by
+    get() as the signal to exit; anything still pending is left for next time.
+    """
+
+    def __init__(self, path, stream):
+        self.path = path
+        self.stream = stream
+        self.closing = False
+        self.cond = threading.Condition()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("pragma journal_mode=wal")
+        self.connection.execute("pragma synchronous=normal")
+        self.connection.execute("create table if not exists outbox ("
+                                "id integer primary key autoincrement, "
+                                "stream text not null, "
+                                "record text not null)")
+        self.connection.execute("create table if not exists outbox_cursor ("
+                                "stream text primary key, "
+                                "acked integer not null, "
+                                "dateTime integer)")
+        self.connection.execute("insert or ignore into outbox_cursor "
+                                "values (?, 0, null)", (stream,))
+        self.connection.commit()
+        self.acked_id, self.synced_datetime = self.connection.execute(
+            "select acked, dateTime from outbox_cursor where stream = ?",
+            (stream,)).fetchone()
+        # the id of the last record handed out by get()
+        self.read_id = self.acked_id
+        pending = self.connection.execute(
+            "select count(*) from outbox where stream = ? and id > ?",
+            (stream, self.acked_id)).fetchone()[0]
+        loginf("sync outbox: %d %s record(s) pending in %s" %
+               (pending, stream, path))
+
+    def put(self, record):
+        with self.cond:
+            if record is None:
+                self.closing = True
+            else:
+                self.connection.execute("insert into outbox (stream, record) "
+                                        "values (?, ?)",
+                                        (self.stream,
+                                         json.dumps(record, default=dict)))
+                self.connection.commit()
+            self.cond.notify()
+
+    def get(self, block=True, timeout=None):
+        """Return the next unread record, None if exiting, or raise
+        queue.Empty in the same manner as queue.Queue.get()"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while True:
+                if self.closing:
+                    return None
+                row = self.connection.execute(
+                    "select id, record from outbox where stream = ? and "
+                    "id > ? order by id limit 1",
+                    (self.stream, self.read_id)).fetchone()
+                if row is not None:
+                    self.read_id = row[0]
+                    return json.loads(row[1])
+                if not block:
+                    raise queue.Empty
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.cond.wait(remaining)
+
+    def task_done(self):
+        """Nothing to do, ack() marks records as done"""
+
+    def ack(self, date_time=None):
+        """Acknowledge every record returned by get() so far, optionally
+        recording date_time as the last one on the remote server."""
+        with self.cond:
+            if date_time is not None:
+                self.synced_datetime = date_time
+            self.acked_id = self.read_id
+            self.connection.execute("update outbox_cursor set acked = ?, "
+                                    "dateTime = ? where stream = ?",
+                                    (self.acked_id, self.synced_datetime,
+                                     self.stream))
+            self.connection.execute("delete from outbox where stream = ? "
+                                    "and id <= ?",
+                                    (self.stream, self.acked_id))
+            self.connection.commit()
+
+    def rewind(self):
+        """Hand out the unacknowledged records again"""
+        with self.cond:
+            self.read_id = self.acked_id
+
+    def close(self):
+        with self.cond:
+            self.connection.close()
+
+
 class SyncService(weewx.engine.StdService):
     """
     Important...
@@ -173,9 +313,9 @@ class SyncService(weewx.engine.StdService):
         watches queue and publishes data to remote server in order
         IO failures result in a retry after X seconds, indefinitely
       back_fill
-        on start up
+        on start up, run by the thread so the engine isn't held up
           query remote server for most recent date
-          sync all records since date to queue
+          sync all records since date, then start on the queue
         new archive packets
           date of packet added to queue (have to make sure it's not already
            sent by the back_fill)
@@ -310,9 +450,10 @@ class SyncService(weewx.engine.StdService):
     complete when you start from scratch. If it's too large it may refuse, or
     your machine may be brought to it's knees while the database is being
     queried.
-    While it's doing that weewx will be stalled, no records generated,
-    no graphs, nothing, nada, zilch. The only activity may be in your logs - if
-    debug is turned on.
+    The backfill runs in the archive sync thread so weewx carries on as
+    normal while it's doing that. New archive records are queued and sent once
+    the backfill has caught up. The only sign of progress may be in your logs
+    - if debug is turned on.
 
     Once the database is populated (or starting to be) then pointing your
     browser to the remote machines webserver mesowx/index.html file should
@@ -359,6 +500,11 @@ class SyncService(weewx.engine.StdService):
     archive packet has been written to the remote database then as far as the
     backfill operation knows, all is golden. There is nothing for it to do.
 
+    With outbox = true in [[RemoteSync]], records not yet sent are kept in
+    an sqlite database (under SQLITE_ROOT) and are sent after a restart. The
+    backfill then starts from the last record the outbox saw sent, rather than
+    asking the remote server.
+
     If you are certain there are gaps in the remote data, then you need to fill
     them manually. You could do a mysqldump style operation, or...
     You can stop weewx, delete everything at the remote end that covers the
@@ -415,8 +561,15 @@ class SyncService(weewx.engine.StdService):
         self.sync_config = self.config_dict['Mesowx']['RemoteSync']
         # used to signal the thread to exit, see shutDown()
         self.exit_event = threading.Event()
-        self.archive_queue = queue.Queue()
-        self.raw_queue = queue.Queue()
+        # keep the queues on disk so that records not yet sent survive a
+        # restart (default: false, in memory only)
+        if weeutil.weeutil.to_bool(self.sync_config.get('outbox', False)):
+            outbox_path = self.outbox_path()
+            self.archive_queue = SyncOutbox(outbox_path, 'archive')
+            self.raw_queue = SyncOutbox(outbox_path, 'raw')
+        else:
+            self.archive_queue = queue.Queue()
+            self.raw_queue = queue.Queue()
         # keeps track of the dateTime of the last loop packet seen in order to
         # prevent sending packets with the same dateTime value, see
         # new_loop_packet() for more info
@@ -426,58 +579,54 @@ class SyncService(weewx.engine.StdService):
         # self.u_agent= ({'User-Agent':'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:76.0) Gecko/20100101 Firefox/76.0'})
         # using a http connection pool to potentially save some overhead and
         # server burden if keep alive is enabled, maxsize is set to 2 since
-        # there are two threads using the pool. Note that keep alive will need
+        # there are two threads using the pool, plus one for each extra
+        # back_fill batch in flight. Note that keep alive will need
         # to be longer than the loop interval to be effective (which may not
-        # make sense for longer intervals)
-        self.http_pool = urllib3.connectionpool.connection_from_url(
+        # make sense for longer intervals), or kept up with heartbeats
+        pipeline_depth = max(1, int(self.sync_config.get(
+                             'archive_pipeline_depth', 1)))
+        # seconds to wait for the remote server to connect or answer, so a
+        # connection that has silently gone is given up on (default: 60)
+        sync_timeout = float(self.sync_config.get('sync_timeout', 60))
+        # seconds a connection can be left idle before it's assumed the
+        # remote server has closed it, set a little under the server's keep
+        # alive timeout (default: 0, rely on noticing it has been closed)
+        idle_timeout = float(self.sync_config.get('sync_idle_timeout', 0))
+        # send a HEAD request for the remote_server_url plus keepalive_path
+        # when no request has been sent for this many seconds, keeping a
+        # connection open between loop packets (default: 0, none)
+        heartbeat = float(self.sync_config.get('sync_keepalive_interval', 0))
+        self.http_pool = SyncConnectionPool(
                          self.sync_config['remote_server_url'],
-                         maxsize=2, headers=self.u_agent)
-        # the maximum number of reords to back_fill (defualt: no limit)
-        self.backfill_limit = int(self.sync_config.get(
-                              'archive_backfill_limit', 0))
-        # the max number of records to send in a request (default: 200)
-        self.batch_size = int(self.sync_config.get('archive_batch_size', 200))
-        # the path on the remote server of the data update api (usually won't
-        # ever change this)
-        self.update_url_path = self.sync_config.get('server_update_path',
-                                                    "updateData.php")
-        # default number of times to retry http requests before giving up
-        self.http_max_tries = 3
-        # default time to wait in seconds before retrying http requests
-        self.http_retry_interval = 0
-        # the base url of the remote server to sync to
-        self.remote_server_url = self.sync_config['remote_server_url']
-        # the url that will be used to update data to on the remote server
-        self.update_url = self.remote_server_url + self.update_url_path
-        # the url that will be used to query for the latest dateTime on the
-        # remote server the path on the remote server of the data query api
-        # (usually won't ever change this)
-        self.server_data_path = self.sync_config.get('server_data_path',
-                                                     "data.php")
-        self.latest_url = self.remote_server_url + self.server_data_path
-        # the number of seconds to wait between sending batches
-        # (default .5 seconds)
-        self.batch_send_interval = float(self.sync_config.get(
-                                   'archive_batch_send_interval', 0.5))
+                         maxsize=1 + pipeline_depth, headers=self.u_agent,
+                         timeout=sync_timeout if sync_timeout > 0 else None,
+                         idle_timeout=idle_timeout, heartbeat=heartbeat,
+                         heartbeat_path=self.sync_config.get(
+                             'sync_keepalive_path', ''),
+                         # log the connection reuse every this many seconds
+                         # (default: 3600)
+                         stats_interval=float(self.sync_config.get(
+                             'sync_http_stats_interval', 3600)),
+                         # updateData.php skips the records it already has,
+                         # so an update POST can be sent again
+                         retry_methods=('HEAD', 'GET', 'POST'))
+        if heartbeat > 0:
+            self.http_pool.start()
         # the entity id to sync to on the remote server
         self.entity_id = self.sync_config.get('archive_entity_id')
-        # the security key that will be sent along with updates to the entity
-        self.security_key = self.sync_config['archive_security_key']
-        # Last dateTime synced records on webserver
-        global last_datetime_synced
-        last_datetime_synced = None
-        # Open default database
-        self.dbm = self.engine.db_binder.get_manager()
-
-        # if an archive_entity_id is configured, then back-fill missed records
-        # and bind & create the thead to sync archive records
+        self.archive_thread = None
+        self.raw_thread = None
+        self.loop_filter = None
+
+        # if an archive_entity_id is configured, then bind & create the thead
+        # to sync archive records. The thread back-fills missed records before
+        # it starts on the queue, new archive records queue up behind it.
         if self.entity_id:
-            # back_fill missed records on webserver
-            self.back_fill()
             self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
             self.archive_thread = ArchiveSyncThread(self.archive_queue,
                                                     self.exit_event,
                                                     self.http_pool,
+                                                    self.config_dict,
                                                     **self.sync_config)
             self.archive_thread.start()
             loginf("remote sync of archive records is enabled")
@@ -487,6 +636,12 @@ class SyncService(weewx.engine.StdService):
         # if a raw_entity_id is configured, then bind & create the thead to
         # sync raw records
         if 'raw_entity_id' in self.sync_config:
+            # thin out the packets sent with the [[LoopFilter]]
+            # (default: false)
+            if weeutil.weeutil.to_bool(self.sync_config.get('loop_filter',
+                                                            False)):
+                self.loop_filter = LoopFilter.from_config(config_dict,
+                                                          "remote raw")
             self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
             self.raw_thread = RawSyncThread(self.raw_queue,
                                             self.exit_event,
@@ -518,13 +673,21 @@ class SyncService(weewx.engine.StdService):
             # duplicates until we get a new one to avoid a duplicate key error
             date_time = packet['dateTime']
             if date_time != self.lastLoopDateTime:
-                self.raw_queue.put(packet)
+                if self.loop_filter is not None:
+                    for record in self.loop_filter.add(packet):
+                        self.raw_queue.put(record)
+                else:
+                    self.raw_queue.put(packet)
                 self.lastLoopDateTime = date_time
         # not going to spam the logs by logging each time we don't sync one
         # due to frequency
 
     def shutDown(self):
         """Shut down the sync threads"""
+        if self.loop_filter is not None:
+            for record in self.loop_filter.flush():
+                self.raw_queue.put(record)
+            self.loop_filter.log_stats(force=True)
         # signal the threads to shutdown
         self.exit_event.set()
         self.archive_queue.put(None)
@@ -534,6 +697,19 @@ class SyncService(weewx.engine.StdService):
         self._join_thread(self.raw_thread)
         # close the http pool
         self.http_pool.close()
+        for outbox in (self.archive_queue, self.raw_queue):
+            if isinstance(outbox, SyncOutbox):
+                outbox.close()
+
+    def outbox_path(self):
+        """The outbox lives with the weewx sqlite databases, under
+        SQLITE_ROOT"""
+        sqlite_root = self.config_dict.get('DatabaseTypes', {}).get(
+                      'SQLite', {}).get('SQLITE_ROOT', 'archive')
+        return os.path.join(self.config_dict.get('WEEWX_ROOT', ''),
+                            sqlite_root,
+                            self.sync_config.get('outbox_file',
+                                                 'mesowx_outbox.sdb'))
 
     @staticmethod
     def _join_thread(thread):
@@ -547,174 +723,150 @@ class SyncService(weewx.engine.StdService):
                 logdbg("sync: Shut down syncing thread: %s" %
                        thread.name)
 
-    def back_fill(self):
-        global last_datetime_synced
-        last_datetime_synced = self.fetch_latest_remote_datetime()
-        # last_datetime_synced = int("1593342453") # Hmmm, debug left in ??
-        if last_datetime_synced is None:
-            num_to_sync = self.dbm.getSql("select count(*) from %s" %
-                                          self.dbm.table_name)[0]
-        else:
-            num_to_sync = self.dbm.getSql("select count(*) from %s "
-                                          "where dateTime > ?" %
-                                          self.dbm.table_name,
-                                          (last_datetime_synced,))[0]
-        logdbg("remote: %d records to sync since last record "
-               "with dateTime: %s" %
-               (num_to_sync, weeutil.weeutil.timestamp_to_string(
-                last_datetime_synced)))
-        if num_to_sync > 0:
-            if self.backfill_limit is not None and self.backfill_limit != 0 \
-                        and num_to_sync[0] > self.backfill_limit:
-            # except FatalSyncError:
-                loginf("remote: Too many to sync: %d exeeds the limit of %d" %
-                       (num_to_sync, self.backfill_limit))
-            #      raise
-            else:
-                logdbg("remote: back_filling %d records" % num_to_sync)
-                self.sync_all_since_datetime(last_datetime_synced)
-                logdbg("remote: done back_filling %d records" %
-                       num_to_sync)
 
-    def sync_all_since_datetime(self, datetime):
-        global last_datetime_synced
-        if datetime is None:
-            query = self.dbm.genSql("select * from %s order by dateTime asc" %
-                                    self.dbm.table_name)
-        else:
-            query = self.dbm.genSql("select * from %s where "
-                                    "dateTime > ? order by dateTime asc" %
-                                    self.dbm.table_name, (datetime,))
-        total_sent = 0
-        while True:
-            batch = []
-            for row in itertools.islice(query, self.batch_size):
-                datadict = dict(zip(self.dbm.sqlkeys, row))
-                batch.append(datadict)
-            if len(batch) > 0:
-                self.post_records(batch)
-                total_sent += len(batch)
-                last_datetime_synced = batch[len(batch)-1]['dateTime']
-                # XXX add start/end datetime to log message
-                logdbg("remote: back_filled %d records; "
-                       "timestamp last record: %s" %
-                       (total_sent, weeutil.weeutil.timestamp_to_string(
-                        last_datetime_synced)))
-            else:
-                # no more to send
-                break
-            # breath a bit so as not to bombard the remote server. Also
-            # back_filling could take some time, so make sure an exit event
-            # hasn't been signaled
-            self._wait(self.batch_send_interval)
+class SyncConnectionPool(threading.Thread):
+    """
+    The urllib3 connection pool shared by the sync threads, keeping its
+    connections usable between requests. Connections left idle longer than
+    the remote server keeps them open (idle_timeout) are dropped before the
+    next request rather than failing it, and with a heartbeat interval the
+    thread sends a HEAD request whenever the pool has been idle that long so
+    the connection stays open at all. A request that fails as its connection
+    is closed may or may not have reached the server, so it's only sent once
+    more on a new connection when its method is one of retry_methods, safe
+    to repeat. The share of requests that reused a connection is logged every
+    stats_interval seconds.
+    """
 
-    def fetch_latest_remote_datetime(self):
-        logdbg("remote backfill: requesting latest dateTime from %s" %
-               self.latest_url)
-        # A valid timestamp to be used to halt the backfill on an invalid
-        # json response (which means no datetime was returned)
-        current_time = int(time.time())
-        # the entity id to sync to on the remote server
-        # redundant # self.entity_id = self.sync_config['archive_entity_id']
-        # the security key that will be sent along with updates to the entity
-        # red'nt # self.security_key = self.sync_config['archive_security_key']
-        # http://wxdev.ruskers.com/
-        # data.php?entity_id=weewx_archive&data=dateTime&order=desc&limit=1
-        postdata = {'entity_id': self.entity_id, 'data': 'dateTime',
-                    'order': 'desc', 'limit': 1}
-        http_response = self.backfill_http_request(self.latest_url, postdata)
-        try:
-            response_json = http_response.data.decode('utf-8')
-        except Exception as e:
-            # NoneType object has no attribute data - server not responding
-            logdbg("remote: Exception as %s" % e)
-            logerr("remote backfill: no datetime available. Returning current"
-                   " time %s to halt any backfill operation."
-                   " ( is the server running? )" % current_time)
-            return current_time
+    def __init__(self, url, maxsize=2, headers=None, timeout=None,
+                 idle_timeout=0, heartbeat=0, heartbeat_path='',
+                 stats_interval=3600,
+                 retry_methods=('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')):
+        threading.Thread.__init__(self, name="SyncConnectionPool")
+        self.setDaemon(True)
+        self.url = url
+        self.maxsize = maxsize
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.heartbeat = heartbeat
+        self.heartbeat_url = url + heartbeat_path
+        self.stats_interval = stats_interval
+        self.retry_methods = frozenset(retry_methods)
+        self.lock = threading.Lock()
+        self.exit_event = threading.Event()
+        self.pool = self.new_pool()
+        self.last_used = time.time()
+        self.stats_started = time.time()
+        # the requests and new connections of the pools already replaced
+        self.past_requests = 0
+        self.past_connections = 0
+        self.reset_stats()
+
+    def new_pool(self):
+        kwargs = dict(maxsize=self.maxsize, headers=self.headers)
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        return urllib3.connectionpool.connection_from_url(self.url, **kwargs)
+
+    def request(self, method, url, fields=None, **kwargs):
+        # fields by name, the third argument is the body in urllib3 2
+        return self.send('request', method, url, fields=fields, **kwargs)
+
+    def urlopen(self, method, url, **kwargs):
+        return self.send('urlopen', method, url, **kwargs)
+
+    def send(self, name, method, *args, **kwargs):
+        pool = self.checkout()
         try:
-            response = json.loads(response_json)
-        except Exception as e:
-            logerr("remote: no datetime available: http response.data % and "
-                   "error %s" % (response_json, e))
-            return current_time
-            # datetime = None
-            # return
-        if len(response) == 0:
-            datetime = None
-        else:
-            datetime = response[0][0]
-        return datetime
-
-    def post_records(self, records):
-        datajson = json.dumps(records)
-        postdata = {'entity_id': self.entity_id, 'data': datajson,
-                    'security_key': self.security_key}
-        self.backfill_http_request(self.update_url, postdata)
+            response = getattr(pool, name)(method, *args, **kwargs)
+        except urllib3.exceptions.ProtocolError as e:
+            # the connection was closed, most likely by the server as it was
+            # being reused before the request got there, but it may have
+            # gone after the server had the request, only send it again if
+            # doing it twice does no harm
+            if method not in self.retry_methods:
+                with self.lock:
+                    self.count_stale += 1
+                    self.count_unretried += 1
+                raise
+            logdbg("sync: connection closed by the server, retrying: %s" %
+                   (e,))
+            with self.lock:
+                self.count_stale += 1
+            response = getattr(self.recycle(pool), name)(method, *args,
+                                                         **kwargs)
+        self.last_used = time.time()
+        self.log_stats()
+        return response
+
+    def checkout(self):
+        """The pool to send the next request with, a new one if the
+        connections of the current one have probably been closed by the
+        server by now"""
+        if self.idle_timeout > 0 and \
+                time.time() - self.last_used > self.idle_timeout:
+            with self.lock:
+                self.count_recycled += 1
+            return self.recycle(self.pool)
+        return self.pool
+
+    def recycle(self, pool):
+        """Replace the pool, unless another thread already has, closing the
+        idle connections of the old one"""
+        with self.lock:
+            if pool is self.pool:
+                self.past_requests += pool.num_requests
+                self.past_connections += pool.num_connections
+                self.pool = self.new_pool()
+                pool.close()
+            return self.pool
 
-    def backfill_http_request(self, url, postdata):
-        # data.php (backfilling)
-        for count in range(self.http_max_tries):
+    def run(self):
+        while not self.exit_event.wait(max(1.0, self.heartbeat / 4.0)):
+            if time.time() - self.last_used < self.heartbeat:
+                continue
             try:
-                response = self.http_pool.request('POST', url, postdata)
-                logdbg("backfill: archive http response.data %s" %
-                       response.data)
-                if response.status == 200:
-                    return response
-                else:
-                    # from here must either set retry=True or raise a
-                    # FatalSyncError
-                    logerr("backfill: http request failed (%s %s): %s" %
-                           (response.status,
-                            response.reason,
-                            response.data))
-                    if response.status >= 500:
-                        # Don't retry if Duplicate entry error
-                        if response.data.find(b'Duplicate entry') >= 0:
-                            # continue
-                            return response
-                        else:
-                            retry = True
-                    else:
-                        message = ("backfill: Request to %s failed, server "
-                                   "returned %s status with reason '%s'." %
-                                   (url, response.status, response.reason))
-                        # invalid credentials
-                        if response.status == 403:
-                            message += " Do your entity security keys match?"
-                        # page not found
-                        if response.status == 404:
-                            message += " Is the url correct?"
-                        # bad request (likely an invalid setup)
-                        if response.status == 400:
-                            message += " Check your entity configuration."
-                        loginf(message)
-                        # don't retry on these errors
-                        retry = False
-            except (urllib3.exceptions.NewConnectionError) as e:
-                logerr("backfill: failed to connect to %s" % url)
-                logdbg("   ****  Reason: %s" % (e,))
-                retry = False  # if we can't find it on start up, assume *we*
-                               # made an error and stop retrying
-            except (urllib3.exceptions.MaxRetryError) as e:
-                logerr("backfill: failed http request attempt #%d to %s" % (
-                       count+1, url))
-                logdbg("   ****  Reason: %s" % (e,))
-                retry = True
-            if retry and count+1 < self.http_max_tries:
-                # wait a bit before retrying, ensuring that we exit if signaled
-                logdbg("backfill: retrying again in %s seconds" % (
-                       self.http_retry_interval,))
-                self._wait(self.http_retry_interval)
-        else:
-            logerr("backfill: failed to invoke %s after %d tries" % (
-                   url, self.http_max_tries))
-
-    def _wait(self, duration):
-        if duration is not None:
-            if self.exit_event.wait(duration):
-                logdbg("backfill: exit event signaled, aborting")
-                raise AbortAndExit
+                self.pool.request('HEAD', self.heartbeat_url)
+                with self.lock:
+                    self.count_heartbeats += 1
+            except urllib3.exceptions.HTTPError as e:
+                logdbg("sync: heartbeat to %s failed: %s" %
+                       (self.heartbeat_url, e))
+            self.last_used = time.time()
+
+    def close(self):
+        self.exit_event.set()
+        self.log_stats(force=True)
+        self.pool.close()
+
+    def reset_stats(self):
+        self.count_stale = 0
+        self.count_unretried = 0
+        self.count_recycled = 0
+        self.count_heartbeats = 0
+
+    def log_stats(self, force=False):
+        now = time.time()
+        if not force and (self.stats_interval <= 0 or
+                          now - self.stats_started < self.stats_interval):
+            return
+        with self.lock:
+            requests = self.past_requests + self.pool.num_requests
+            connections = self.past_connections + self.pool.num_connections
+            # start counting again from the current pool's counts
+            self.past_requests = -self.pool.num_requests
+            self.past_connections = -self.pool.num_connections
+            if requests:
+                loginf("sync: %d requests (%d heartbeats) on %d new "
+                       "connections, %.0f%% reused; %d closed by the server "
+                       "(%d not retried), %d idle pools replaced" %
+                       (requests, self.count_heartbeats, connections,
+                        100.0 * max(0, requests - connections) / requests,
+                        self.count_stale, self.count_unretried,
+                        self.count_recycled))
+            self.reset_stats()
+            self.stats_started = now
 
 
 class SyncThread(threading.Thread):
@@ -744,6 +896,17 @@ class SyncThread(threading.Thread):
         self.http_retry_interval = 0
         # the url that will be used to update data to on the remote server
         self.update_url = self.remote_server_url + self.update_url_path
+        # compress update requests with 'gzip' or 'deflate', the remote
+        # server needs the updateData.php that comes with this version
+        # (default: none)
+        self.compression = sync_params.get('sync_compression', 'none')
+        if self.compression not in ('none', 'gzip', 'deflate'):
+            raise ValueError("mesowx sync: unknown sync_compression '%s'" %
+                             self.compression)
+        # leave out fields with a value of None, the remote server stores
+        # them as null anyway (default: false)
+        self.elide_nulls = weeutil.weeutil.to_bool(sync_params.get(
+                           'sync_elide_nulls', False))
 
     def run(self):
         try:
@@ -764,22 +927,72 @@ class SyncThread(threading.Thread):
     def _run(self):
         pass
 
-    def post_records(self, records):
-        datajson = json.dumps(records)
-        postdata = {'entity_id': self.entity_id, 'data': datajson,
-                    'security_key': self.security_key}
-        self.make_http_request(self.update_url, postdata)
+    def post_records(self, records, last_datetime=None):
+        if self.elide_nulls:
+            if isinstance(records, dict):
+                records = self.without_nulls(records)
+            else:
+                records = [self.without_nulls(r) for r in records]
+        # default=dict for the packets of RetainLoopValues
+        datajson = json.dumps(records, default=dict)
+        url, postdata, headers = self.update_request(datajson, last_datetime)
+        return self.make_http_request(url, postdata, headers)
 
-    def make_http_request(self, url, postdata):
+    @staticmethod
+    def without_nulls(record):
+        return dict((k, v) for k, v in record.items() if v is not None)
+
+    def update_request(self, datajson, last_datetime=None):
+        """Returns the url, post data and headers for an update request.
+        Normally that's the form fields, left for urllib3 to encode, but when
+        compressing, the data is url encoded and compressed into the body, and
+        the entity_id and security_key go in the query string so that
+        updateData.php can check them before decompressing anything."""
+        credentials = {'entity_id': self.entity_id,
+                       'security_key': self.security_key}
+        fields = dict(self.update_fields(last_datetime), data=datajson)
+        if self.compression == 'none':
+            postdata = dict(credentials, **fields)
+            return self.update_url, postdata, None
+        url = self.update_url + '?' + urlencode(credentials)
+        body = urlencode(fields).encode('utf-8')
+        if self.compression == 'gzip':
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+        else:
+            body = zlib.compress(body)
+        headers = dict(self.http_pool.headers)
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        headers['Content-Encoding'] = self.compression
+        return url, body, headers
+
+    def update_fields(self, last_datetime=None):
+        """Any fields to send along with the data of an update request, whose
+        last record is at last_datetime when it's given"""
+        return {}
+
+    def http_post(self, url, postdata, headers=None):
+        """POST either form fields, or with headers, a prepared body"""
+        if headers is None:
+            return self.http_pool.request('POST', url, fields=postdata)
+        return self.http_pool.urlopen('POST', url, body=postdata,
+                                      headers=headers)
+
+    def make_http_request(self, url, postdata, headers=None):
         # updatedata.php (loop, raw data, real time)
         for count in range(self.http_max_tries):
             try:
-                response = self.http_pool.request('POST', url, postdata)
+                response = self.http_post(url, postdata, headers)
                 logdbg("loop: http response.data %s" % response.data)
                 logdbg("loop: http response.status %s" % response.status)
                 logdbg("loop: http response.reason %s" % response.reason)
                 if response.status == 200:
                     return response
+                elif response.status == 409:
+                    # a delta the remote server can't apply, it's up to the
+                    # caller to send it another way
+                    return response
                 else:
                     # from here must either set retry=True or raise a
                     # FatalSyncError
@@ -789,7 +1002,7 @@ class SyncThread(threading.Thread):
                             response.data))
                     if response.status >= 500:
                         # Don't retry if Duplicate entry error
-                        if response.data.find(b'Duplicate entry') >= 0:
+                        if self.is_duplicate(response):
                             # continue
                             return response
                         else:
@@ -813,20 +1026,40 @@ class SyncThread(threading.Thread):
                 logerr("loop: failed to connect to %s" % url)
                 logdbg("   ****  Reason: %s" % (e,))
                 retry = True  # maybe only a temporary outage.
-            except (urllib3.exceptions.MaxRetryError) as e:
+            except urllib3.exceptions.HTTPError as e:
+                # MaxRetryError, or a timeout or dropped connection
                 logerr("loop: failed http request attempt #%d to %s" % (
                        count+1, url))
                 logdbg("   ****  Reason: %s" % (e,))
                 retry = True
             if retry and count+1 < self.http_max_tries:
                 # wait a bit before retrying, ensuring that we exit if signaled
-                logdbg("loop: retrying again in %s seconds" % (
-                       self.http_retry_interval,))
-                self._wait(self.http_retry_interval)
+                retry_wait = self.retry_wait(count, self.http_retry_interval)
+                logdbg("loop: retrying again in %s seconds" % (retry_wait,))
+                self._wait(retry_wait)
         else:
             loginf("loop: Failed to invoke %s after %d tries" % (
                    url, self.http_max_tries))
 
+    @staticmethod
+    def is_duplicate(response):
+        """Whether the remote server turned the request down because it
+        already has a record in it, only an updateData.php from before
+        duplicates were skipped does so"""
+        return response is not None and response.status >= 500 and \
+            response.data.find(b'Duplicate entry') >= 0
+
+    def retry_wait(self, count, interval):
+        """Seconds to wait before retry number count+1, a flat interval
+        unless a sub-class knows better"""
+        return interval
+
+    def ack_records(self, date_time=None):
+        """Tell a durable outbox that the records taken so far are done
+        with, a plain queue.Queue has nothing to remember"""
+        if isinstance(self.queue, SyncOutbox):
+            self.queue.ack(date_time)
+
     def _wait(self, duration):
         if duration is not None:
             if self.exit_event.wait(duration):
@@ -849,41 +1082,205 @@ class RawSyncThread(SyncThread):
                                    self.http_retry_interval))
         # number of times to retry http requests (default: 1)
         self.http_max_tries = int(sync_params.get('raw_http_max_tries', 1))
+        # the max number of loop records to send in a single request. A value
+        # of 1 sends each record as soon as it arrives (default: 1)
+        self.batch_size = max(1, int(sync_params.get('raw_batch_size', 1)))
+        # the max number of seconds to hold on to a record while waiting for
+        # a batch to fill, whichever of the two limits is reached first
+        # triggers the send (default: 5 seconds)
+        self.batch_max_latency = float(sync_params.get(
+                                 'raw_batch_max_latency', 5))
+        # log the batch size and latency figures every this many batches
+        # (default: 100)
+        self.stats_interval = int(sync_params.get(
+                              'raw_batch_stats_interval', 100))
+        # 'delta' sends only the fields that changed since the packet before,
+        # the remote server rebuilding the rest from the record it has
+        # (default: full)
+        self.sync_format = sync_params.get('raw_sync_format', 'full')
+        if self.sync_format not in ('full', 'delta'):
+            raise ValueError("mesowx sync: unknown raw_sync_format '%s'" %
+                             self.sync_format)
+        # with delta, send every packet in full at least this often
+        # (default: 100)
+        self.keyframe_interval = int(sync_params.get('raw_keyframe_interval',
+                                                     100))
+        # the last packet the remote server is known to have, None for
+        # unknown, and the number of packets sent since the last full one
+        self.delta_base = None
+        self.since_keyframe = 0
         self.debug_count = 0
         self.max_times_to_print = 5
+        self.reset_batch_stats()
 
     def _run(self):
         self.sync_queued_records()
 
     def sync_queued_records(self):
         logdbg("sync raw: waiting for new records")
-        while True:
+        exiting = False
+        while not exiting:
+            batch, exiting = self.next_batch()
             try:
-                # XXX always empty the queue - send as a batch
-                # XXX option to always send in a batch, wait for X records
-                # before sending
-                raw_record = self.queue.get()
-                # a value of None is a signal to exit
-                if raw_record is None:
-                    logdbg("remote raw: exit event signaled, exiting "
-                           "queue loop")
-                    raise AbortAndExit
+                if not batch:
+                    continue
                 self.debug_count += 1
                 if self.debug_count <= self.max_times_to_print:
-                    logdbg("remote raw: send record %s" %
-                           (weeutil.weeutil.timestamp_to_string(
-                            raw_record['dateTime'])))
+                    logdbg("remote raw: send %d record(s) ending %s" %
+                           (len(batch), weeutil.weeutil.timestamp_to_string(
+                            batch[-1]['dateTime'])))
                 if self.debug_count == self.max_times_to_print:
                     logdbg("remote raw: print message above only the "
                            "first %s times" %
                            self.max_times_to_print)
-                self.post_records(raw_record)
+                if self.sync_format == 'delta':
+                    response = self.post_delta(batch)
+                elif len(batch) == 1:
+                    response = self.post_records(batch[0])
+                else:
+                    response = self.post_batch_records(batch)
+                if response is not None:
+                    self.update_batch_stats(batch)
             except SyncError as e:
-                logerr("remote raw: unable to sync record, skipping")
+                logerr("remote raw: unable to sync %d record(s), skipping" %
+                       len(batch))
                 logerr("   ****  Reason: %s" % (e,))
             finally:
-                # mark the queue item as done whether it succeeded or not
+                # mark the queue items as done whether they succeeded or not
+                for _ in batch:
+                    self.queue.task_done()
+                if batch:
+                    self.ack_records()
+        logdbg("remote raw: exit event signaled, exiting queue loop")
+        raise AbortAndExit
+
+    def next_batch(self):
+        """Block until a record arrives, then keep draining the queue until
+        either batch_size records are collected or batch_max_latency seconds
+        have passed. Returns the batch and whether an exit was signaled."""
+        batch = []
+        raw_record = self.queue.get()
+        # a value of None is a signal to exit
+        if raw_record is None:
+            self.queue.task_done()
+            return batch, True
+        batch.append(raw_record)
+        deadline = time.time() + self.batch_max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                raw_record = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if raw_record is None:
+                # send what we have before exiting
                 self.queue.task_done()
+                return batch, True
+            batch.append(raw_record)
+        return batch, False
+
+    def post_batch_records(self, batch):
+        """Sends the batch in one request. An older remote server stores all
+        of a request or none of it, so if it already has one of the records
+        (the outbox replayed them after a restart, or the response to them
+        was lost) they're sent again one at a time, or the rest would be
+        lost with it."""
+        response = self.post_records(self.align_columns(batch))
+        if not self.is_duplicate(response):
+            return response
+        logdbg("remote raw: remote server already has some of %d records, "
+               "sending them one at a time" % len(batch))
+        for record in batch:
+            if self.post_records(record) is None:
+                response = None
+        return response
+
+    def post_delta(self, batch):
+        """Sends the batch as changes from the last packet the remote server
+        has, or in full when that isn't known, is too far back, or the remote
+        server doesn't have it after all"""
+        base = self.delta_base
+        if base is not None and \
+                self.since_keyframe + len(batch) > self.keyframe_interval:
+            base = None
+        response = self.post_delta_records(batch, base)
+        if response is not None and response.status == 409:
+            logdbg("remote raw: delta base %s not found, sending in full" %
+                   base['dateTime'])
+            base = None
+            response = self.post_delta_records(batch, None)
+        if response is None or response.status != 200:
+            # not sure what it has, start again from a full packet
+            self.delta_base = None
+            return response
+        self.delta_base = batch[-1]
+        self.since_keyframe = len(batch) + (0 if base is None
+                                            else self.since_keyframe)
+        return response
+
+    def post_delta_records(self, batch, base):
+        records = []
+        previous = base
+        for packet in batch:
+            if previous is None:
+                record = self.without_nulls(packet)
+            else:
+                record = dict((k, v) for k, v in packet.items()
+                              if k not in previous or previous[k] != v)
+                for k in previous:
+                    if k not in packet:
+                        record[k] = None
+                record['dateTime'] = packet['dateTime']
+            records.append(record)
+            previous = packet
+        # the dateTime of the base is all the server needs to resync, it
+        # either has that record or answers 409
+        datajson = json.dumps({'delta': {
+            'base': None if base is None else base['dateTime'],
+            'records': records}})
+        url, postdata, headers = self.update_request(datajson)
+        return self.make_http_request(url, postdata, headers)
+
+    @staticmethod
+    def align_columns(batch):
+        """updateData.php requires that every record in a request has the
+        same columns, loop packets don't always do so, fill the gaps with
+        None."""
+        keys = set()
+        for record in batch:
+            keys.update(record)
+        return [dict((k, record.get(k)) for k in keys) for record in batch]
+
+    def reset_batch_stats(self):
+        self.stats_batches = 0
+        self.stats_records = 0
+        self.stats_max_size = 0
+        self.stats_latency_total = 0.0
+        self.stats_latency_max = 0.0
+
+    def update_batch_stats(self, batch):
+        """Track the batch sizes and the end-to-end latency, measured from the
+        dateTime of each packet to the completion of its request."""
+        now = time.time()
+        self.stats_batches += 1
+        self.stats_records += len(batch)
+        self.stats_max_size = max(self.stats_max_size, len(batch))
+        for record in batch:
+            latency = now - record['dateTime']
+            self.stats_latency_total += latency
+            self.stats_latency_max = max(self.stats_latency_max, latency)
+        if self.stats_interval > 0 and \
+                self.stats_batches >= self.stats_interval:
+            loginf("remote raw: sent %d records in %d batches; batch size "
+                   "avg %.1f max %d; latency avg %.1fs max %.1fs" %
+                   (self.stats_records, self.stats_batches,
+                    float(self.stats_records) / self.stats_batches,
+                    self.stats_max_size,
+                    self.stats_latency_total / self.stats_records,
+                    self.stats_latency_max))
+            self.reset_batch_stats()
 
 
 class ArchiveSyncThread(SyncThread):
@@ -893,10 +1290,14 @@ class ArchiveSyncThread(SyncThread):
     #    query for latest remote date
     #    send data since that date
     #    then load data from queue
-    def __init__(self, queue, exit_event, http_pool, **sync_params):
+    def __init__(self, queue, exit_event, http_pool, config_dict,
+                 **sync_params):
         SyncThread.__init__(self, queue, exit_event, http_pool,
                             "ArchiveSyncThread", **sync_params)
-
+        # the thread opens its own database manager, see _run()
+        self.config_dict = config_dict
+        self.data_binding = sync_params.get('data_binding', 'wx_binding')
+        self.dbm = None
         # the path on the remote server of the data query api (usually won't
         # ever change this)
         self.server_data_path = sync_params.get('server_data_path', "data.php")
@@ -919,24 +1320,96 @@ class ArchiveSyncThread(SyncThread):
         # the url that will be used to query for the latest dateTime on the
         # remote server
         self.latest_url = self.remote_server_url + self.server_data_path
+        # the maximum number of reords to back_fill (defualt: no limit)
+        self.backfill_limit = int(sync_params.get('archive_backfill_limit', 0))
+        # the max number of records to send in a request (default: 200)
+        self.batch_size = int(sync_params.get('archive_batch_size', 200))
+        # the number of seconds to wait between sending batches
+        # (default .5 seconds)
+        self.batch_send_interval = float(sync_params.get(
+                                   'archive_batch_send_interval', 0.5))
+        # how back_fill batches are encoded, 'rows' as a list of objects, or
+        # 'columnar', the column names then the rows as arrays, which needs
+        # the matching updateData.php (default: rows)
+        self.sync_format = sync_params.get('archive_sync_format', 'rows')
+        if self.sync_format not in ('rows', 'columnar'):
+            raise ValueError("mesowx sync: unknown archive_sync_format '%s'" %
+                             self.sync_format)
+        self.json_encoder = json.JSONEncoder(separators=(',', ':'))
+        # the number of back_fill batches to have on their way to the remote
+        # server at once (default: 1, wait for each one before the next)
+        self.pipeline_depth = max(1, int(sync_params.get(
+                                  'archive_pipeline_depth', 1)))
+        # number of times, and seconds between, back_fill http requests
+        self.backfill_max_tries = 3
+        self.backfill_retry_interval = 0
+        # let the server's response times size the back_fill batches, and
+        # back off exponentially (with jitter) after failures, rather than
+        # the fixed sizes and waits above, which become the limits
+        # (default: false)
+        self.controller = None
+        if weeutil.weeutil.to_bool(sync_params.get('archive_adaptive',
+                                                   False)):
+            self.controller = BatchController(
+                self.batch_size, self.batch_send_interval,
+                min_size=int(sync_params.get('archive_batch_size_min', 10)),
+                max_size=int(sync_params.get('archive_batch_size_max', 2000)),
+                target_time=float(sync_params.get(
+                    'archive_target_response_time', 2.0)),
+                max_interval=float(sync_params.get(
+                    'archive_batch_send_interval_max', 30)))
+        # the first wait of the exponential backoff, it doubles each time up
+        # to archive_http_retry_interval or archive_failure_retry_interval
+        # (default: 5 seconds)
+        self.backoff_base = float(sync_params.get('archive_backoff_base', 5))
+        # consecutive times sync has failed and started over
+        self.failures = 0
         # the datetime of the most recently synced archive record, this is
         # used to prevent potentially re-sending queued records that a
         # back_fill already sent (the queue is still populated during this
         # process)
+        self.last_datetime_synced = None
+        # the datetime the remote server is known to have every archive
+        # record up to, once back_fill has started sending. Starting over
+        # after a failure carries on from here rather than asking the remote
+        # server, whose latest record can be past a batch that failed while
+        # the pipelined ones after it got through
+        self.resume_datetime = None
+        # the datetime after which every record up to resume_datetime is on
+        # the remote server, i.e. where the records sent in order started.
+        # Sent along as complete_from/complete_to, the remote server's
+        # watermark, behind which data.php lets its tiles be cached for good,
+        # moves on as long as it carries on from it. A gap (a record dropped,
+        # or a back_fill over the limit) starts a new run, which the
+        # watermark then can't reach
+        self.complete_from = None
 
     def _run(self):
-        while True:
-            try:
-                self.sync_queued_records()
-            except SyncError as e:
-                logerr("remote archive: synchronization failed, starting "
-                       "over in %s seconds" %
-                       self.failure_retry_interval)
-                logerr("   ****  Reason: %s" % (e,))
-                self._wait(self.failure_retry_interval)
+        self.dbm = weewx.manager.open_manager_with_config(self.config_dict,
+                                                          self.data_binding)
+        try:
+            back_filled = False
+            while True:
+                try:
+                    if not back_filled:
+                        # back_fill missed records on webserver, anything
+                        # arriving in the meantime waits in the queue
+                        self.back_fill()
+                        back_filled = True
+                        self.failures = 0
+                    self.sync_queued_records()
+                except SyncError as e:
+                    retry_wait = self.failure_wait()
+                    logerr("remote archive: synchronization failed, starting "
+                           "over in %s seconds" % retry_wait)
+                    logerr("   ****  Reason: %s" % (e,))
+                    self._wait(retry_wait)
+                    if isinstance(self.queue, SyncOutbox):
+                        self.queue.rewind()
+        finally:
+            self.dbm.close()
 
     def sync_queued_records(self):
-        global last_datetime_synced
         logdbg("remote archive: waiting for new records")
         while True:
             try:
@@ -950,9 +1423,10 @@ class ArchiveSyncThread(SyncThread):
                        (weeutil.weeutil.timestamp_to_string(
                         archive_record['dateTime']),
                         weeutil.weeutil.timestamp_to_string(
-                        last_datetime_synced)))
-                if last_datetime_synced is not None and (
-                        archive_record['dateTime'] <= last_datetime_synced):
+                        self.last_datetime_synced)))
+                if self.last_datetime_synced is not None and (
+                        archive_record['dateTime'] <=
+                        self.last_datetime_synced):
                     logdbg("remote archive: skip already synced record %s" %
                            weeutil.weeutil.timestamp_to_string(
                             archive_record['dateTime']))
@@ -960,23 +1434,1297 @@ class ArchiveSyncThread(SyncThread):
                     logdbg("remote archive: send record %s" %
                            weeutil.weeutil.timestamp_to_string(
                             archive_record['dateTime']))
-                    self.post_records(archive_record)
+                    response = self.post_records(archive_record,
+                                                 archive_record['dateTime'])
+                    if response is not None:
+                        self.last_datetime_synced = archive_record['dateTime']
+                        self.resume_datetime = self.last_datetime_synced
+                        self.failures = 0
+                    elif isinstance(self.queue, SyncOutbox):
+                        # leave it in the outbox to try again later
+                        raise SyncError("unable to send record %s" %
+                                        weeutil.weeutil.timestamp_to_string(
+                                         archive_record['dateTime']))
+                    else:
+                        # dropped, the records after it are a new run
+                        self.complete_from = archive_record['dateTime']
+                self.ack_records(self.last_datetime_synced)
             finally:
                 # mark the queue item as done whether it succeeded or not
                 self.queue.task_done()
 
-###############################
-# start of original raw.0.4.1-lh.py script
-################################
-# VERSION = "0.4.1-lh"
-#
-# 2015-12-28 Modified by Luc Heijst to work with weewx version 3.3.1
-#
-
+    def back_fill(self):
+        if self.resume_datetime is not None:
+            # starting over after a failure, from the last record sent with
+            # every one before it
+            self.last_datetime_synced = self.resume_datetime
+        elif isinstance(self.queue, SyncOutbox) and \
+                self.queue.synced_datetime is not None:
+            # the outbox knows where we got to, no need to ask
+            self.last_datetime_synced = self.queue.synced_datetime
+        else:
+            self.last_datetime_synced = self.fetch_latest_remote_datetime()
+        if self.complete_from is None:
+            # the remote server has every record up to here, as far as
+            # we know, 0 (everything) if it had nothing
+            self.complete_from = self.last_datetime_synced or 0
+        if self.last_datetime_synced is None:
+            num_to_sync = self.dbm.getSql("select count(*) from %s" %
+                                          self.dbm.table_name)[0]
+        else:
+            num_to_sync = self.dbm.getSql("select count(*) from %s "
+                                          "where dateTime > ?" %
+                                          self.dbm.table_name,
+                                          (self.last_datetime_synced,))[0]
+        logdbg("remote: %d records to sync since last record "
+               "with dateTime: %s" %
+               (num_to_sync, weeutil.weeutil.timestamp_to_string(
+                self.last_datetime_synced)))
+        if num_to_sync > 0:
+            if self.backfill_limit is not None and self.backfill_limit != 0 \
+                        and num_to_sync > self.backfill_limit:
+                loginf("remote: Too many to sync: %d exeeds the limit of %d" %
+                       (num_to_sync, self.backfill_limit))
+                # the records that arrive from now on are a new run
+                self.complete_from = self.dbm.lastGoodStamp()
+            else:
+                logdbg("remote: back_filling %d records" % num_to_sync)
+                self.sync_all_since_datetime(self.last_datetime_synced)
+                logdbg("remote: done back_filling %d records" %
+                       num_to_sync)
 
-class RawService(StdService):
+    def sync_all_since_datetime(self, datetime):
+        # from here on a failure starts over from what has been sent in order,
+        # 0 (everything) if the remote server had nothing
+        self.resume_datetime = datetime if datetime is not None else 0
+        if datetime is None:
+            query = self.dbm.genSql("select * from %s order by dateTime asc" %
+                                    self.dbm.table_name)
+        else:
+            query = self.dbm.genSql("select * from %s where "
+                                    "dateTime > ? order by dateTime asc" %
+                                    self.dbm.table_name, (datetime,))
+        if self.pipeline_depth > 1:
+            self.sync_pipelined(query)
+            return
+        total_sent = 0
+        date_time_index = self.dbm.sqlkeys.index('dateTime')
+        while True:
+            batch = list(itertools.islice(query, self.batch_size))
+            if len(batch) > 0:
+                if self.post_batch(self.encode_rows(batch),
+                                   batch[-1][date_time_index]) is None:
+                    # stop here rather than leave a gap, back_fill starts
+                    # over from the last batch sent
+                    raise SyncError("back_fill stopped at %s" %
+                                    weeutil.weeutil.timestamp_to_string(
+                                     batch[0][date_time_index]))
+                total_sent += len(batch)
+                self.last_datetime_synced = batch[-1][date_time_index]
+                self.resume_datetime = self.last_datetime_synced
+                self.ack_records(self.last_datetime_synced)
+                # XXX add start/end datetime to log message
+                logdbg("remote: back_filled %d records; "
+                       "timestamp last record: %s" %
+                       (total_sent, weeutil.weeutil.timestamp_to_string(
+                        self.last_datetime_synced)))
+            else:
+                # no more to send
+                break
+            # breath a bit so as not to bombard the remote server. Also
+            # back_filling could take some time, so make sure an exit event
+            # hasn't been signaled
+            self._wait(self.batch_send_interval)
 
-    def __init__(self, engine, config_dict):
+    def sync_pipelined(self, query):
+        """Keep up to pipeline_depth batches in flight at once. They may be
+        acknowledged out of order, but last_datetime_synced only moves past a
+        batch once it, and every batch before it, has been acknowledged. So
+        the records on the remote server are still in order as far as a
+        restart of the back_fill is concerned."""
+        total_sent = 0
+        date_time_index = self.dbm.sqlkeys.index('dateTime')
+        in_flight = collections.deque()
+        exhausted = False
+        last_row = None
+        try:
+            while True:
+                while not exhausted and len(in_flight) < self.pipeline_depth:
+                    batch = list(itertools.islice(query, self.batch_size))
+                    if not batch:
+                        exhausted = True
+                        break
+                    upload = BatchUpload(self, self.encode_rows(batch),
+                                         batch[0][date_time_index],
+                                         batch[-1][date_time_index],
+                                         len(batch))
+                    upload.start()
+                    in_flight.append(upload)
+                    last_row = batch[-1]
+                    # breath a bit so as not to bombard the remote server
+                    self._wait(self.batch_send_interval)
+                if not in_flight:
+                    # no more to send. The last batches only claimed what
+                    # was acknowledged before they went, so send the last
+                    # record again, which the remote server skips, to move
+                    # its watermark on to here now every one is
+                    if last_row is not None:
+                        self.post_batch(self.encode_rows([last_row]),
+                                        last_row[date_time_index])
+                    break
+                upload = in_flight.popleft()
+                while upload.is_alive():
+                    self._wait(0)
+                    upload.join(1.0)
+                if upload.response is None:
+                    # the batches after this one are past a gap, they'll be
+                    # sent again when back_fill starts over from
+                    # resume_datetime, the remote server skipping the records
+                    # it already has
+                    raise SyncError("back_fill stopped at %s" %
+                                    weeutil.weeutil.timestamp_to_string(
+                                     upload.first_datetime))
+                total_sent += upload.count
+                self.last_datetime_synced = upload.last_datetime
+                self.resume_datetime = self.last_datetime_synced
+                self.ack_records(self.last_datetime_synced)
+                logdbg("remote: back_filled %d records; "
+                       "timestamp last record: %s; %d batches in flight" %
+                       (total_sent, weeutil.weeutil.timestamp_to_string(
+                        self.last_datetime_synced), len(in_flight)))
+        finally:
+            for upload in in_flight:
+                upload.join(20.0)
+
+    def observe(self, elapsed, status):
+        """Pass the outcome of a back_fill request to the controller, which
+        may change the batch size and the wait between batches"""
+        if self.controller is None:
+            return
+        if self.controller.observe(elapsed, status):
+            self.batch_size = self.controller.size
+            self.batch_send_interval = self.controller.interval
+            logdbg("backfill: %s response in %.2f seconds, batch size now "
+                   "%d, send interval %.2f seconds" %
+                   (status, elapsed, self.batch_size,
+                    self.batch_send_interval))
+
+    def retry_wait(self, count, interval):
+        """With the controller, retries back off exponentially from
+        backoff_base up to archive_http_retry_interval"""
+        if self.controller is None:
+            return interval
+        return BatchController.backoff(count, self.backoff_base,
+                                       self.http_retry_interval)
+
+    def failure_wait(self):
+        """Seconds to wait before starting over after a SyncError"""
+        self.failures += 1
+        if self.controller is None:
+            return self.failure_retry_interval
+        return BatchController.backoff(self.failures - 1, self.backoff_base,
+                                       self.failure_retry_interval)
+
+    def fetch_latest_remote_datetime(self):
+        logdbg("remote backfill: requesting latest dateTime from %s" %
+               self.latest_url)
+        # A valid timestamp to be used to halt the backfill on an invalid
+        # json response (which means no datetime was returned)
+        current_time = int(time.time())
+        # http://wxdev.ruskers.com/
+        # data.php?entity_id=weewx_archive&data=dateTime&order=desc&limit=1
+        postdata = {'entity_id': self.entity_id, 'data': 'dateTime',
+                    'order': 'desc', 'limit': 1}
+        http_response = self.backfill_http_request(self.latest_url, postdata)
+        try:
+            response_json = http_response.data.decode('utf-8')
+        except Exception as e:
+            # NoneType object has no attribute data - server not responding
+            logdbg("remote: Exception as %s" % e)
+            logerr("remote backfill: no datetime available. Returning current"
+                   " time %s to halt any backfill operation."
+                   " ( is the server running? )" % current_time)
+            return current_time
+        try:
+            response = json.loads(response_json)
+        except Exception as e:
+            logerr("remote: no datetime available: http response.data % and "
+                   "error %s" % (response_json, e))
+            return current_time
+        if len(response) == 0:
+            datetime = None
+        else:
+            datetime = response[0][0]
+        return datetime
+
+    def update_fields(self, last_datetime=None):
+        """Claim the records sent in order so far. Those of a request sent
+        once every one before it was acknowledged are included, given its
+        last_datetime, a pipelined batch only claims those already
+        acknowledged, as one before it may yet fail"""
+        complete_from = self.complete_from
+        complete_to = last_datetime
+        if complete_to is None:
+            complete_to = self.resume_datetime
+        if complete_from is None or complete_to is None or \
+                complete_to <= complete_from:
+            return {}
+        return {'complete_from': complete_from, 'complete_to': complete_to}
+
+    def encode_rows(self, rows):
+        """Encode database rows as the JSON for a request. The 'columnar'
+        format names the columns once and writes each row straight from the
+        cursor as an array, rather than building a dict per row."""
+        if self.sync_format == 'columnar':
+            encode = self.json_encoder.encode
+            columns = self.dbm.sqlkeys
+            if self.elide_nulls:
+                # drop the columns that are null in every row of the batch
+                keep = [i for i in range(len(columns))
+                        if any(row[i] is not None for row in rows)]
+                if len(keep) < len(columns):
+                    columns = [columns[i] for i in keep]
+                    rows = [[row[i] for i in keep] for row in rows]
+            return '{"columns":%s,"rows":[%s]}' % (
+                   encode(columns),
+                   ",".join([encode(row) for row in rows]))
+        if self.elide_nulls:
+            return json.dumps([dict((k, v) for k, v in
+                                    zip(self.dbm.sqlkeys, row)
+                                    if v is not None) for row in rows])
+        return json.dumps([dict(zip(self.dbm.sqlkeys, row)) for row in rows])
+
+    def post_batch(self, datajson, last_datetime=None):
+        url, postdata, headers = self.update_request(datajson, last_datetime)
+        return self.backfill_http_request(url, postdata, headers)
+
+    def backfill_http_request(self, url, postdata, headers=None):
+        # data.php (backfilling)
+        for count in range(self.backfill_max_tries):
+            started = time.time()
+            try:
+                response = self.http_post(url, postdata, headers)
+                # a duplicate is taken as stored below, so it counts as a
+                # success for the batch size too
+                self.observe(time.time() - started,
+                             200 if self.is_duplicate(response)
+                             else response.status)
+                logdbg("backfill: archive http response.data %s" %
+                       response.data)
+                if response.status == 200:
+                    return response
+                else:
+                    # from here must either set retry=True or raise a
+                    # FatalSyncError
+                    logerr("backfill: http request failed (%s %s): %s" %
+                           (response.status,
+                            response.reason,
+                            response.data))
+                    if response.status >= 500:
+                        # Don't retry if Duplicate entry error
+                        if self.is_duplicate(response):
+                            # continue
+                            return response
+                        else:
+                            retry = True
+                    else:
+                        message = ("backfill: Request to %s failed, server "
+                                   "returned %s status with reason '%s'." %
+                                   (url, response.status, response.reason))
+                        # invalid credentials
+                        if response.status == 403:
+                            message += " Do your entity security keys match?"
+                        # page not found
+                        if response.status == 404:
+                            message += " Is the url correct?"
+                        # bad request (likely an invalid setup)
+                        if response.status == 400:
+                            message += " Check your entity configuration."
+                        loginf(message)
+                        # don't retry on these errors
+                        retry = False
+            except (urllib3.exceptions.NewConnectionError) as e:
+                self.observe(time.time() - started, None)
+                logerr("backfill: failed to connect to %s" % url)
+                logdbg("   ****  Reason: %s" % (e,))
+                retry = False  # if we can't find it on start up, assume *we*
+                               # made an error and stop retrying
+            except urllib3.exceptions.HTTPError as e:
+                # MaxRetryError, or a timeout or dropped connection
+                self.observe(time.time() - started, None)
+                logerr("backfill: failed http request attempt #%d to %s" % (
+                       count+1, url))
+                logdbg("   ****  Reason: %s" % (e,))
+                retry = True
+            if retry and count+1 < self.backfill_max_tries:
+                # wait a bit before retrying, ensuring that we exit if signaled
+                retry_wait = self.retry_wait(count,
+                                             self.backfill_retry_interval)
+                logdbg("backfill: retrying again in %s seconds" % (
+                       retry_wait,))
+                self._wait(retry_wait)
+        else:
+            logerr("backfill: failed to invoke %s after %d tries" % (
+                   url, self.backfill_max_tries))
+
+
+class BatchUpload(threading.Thread):
+    """Sends one back_fill batch for ArchiveSyncThread.sync_pipelined(), the
+    response is None if it failed."""
+
+    def __init__(self, sync_thread, datajson, first_datetime, last_datetime,
+                 count):
+        threading.Thread.__init__(self, name="BatchUpload-%d" % last_datetime)
+        self.setDaemon(True)
+        self.sync_thread = sync_thread
+        self.datajson = datajson
+        self.first_datetime = first_datetime
+        self.last_datetime = last_datetime
+        self.count = count
+        self.response = None
+
+    def run(self):
+        try:
+            self.response = self.sync_thread.post_batch(self.datajson)
+        except AbortAndExit:
+            pass
+        except Exception as e:
+            logerr("backfill: batch ending %s failed: %s" %
+                   (weeutil.weeutil.timestamp_to_string(self.last_datetime),
+                    e))
+
+
+class BatchController(object):
+    """Sizes back_fill batches from how quickly the remote server answers.
+    While responses come back within target_time the batch grows by a
+    quarter and the wait between batches falls back towards the configured
+    one. A slow response, a 5xx (other than a duplicate entry, which is as
+    good as stored) or no response at all halves the batch and doubles the
+    wait. Batches from sync_pipelined() report from their own threads, hence
+    the lock."""
+
+    def __init__(self, size, interval, min_size=10, max_size=2000,
+                 target_time=2.0, max_interval=30):
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.size = min(max(size, self.min_size), self.max_size)
+        self.base_interval = interval
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.target_time = target_time
+        self.lock = threading.Lock()
+
+    def observe(self, elapsed, status):
+        """Returns True if the size or interval changed"""
+        with self.lock:
+            size, interval = self.size, self.interval
+            if status is None or status >= 500 or elapsed > self.target_time:
+                self.size = max(self.min_size, self.size // 2)
+                self.interval = min(self.max_interval,
+                                    max(self.interval * 2, 0.5))
+            elif status == 200:
+                self.size = min(self.max_size,
+                                self.size + max(1, self.size // 4))
+                self.interval = max(self.base_interval, self.interval / 2)
+            return (size, interval) != (self.size, self.interval)
+
+    @staticmethod
+    def backoff(count, base, limit):
+        """Exponential backoff, base * 2**count capped at limit, jittered
+        to between half and all of that so that stations behind the same
+        outage don't all come back at once"""
+        wait = min(limit, base * 2 ** min(count, 30))
+        return wait / 2 + random.uniform(0, wait / 2)
+
+###############################
+# start of original raw.0.4.1-lh.py script
+################################
+# VERSION = "0.4.1-lh"
+#
+# 2015-12-28 Modified by Luc Heijst to work with weewx version 3.3.1
+#
+
+
+class LoopFilter(object):
+    """
+    Thins out loop packets that add little, before RawService stores them or
+    SyncService sends them. Each field has a deadband (its band, or the
+    default); in 'deadband' mode a packet is passed on when a field has
+    moved by more than that since the last packet passed on, in
+    'swinging_door' mode when a straight line from the last packet passed on
+    can no longer go within that of every packet since, and then it's the
+    packet before that is passed on. Either way a packet is passed on at
+    least every max_interval seconds, and what the packets held back had of
+    the sum_fields (i.e. rain) is added to the next one passed on.
+    """
+
+    IGNORED = ('dateTime', 'usUnits', 'interval')
+
+    def __init__(self, name, mode='deadband', bands=None, default_band=0.0,
+                 max_interval=60, sum_fields=('rain',), stats_interval=3600):
+        if mode not in ('deadband', 'swinging_door'):
+            raise ValueError("mesowx loop filter: unknown mode '%s'" % mode)
+        self.name = name
+        self.mode = mode
+        self.bands = dict(bands or {})
+        self.default_band = default_band
+        self.max_interval = max_interval
+        self.sum_fields = list(sum_fields)
+        self.stats_interval = stats_interval
+        # the last packet passed on
+        self.anchor = None
+        # the newest packet not (yet) passed on, and the sum_fields of those
+        # held back before it
+        self.held = None
+        self.carry = {}
+        # swinging door slopes from the anchor, by field
+        self.upper = {}
+        self.lower = {}
+        self.count_in = 0
+        self.count_out = 0
+        self.last_stats = time.time()
+
+    def band(self, field):
+        return self.bands.get(field, self.default_band)
+
+    def add(self, packet):
+        """Returns the packets to pass on now"""
+        self.count_in += 1
+        if self.anchor is None:
+            passed = [self.emit(packet)]
+        elif self.mode == 'deadband':
+            passed = self.add_deadband(packet)
+        else:
+            passed = self.add_swinging_door(packet)
+        self.count_out += len(passed)
+        self.log_stats()
+        return passed
+
+    def flush(self):
+        """Returns the packet held back, if any, with what it carries"""
+        if self.held is None:
+            return []
+        passed = [self.emit(self.held)]
+        self.count_out += 1
+        return passed
+
+    def add_deadband(self, packet):
+        if packet['dateTime'] - self.anchor['dateTime'] >= \
+                self.max_interval or self.moved(packet):
+            return [self.emit(packet)]
+        self.hold(packet)
+        return []
+
+    def moved(self, packet):
+        anchor = self.anchor
+        for field, value in packet.items():
+            if field in self.IGNORED or field in self.sum_fields:
+                continue
+            last = anchor.get(field)
+            if value is None or last is None:
+                if value is not last:
+                    return True
+            else:
+                try:
+                    if abs(value - last) > self.band(field):
+                        return True
+                except TypeError:
+                    if value != last:
+                        return True
+        return False
+
+    def add_swinging_door(self, packet):
+        if self.held is not None and (
+                packet['dateTime'] - self.anchor['dateTime'] >
+                self.max_interval or not self.narrow_doors(packet)):
+            # the door has opened, the packet before is the last that fits
+            passed = [self.emit(self.held)]
+            self.open_doors(packet)
+            self.held = packet
+            return passed
+        if self.held is None:
+            self.open_doors(packet)
+        self.hold(packet)
+        return []
+
+    def open_doors(self, packet):
+        """Starts the doors from the anchor through packet"""
+        self.upper = {}
+        self.lower = {}
+        self.narrow_doors(packet)
+
+    def narrow_doors(self, packet):
+        """Narrows the doors to fit packet, returns whether they're still
+        open to a line through every packet since the anchor"""
+        anchor = self.anchor
+        elapsed = float(packet['dateTime'] - anchor['dateTime'])
+        if elapsed <= 0:
+            return False
+        fits = True
+        for field, value in packet.items():
+            if field in self.IGNORED or field in self.sum_fields:
+                continue
+            start = anchor.get(field)
+            if value is None or start is None:
+                if value is not start:
+                    fits = False
+                continue
+            band = self.band(field)
+            try:
+                upper = (value + band - start) / elapsed
+                lower = (value - band - start) / elapsed
+            except TypeError:
+                if value != start:
+                    fits = False
+                continue
+            if field in self.upper:
+                upper = min(upper, self.upper[field])
+                lower = max(lower, self.lower[field])
+            self.upper[field] = upper
+            self.lower[field] = lower
+            if lower > upper:
+                fits = False
+        return fits
+
+    def hold(self, packet):
+        """Holds packet back, adding the one held before to the carry"""
+        if self.held is not None:
+            for field in self.sum_fields:
+                value = self.held.get(field)
+                if value:
+                    self.carry[field] = self.carry.get(field, 0) + value
+        self.held = packet
+
+    def emit(self, packet):
+        if packet is not self.held:
+            self.hold(None)
+        self.held = None
+        carry, self.carry = self.carry, {}
+        if any(carry.values()):
+            packet = dict(packet)
+            for field, value in carry.items():
+                packet[field] = (packet.get(field) or 0) + value
+        self.anchor = packet
+        return packet
+
+    def log_stats(self, force=False):
+        now = time.time()
+        if force or now - self.last_stats >= self.stats_interval:
+            loginf("%s: loop filter passed %d of %d packets (%.0f%% fewer)" %
+                   (self.name, self.count_out, self.count_in,
+                    100.0 * (self.count_in - self.count_out) /
+                    max(1, self.count_in)))
+            self.last_stats = now
+
+    @staticmethod
+    def from_config(config_dict, name):
+        """The filter configured in [Mesowx][[LoopFilter]]"""
+        d = config_dict['Mesowx'].get('LoopFilter', {})
+        bands = dict((k, float(v)) for k, v in d.get('fields', {}).items())
+        return LoopFilter(
+            name, mode=d.get('mode', 'deadband'), bands=bands,
+            default_band=float(d.get('deadband', 0)),
+            max_interval=int(d.get('max_interval', 60)),
+            sum_fields=weeutil.weeutil.option_as_list(d.get('sum_fields',
+                                                            ['rain'])),
+            stats_interval=int(d.get('stats_interval', 3600)))
+
+
+class RawWriter(object):
+    """
+    Writes loop packets to the raw table.
+
+    With a buffer_size of 1 each packet is added as it arrives. Larger values
+    hold packets back until buffer_size of them are waiting, or the oldest has
+    waited buffer_interval seconds, then write them with one multi-row INSERT
+    in a single transaction.
+
+    Pruning deletes in chunks of prune_chunk_seconds worth of dateTime, each
+    chunk its own statement so the locks are let go between them, and stops
+    once prune_time_budget seconds are used up; the next prune carries on.
+    With prune_strategy = partition (MySQL only) the table is partitioned by
+    dateTime into partition_seconds wide ranges instead, and old partitions
+    are dropped whole.
+    """
+
+    # sqlite refuses statements with more than 999 bound values (older
+    # builds), so larger buffers are split across several INSERTs
+    max_bound_values = 999
+
+    def __init__(self, dbm, buffer_size=1, buffer_interval=60,
+                 prune_options=None):
+        self.dbm = dbm
+        self.buffer_size = max(1, buffer_size)
+        self.buffer_interval = buffer_interval
+        self.buffer = []
+        prune_options = prune_options or {}
+        self.prune_strategy = prune_options.get('prune_strategy', 'chunked')
+        self.prune_chunk = int(prune_options.get('prune_chunk_seconds', 3600))
+        self.prune_budget = float(prune_options.get('prune_time_budget', 5))
+        self.partition_span = int(prune_options.get('partition_seconds',
+                                                    3600))
+        if self.prune_strategy not in ('chunked', 'partition'):
+            raise ValueError("mesowx raw: unknown prune_strategy '%s'" %
+                             self.prune_strategy)
+        if self.prune_strategy == 'partition' and \
+                getattr(dbm.connection, 'dbtype', None) != 'mysql':
+            logerr("local raw: prune_strategy partition needs MySQL, "
+                   "using chunked")
+            self.prune_strategy = 'chunked'
+        # number of records handed to the database
+        self.count_written = 0
+
+    def add(self, packet):
+        if self.buffer_size == 1:
+            # addRecord only takes a dict for a single record
+            self.dbm.addRecord(packet if isinstance(packet, dict) else
+                               dict(packet))
+            self.count_written += 1
+            return
+        # keep a copy, the packet is still on its way through the engine
+        self.buffer.append(dict(packet))
+        if len(self.buffer) >= self.buffer_size or (
+                packet['dateTime'] - self.buffer[0]['dateTime'] >=
+                self.buffer_interval):
+            self.flush()
+
+    def flush(self):
+        """Write out any buffered packets"""
+        if not self.buffer:
+            return
+        records, self.buffer = self.buffer, []
+        try:
+            self.insert_records(records)
+        except weedb.IntegrityError as e:
+            # one duplicate fails the whole statement, fall back to adding
+            # them one at a time so the rest still make it
+            logerr("local raw: bulk insert failed, adding %d records "
+                   "singly: %s" % (len(records), e))
+            self.dbm.addRecord(records)
+        self.count_written += len(records)
+
+    def insert_records(self, records):
+        keys = self.dbm.sqlkeys
+        placeholders = "(%s)" % ", ".join("?" * len(keys))
+        rows_per_insert = max(1, self.max_bound_values // len(keys))
+        with weedb.Transaction(self.dbm.connection) as cursor:
+            for i in range(0, len(records), rows_per_insert):
+                chunk = records[i:i + rows_per_insert]
+                sql = "INSERT INTO %s (%s) VALUES %s" % (
+                      self.dbm.table_name, ", ".join(keys),
+                      ", ".join([placeholders] * len(chunk)))
+                cursor.execute(sql, [record.get(k) for record in chunk
+                                     for k in keys])
+        logdbg("local raw: added %d records ending %s" %
+               (len(records), weeutil.weeutil.timestamp_to_string(
+                records[-1]['dateTime'])))
+
+    def prune(self, ts, max_tries=3, retry_wait=10):
+        """remove rawdata older than data_limit hours from the database"""
+        if self.prune_strategy == 'partition':
+            self.prune_partitions(ts, max_tries, retry_wait)
+        else:
+            self.prune_chunked(ts, max_tries, retry_wait)
+
+    def prune_chunked(self, ts, max_tries, retry_wait):
+        started = time.time()
+        oldest = self.dbm.getSql("select min(dateTime) from %s" %
+                                 self.dbm.table_name)[0]
+        while oldest is not None and oldest < ts:
+            # walk forward from the oldest record so each delete covers a
+            # bounded range of the primary key
+            upper = min(ts, oldest + self.prune_chunk)
+            self.execute_with_retry("delete from %s where dateTime < %d" %
+                                    (self.dbm.table_name, upper),
+                                    max_tries, retry_wait)
+            oldest = upper
+            if time.time() - started > self.prune_budget:
+                loginf("local raw: prune stopped at %s, out of time" %
+                       weeutil.weeutil.timestamp_to_string(upper))
+                return
+        loginf('local raw: deleted rawdata prior to %s' %
+               weeutil.weeutil.timestamp_to_string(ts))
+
+    def prune_partitions(self, ts, max_tries, retry_wait):
+        table = self.dbm.table_name
+        partitions = self.partitions()
+        if not partitions:
+            # first time through, partition the table. Everything up to the
+            # next boundary after ts goes in the first partition.
+            first = (int(ts) // self.partition_span + 1) * self.partition_span
+            self.execute_with_retry(
+                "alter table %s partition by range (dateTime) (%s)" %
+                (table, self.partition_sql(first, first)),
+                max_tries, retry_wait)
+            partitions = self.partitions()
+        expired = [name for name, upper in partitions
+                   if upper is not None and upper <= ts]
+        if expired:
+            self.execute_with_retry("alter table %s drop partition %s" %
+                                    (table, ", ".join(expired)),
+                                    max_tries, retry_wait)
+            loginf('local raw: dropped %d partition(s) prior to %s' %
+                   (len(expired), weeutil.weeutil.timestamp_to_string(ts)))
+        # keep a couple of empty partitions ahead of the incoming data so
+        # that nothing lands in the catch-all one
+        highest = max(upper for name, upper in partitions
+                      if upper is not None)
+        wanted = time.time() + 2 * self.partition_span
+        if highest < wanted:
+            self.execute_with_retry(
+                "alter table %s reorganize partition pmax into (%s)" %
+                (table, self.partition_sql(highest + self.partition_span,
+                                           wanted)),
+                max_tries, retry_wait)
+
+    def partition_sql(self, first, last):
+        """Partition definitions from first to at least last, ending in the
+        catch-all pmax"""
+        defs = []
+        upper = first
+        while True:
+            defs.append("partition p%d values less than (%d)" % (upper, upper))
+            if upper >= last:
+                break
+            upper += self.partition_span
+        defs.append("partition pmax values less than maxvalue")
+        return ", ".join(defs)
+
+    def partitions(self):
+        """Returns a list of (name, upper bound) for the table's partitions,
+        the bound is None for the catch-all"""
+        partitions = []
+        for name, upper in self.dbm.genSql(
+                "select partition_name, partition_description "
+                "from information_schema.partitions where table_schema = ? "
+                "and table_name = ? and partition_name is not null "
+                "order by partition_ordinal_position",
+                (self.dbm.connection.database_name, self.dbm.table_name)):
+            partitions.append((name, None if upper == 'MAXVALUE'
+                               else int(upper)))
+        return partitions
+
+    def execute_with_retry(self, sql, max_tries, retry_wait):
+        for count in range(max_tries):
+            try:
+                self.dbm.getSql(sql)
+                break
+            except Exception as e:
+                logerr("local raw: prune failed (attempt %d of %d): %s" %
+                       ((count + 1), max_tries, e))
+                loginf("local raw: waiting %d seconds before retry" %
+                       retry_wait)
+                time.sleep(retry_wait)
+        else:
+            raise Exception('local raw: prune failed after %d attemps' %
+                            max_tries)
+
+
+class RawWriterThread(threading.Thread):
+    """
+    Takes the raw table inserts and pruning off the engine thread. Packets
+    and prune requests are passed over a bounded queue to a RawWriter that
+    uses the thread's own database manager.
+
+    When the queue is full the overflow policy decides what happens,
+    'drop_oldest' throws away the oldest waiting packet to make room, 'block'
+    holds up the engine until there is room.
+    """
+
+    def __init__(self, config_dict, data_binding, buffer_size=1,
+                 buffer_interval=60, prune_options=None, queue_size=1000,
+                 overflow='drop_oldest', stats_interval=3600):
+        threading.Thread.__init__(self, name="RawWriterThread")
+        self.setDaemon(True)
+        self.config_dict = config_dict
+        self.data_binding = data_binding
+        self.buffer_size = buffer_size
+        self.buffer_interval = buffer_interval
+        self.prune_options = prune_options
+        if overflow not in ('drop_oldest', 'block'):
+            raise ValueError("mesowx raw: unknown writer_overflow '%s'" %
+                             overflow)
+        self.overflow = overflow
+        self.stats_interval = stats_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.writer = None
+        self.count_queued = 0
+        self.count_dropped = 0
+        self.count_pruned = 0
+        self.count_errors = 0
+        self.max_depth = 0
+        self.last_stats = time.time()
+
+    def put(self, item):
+        if self.overflow == 'block':
+            self.queue.put(item)
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.count_dropped += 1
+                    except queue.Empty:
+                        pass
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def add_packet(self, packet):
+        self.count_queued += 1
+        self.put(('packet', dict(packet)))
+
+    def prune(self, ts):
+        self.put(('prune', ts))
+
+    def stop(self):
+        self.put(None)
+        self.join(20.0)
+        if self.is_alive():
+            logerr("local raw: unable to shut down %s" % self.name)
+
+    def run(self):
+        dbm = weewx.manager.open_manager_with_config(self.config_dict,
+                                                     self.data_binding)
+        self.writer = RawWriter(dbm, self.buffer_size, self.buffer_interval,
+                                self.prune_options)
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.buffer_interval)
+                except queue.Empty:
+                    item = ('flush', None)
+                if item is None:
+                    self.process(('flush', None))
+                    break
+                self.process(item)
+                self.log_stats()
+        finally:
+            self.log_stats(force=True)
+            dbm.close()
+
+    def process(self, item):
+        kind, value = item
+        try:
+            if kind == 'packet':
+                self.writer.add(value)
+            elif kind == 'prune':
+                self.writer.prune(value, 2, 5)
+                self.count_pruned += 1
+            else:
+                self.writer.flush()
+        except Exception as e:
+            self.count_errors += 1
+            logerr("local raw: %s failed: %s" % (kind, e))
+
+    def log_stats(self, force=False):
+        now = time.time()
+        if force or now - self.last_stats >= self.stats_interval:
+            loginf("local raw: writer queued %d, written %d, dropped %d, "
+                   "prunes %d, errors %d, max queue depth %d" %
+                   (self.count_queued, self.writer.count_written,
+                    self.count_dropped,
+                    self.count_pruned, self.count_errors, self.max_depth))
+            self.max_depth = 0
+            self.last_stats = now
+
+
+NAN = float('nan')
+
+# the raw fields used by the pages
+RING_BUFFER_FIELDS = ['barometer', 'inTemp', 'outTemp', 'inHumidity',
+                      'outHumidity', 'windSpeed', 'windDir', 'windGust',
+                      'windGustDir', 'rainRate', 'rain', 'dayRain',
+                      'dewpoint', 'windchill', 'heatindex']
+
+
+class RawRingBuffer(object):
+    """
+    The last capacity loop packets, newest overwriting oldest, held as one
+    typed array per field (NaN for a missing value) rather than as dicts, for
+    the recent raw data to be looked up without going to the database.
+    """
+
+    def __init__(self, fields, capacity, window=None):
+        self.fields = list(fields)
+        self.index = dict((f, i) for i, f in enumerate(self.fields))
+        self.capacity = capacity
+        self.window = window
+        self.times = array.array('d', [0.0]) * capacity
+        self.columns = [array.array('d', [NAN]) * capacity
+                        for _ in self.fields]
+        # where the next packet goes, and how many are held
+        self.head = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, packet):
+        date_time = packet['dateTime']
+        with self.lock:
+            if self.count and date_time <= self.times[(self.head - 1) %
+                                                      self.capacity]:
+                return False
+            self.times[self.head] = date_time
+            for field, column in zip(self.fields, self.columns):
+                value = packet.get(field)
+                column[self.head] = NAN if value is None else value
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+        return True
+
+    def warm(self, rows):
+        """Fills the buffer from (dateTime, field, ...) rows in dateTime
+        order, as from the raw table"""
+        count = 0
+        for row in rows:
+            if self.append(dict(zip(['dateTime'] + self.fields, row))):
+                count += 1
+        return count
+
+    def _slot(self, i):
+        """The array position of the i-th oldest packet"""
+        return (self.head - self.count + i) % self.capacity
+
+    def _bisect(self, date_time):
+        """The number of packets before date_time"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[self._slot(middle)] < date_time:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _row(self, slot, columns):
+        row = [int(self.times[slot])]
+        for column in columns:
+            value = column[slot]
+            row.append(None if value != value else value)
+        return row
+
+    def _columns(self, fields):
+        if fields is None:
+            return self.columns
+        return [self.columns[self.index[f]] for f in fields]
+
+    def latest(self, fields=None):
+        """The newest packet as [dateTime, value, ...], or None"""
+        columns = self._columns(fields)
+        with self.lock:
+            if not self.count:
+                return None
+            return self._row((self.head - 1) % self.capacity, columns)
+
+    def range(self, start=None, end=None, fields=None):
+        """The packets from start to end inclusive, oldest first, as rows of
+        [dateTime, value, ...]"""
+        columns = self._columns(fields)
+        with self.lock:
+            if not self.count:
+                return []
+            newest = self.times[(self.head - 1) % self.capacity]
+            if self.window is not None:
+                start = max(start or 0, newest - self.window)
+            first = 0 if start is None else self._bisect(start)
+            last = self.count if end is None else self._bisect(end + 1)
+            return [self._row(self._slot(i), columns)
+                    for i in range(first, last)]
+
+
+class SnapshotPublisher(object):
+    """
+    Writes the newest loop packet (latest.json) and the packets of the last
+    hours (last24h.json) as files in the web server's directory, along with
+    gzipped copies, so the pages can fetch them as they are instead of
+    through data.php. Each file is written under a temporary name and then
+    renamed, so a request never gets half a file.
+    """
+
+    def __init__(self, directory, fields, hours=24, latest_interval=0):
+        self.directory = directory
+        self.fields = fields
+        self.hours = hours
+        # least seconds between writes of latest.json
+        self.latest_interval = latest_interval
+        self.last_latest = 0
+
+    def publish_latest(self, packet):
+        date_time = packet['dateTime']
+        if date_time - self.last_latest < self.latest_interval:
+            return
+        self.last_latest = date_time
+        record = dict((k, packet.get(k)) for k in self.fields)
+        self.write('latest.json', json.dumps(record, separators=(',', ':')))
+
+    def publish_recent(self, rows):
+        """rows of [dateTime, value, ...] with a value for each field after
+        dateTime, oldest first"""
+        # the same arrays as data.php answers with, one line per record
+        fields = ['dateTime'] + [f for f in self.fields if f != 'dateTime']
+        data = ',\n'.join(json.dumps(list(row), separators=(',', ':'))
+                          for row in rows)
+        self.write('last24h.json',
+                   '{"fields":%s,"data":[\n%s\n]}' % (json.dumps(fields), data))
+
+    def write(self, name, text):
+        data = text.encode('utf-8')
+        buf = io.BytesIO()
+        # no name or time in the header, so unchanged data gives the same file
+        with gzip.GzipFile(filename='', mode='wb', fileobj=buf,
+                           mtime=0) as compressed:
+            compressed.write(data)
+        path = os.path.join(self.directory, name)
+        self.replace(path, data)
+        self.replace(path + '.gz', buf.getvalue())
+
+    @staticmethod
+    def replace(path, data):
+        temp = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(data)
+        # atomic on POSIX
+        os.rename(temp, path)
+
+
+class LivePushServer(threading.Thread):
+    """
+    Pushes each loop packet to the browsers, over server-sent events or a
+    WebSocket, so the realtime chart and console don't have to poll data.php.
+    A packet is encoded once and kept in a short list of recent messages that
+    every client's connection thread works through, a client that falls too
+    far behind skips to the oldest one still kept.
+    """
+
+    WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    def __init__(self, host='', port=8081, fields=None, allow_origin='*',
+                 backlog=50, heartbeat=15, ring=None):
+        threading.Thread.__init__(self, name="LivePushServer")
+        self.setDaemon(True)
+        self.fields = fields
+        # a RawRingBuffer to answer /latest and /recent from
+        self.ring = ring
+        self.allow_origin = allow_origin
+        self.heartbeat = heartbeat
+        self.condition = threading.Condition()
+        # (sequence, server-sent event, WebSocket frame) of recent packets
+        self.messages = collections.deque(maxlen=backlog)
+        self.sequence = 0
+        self.clients = 0
+        self.count_published = 0
+        self.count_skipped = 0
+        self.stopping = False
+        self.httpd = ThreadingHTTPServer((host, port), LivePushHandler)
+        self.httpd.push_server = self
+
+    def publish(self, packet):
+        if self.fields is not None:
+            record = dict((k, packet.get(k)) for k in self.fields)
+        else:
+            record = dict(packet)
+        data = json.dumps(record, separators=(',', ':'))
+        event = ("id: %s\ndata: %s\n\n" % (record.get('dateTime'),
+                                           data)).encode('utf-8')
+        frame = self.websocket_frame(0x1, data.encode('utf-8'))
+        with self.condition:
+            self.sequence += 1
+            self.messages.append((self.sequence, event, frame))
+            self.count_published += 1
+            self.condition.notify_all()
+
+    def next_messages(self, after, timeout):
+        """The messages after sequence number after, waiting up to timeout
+        seconds for one"""
+        with self.condition:
+            if not self.stopping and \
+                    (not self.messages or self.messages[-1][0] <= after):
+                self.condition.wait(timeout)
+            if self.stopping:
+                return None
+            waiting = [m for m in self.messages if m[0] > after]
+            if waiting and after and waiting[0][0] > after + 1:
+                self.count_skipped += waiting[0][0] - after - 1
+            return waiting
+
+    def latest(self):
+        """The sequence number before the newest message, so a new client
+        starts with it"""
+        with self.condition:
+            return self.messages[-1][0] - 1 if self.messages else 0
+
+    @staticmethod
+    def websocket_frame(opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        return header + payload
+
+    @staticmethod
+    def websocket_accept(key):
+        digest = hashlib.sha1((key + LivePushServer.WEBSOCKET_GUID).encode(
+                              'ascii')).digest()
+        return base64.b64encode(digest).decode('ascii')
+
+    def run(self):
+        loginf("live push: listening on %s:%d" % self.httpd.server_address)
+        self.httpd.serve_forever()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        loginf("live push: published %d packets, %d skipped by slow clients"
+               % (self.count_published, self.count_skipped))
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class LivePushHandler(BaseHTTPRequestHandler):
+    """A client of the LivePushServer, a WebSocket if it asks to be upgraded,
+    otherwise a server-sent event stream"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logdbg("live push: %s %s" % (self.address_string(), format % args))
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        name = path.rstrip('/').rsplit('/', 1)[-1]
+        if name in ('latest', 'recent') and \
+                self.server.push_server.ring is not None:
+            self.serve_ring(name, dict(parse_qsl(query)))
+        elif self.headers.get('Upgrade', '').lower() == 'websocket':
+            self.serve_websocket()
+        else:
+            self.serve_events()
+
+    def serve_ring(self, name, params):
+        """/latest, or /recent?start=&end= (dateTime, inclusive), either with
+        fields=a,b for some of the fields, as a list of [dateTime, value, ...]
+        rows"""
+        ring = self.server.push_server.ring
+        fields = params.get('fields')
+        try:
+            fields = fields.split(',') if fields else ring.fields
+            if name == 'latest':
+                rows = [ring.latest(fields)]
+            else:
+                start = params.get('start')
+                end = params.get('end')
+                rows = ring.range(int(start) if start else None,
+                                  int(end) if end else None, fields)
+        except (KeyError, ValueError) as e:
+            self.send_error(400, "Bad request: %s" % e)
+            return
+        body = json.dumps({'fields': ['dateTime'] + list(fields),
+                           'rows': [r for r in rows if r is not None]},
+                          separators=(',', ':')).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin',
+                         self.server.push_server.allow_origin)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin',
+                         self.server.push_server.allow_origin)
+        self.end_headers()
+        self.stream(lambda m: m[1], b": keep-alive\n\n")
+
+    def serve_websocket(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if not key:
+            self.send_error(400, "Missing Sec-WebSocket-Key")
+            return
+        self.send_response(101, "Switching Protocols")
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept',
+                         LivePushServer.websocket_accept(key))
+        self.end_headers()
+        self.stream(lambda m: m[2], LivePushServer.websocket_frame(0x9, b''),
+                    websocket=True)
+
+    def stream(self, encoded, heartbeat, websocket=False):
+        server = self.server.push_server
+        with server.condition:
+            server.clients += 1
+        loginf("live push: %s connected, %d clients" %
+               (self.address_string(), server.clients))
+        after = server.latest()
+        last_sent = time.time()
+        try:
+            while True:
+                messages = server.next_messages(after, server.heartbeat)
+                if messages is None:
+                    break
+                if websocket and not self.read_websocket():
+                    break
+                for message in messages:
+                    self.wfile.write(encoded(message))
+                    after = message[0]
+                if not messages and time.time() - last_sent >= \
+                        server.heartbeat:
+                    self.wfile.write(heartbeat)
+                elif not messages:
+                    continue
+                self.wfile.flush()
+                last_sent = time.time()
+        except (IOError, OSError) as e:
+            logdbg("live push: %s went away: %s" % (self.address_string(), e))
+        finally:
+            with server.condition:
+                server.clients -= 1
+            self.close_connection = True
+
+    def read_websocket(self):
+        """Answers whatever the browser has sent, returns False once it has
+        closed the WebSocket"""
+        while select.select([self.connection], [], [], 0)[0]:
+            header = self.rfile.read(2)
+            if len(header) < 2:
+                return False
+            opcode = ord(header[0:1]) & 0x0f
+            length = ord(header[1:2]) & 0x7f
+            if length == 126:
+                length = struct.unpack('!H', self.rfile.read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self.rfile.read(8))[0]
+            # frames from a browser are always masked
+            mask = self.rfile.read(4)
+            payload = bytearray(self.rfile.read(length))
+            for i in range(length):
+                payload[i] ^= ord(mask[i % 4:i % 4 + 1])
+            if opcode == 0x8:
+                self.wfile.write(LivePushServer.websocket_frame(0x8, b''))
+                return False
+            if opcode == 0x9:
+                self.wfile.write(LivePushServer.websocket_frame(
+                                 0xA, bytes(payload)))
+        return True
+
+
+class RawService(StdService):
+
+    def __init__(self, engine, config_dict):
         super(RawService, self).__init__(engine, config_dict)
         loginf("local raw: service version is %s" % VERSION)
 
@@ -984,6 +2732,11 @@ class RawService(StdService):
         d = self.config_dict['Mesowx']['Raw']
         self.dataLimit = int(d.get('data_limit', 24))
         self.skip_loop = int(d.get('skip_loop', 2))
+        # number of loop packets to gather before writing them in one go, 1
+        # writes each packet as it arrives (default: 1)
+        self.buffer_size = int(d.get('loop_buffer_size', 1))
+        # max seconds a loop packet is held in the buffer (default: 60)
+        self.buffer_interval = int(d.get('loop_buffer_interval', 60))
 
         # get the database parameters we need to function
         # self.binding = self.config_dict['DataBindings'].get('mesowx_binding')
@@ -1005,28 +2758,140 @@ class RawService(StdService):
             raise Exception('mesowx raw: schema mismatch: %s != %s' %
                             (dbcol, memcol))
 
+        # how old data is pruned, either 'chunked' deletes of up to
+        # prune_chunk_seconds of data at a time, stopping after
+        # prune_time_budget seconds, or 'partition' to drop whole
+        # partition_seconds wide partitions (MySQL only)
+        prune_options = dict((k, d[k]) for k in (
+                             'prune_strategy', 'prune_chunk_seconds',
+                             'prune_time_budget', 'partition_seconds')
+                             if k in d)
+        # inserts and pruning can be done by a separate thread, with its own
+        # database connection, so a slow database doesn't hold up the engine
+        # (default: false)
+        if weeutil.weeutil.to_bool(d.get('writer_thread', False)):
+            self.writer = None
+            self.writer_thread = RawWriterThread(
+                self.config_dict, self.data_binding, self.buffer_size,
+                self.buffer_interval, prune_options,
+                queue_size=int(d.get('writer_queue_size', 1000)),
+                overflow=d.get('writer_overflow', 'drop_oldest'),
+                stats_interval=int(d.get('writer_stats_interval', 3600)))
+            self.writer_thread.start()
+            loginf("local raw: writing from %s" % self.writer_thread.name)
+        else:
+            self.writer = RawWriter(self.dbm, self.buffer_size,
+                                    self.buffer_interval, prune_options)
+            self.writer_thread = None
+        # thin out the packets stored with the [[LoopFilter]] (default: false)
+        if weeutil.weeutil.to_bool(d.get('loop_filter', False)):
+            self.loop_filter = LoopFilter.from_config(config_dict, "local raw")
+        else:
+            self.loop_filter = None
+        # keep the last data_limit hours of loop packets in memory as well,
+        # for the fields in ring_buffer_fields (default: false)
+        if weeutil.weeutil.to_bool(d.get('ring_buffer', False)):
+            fields = weeutil.weeutil.option_as_list(d.get(
+                'ring_buffer_fields', [f for f in RING_BUFFER_FIELDS
+                                       if f in memcol]))
+            window = self.dataLimit * 3600
+            self.ring = RawRingBuffer(fields, int(d.get(
+                'ring_buffer_size', window // (self.skip_loop + 1) + 1)),
+                window)
+            self.warm_ring()
+        else:
+            self.ring = None
+        # port to push loop packets to the browsers from, as server-sent
+        # events or over a WebSocket, 0 for none (default: 0)
+        push_port = int(d.get('push_port', 0))
+        self.push_server = None
+        if push_port:
+            try:
+                self.push_server = LivePushServer(
+                    d.get('push_host', ''), push_port,
+                    fields=weeutil.weeutil.option_as_list(
+                        d.get('push_fields', memcol)),
+                    allow_origin=d.get('push_allow_origin', '*'),
+                    backlog=int(d.get('push_backlog', 50)),
+                    heartbeat=int(d.get('push_heartbeat', 15)),
+                    ring=self.ring)
+            except (IOError, OSError) as e:
+                # i.e. the port is in use, weewx carries on without live push
+                logerr("local raw: unable to push loop packets on port "
+                       "%s: %s" % (push_port, e))
+            else:
+                self.push_server.start()
+        # write latest.json and last24h.json, and gzipped copies, for the web
+        # server to serve as they are (default: false)
+        if weeutil.weeutil.to_bool(d.get('snapshot', False)):
+            self.snapshot = SnapshotPublisher(
+                self.snapshot_dir(d),
+                weeutil.weeutil.option_as_list(d.get(
+                    'snapshot_fields', ['dateTime'] + [
+                        f for f in RING_BUFFER_FIELDS if f in memcol])),
+                # hours of packets in last24h.json (default: 24)
+                hours=float(d.get('snapshot_hours', 24)),
+                # least seconds between writes of latest.json (default: 0,
+                # every packet stored)
+                latest_interval=int(d.get('snapshot_interval', 0)))
+            self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+        else:
+            self.snapshot = None
         self.lastLoopDateTime = 0
         self.lastPrunedDateTime = 0
         self.bind(weewx.NEW_LOOP_PACKET, self.newLoopPacket)
 
-    def prune_rawdata(self, dbm, ts, max_tries=3, retry_wait=10):
-        """remove rawdata older than data_limit hours from the database"""
-        sql = "delete from %s where dateTime < %d" % (dbm.table_name, ts)
-        for count in range(max_tries):
-            try:
-                dbm.getSql(sql)
-                loginf('local raw: deleted rawdata prior to %s' %
-                       weeutil.weeutil.timestamp_to_string(ts))
-                break
-            except Exception as e:
-                logerr("local raw: prune failed (attempt %d of %d): %s" %
-                       ((count + 1), max_tries, e))
-                loginf("local raw: waiting %d seconds before retry" %
-                       retry_wait)
-                time.sleep(retry_wait)
+    def snapshot_dir(self, d):
+        """snapshot_dir, by default the HTML_ROOT of the Mesowx report"""
+        reports = self.config_dict.get('StdReport', {})
+        html_root = reports.get('Mesowx', {}).get(
+                    'HTML_ROOT', reports.get('HTML_ROOT', 'public_html'))
+        return os.path.join(self.config_dict.get('WEEWX_ROOT', ''),
+                            d.get('snapshot_dir', html_root))
+
+    def new_archive_record(self, event):
+        """Rewrites last24h.json, from the ring buffer if there is one"""
+        fields = [f for f in self.snapshot.fields if f != 'dateTime']
+        end = event.record['dateTime']
+        start = end - int(self.snapshot.hours * 3600)
+        try:
+            if self.ring is not None and set(fields) <= set(self.ring.fields):
+                rows = self.ring.range(start, end, fields)
+            else:
+                sql = "SELECT dateTime, %s FROM %s WHERE dateTime > ? " \
+                      "ORDER BY dateTime" % (', '.join(fields),
+                                             self.dbm.table_name)
+                rows = self.dbm.genSql(sql, (start,))
+            self.snapshot.publish_recent(rows)
+        except (weedb.DatabaseError, IOError, OSError) as e:
+            logerr("local raw: unable to write last24h.json: %s" % e)
+
+    def warm_ring(self):
+        """Fills the ring buffer from the raw table"""
+        started = time.time()
+        since = int(started) - self.ring.window
+        sql = "SELECT dateTime, %s FROM %s WHERE dateTime >= ? " \
+              "ORDER BY dateTime" % (', '.join(self.ring.fields),
+                                     self.dbm.table_name)
+        try:
+            count = self.ring.warm(self.dbm.genSql(sql, (since,)))
+        except weedb.DatabaseError as e:
+            logerr("local raw: unable to fill the ring buffer: %s" % e)
+            return
+        loginf("local raw: ring buffer of %d holds %d records, filled in "
+               "%.2fs" % (self.ring.capacity, count, time.time() - started))
+
+    def shutDown(self):
+        if self.push_server is not None:
+            self.push_server.stop()
+        if self.loop_filter is not None:
+            for packet in self.loop_filter.flush():
+                self.store(packet)
+            self.loop_filter.log_stats(force=True)
+        if self.writer_thread is not None:
+            self.writer_thread.stop()
         else:
-            raise Exception('local raw: prune failed after %d attemps' %
-                            max_tries)
+            self.writer.flush()
 
     def newLoopPacket(self, event):
         packet = event.packet
@@ -1042,15 +2907,38 @@ class RawService(StdService):
         # loginf('if dateTime (%s) > lastloopDateTime + 42 (%s)' % (dateTime,
         #        (self.lastLoopDateTime +42)))
         if dateTime > (self.lastLoopDateTime + self.skip_loop):
-            self.dbm.addRecord(packet)
+            if self.loop_filter is not None:
+                for stored in self.loop_filter.add(packet):
+                    self.store(stored)
+            else:
+                self.store(packet)
+            # the browsers get every packet
+            if self.push_server is not None:
+                self.push_server.publish(packet)
+            if self.snapshot is not None:
+                try:
+                    self.snapshot.publish_latest(packet)
+                except (IOError, OSError) as e:
+                    logerr("local raw: unable to write latest.json: %s" % e)
             self.lastLoopDateTime = dateTime
         if dateTime > (self.lastPrunedDateTime + prune_period):
             if self.dataLimit is not None:
                 ts = ((dateTime - (self.dataLimit * 3600)) /
                       prune_period) * prune_period  # preset on 5-min boundary
-                self.prune_rawdata(self.dbm, ts, 2, 5)
+                if self.writer_thread is not None:
+                    self.writer_thread.prune(ts)
+                else:
+                    self.writer.prune(ts, 2, 5)
             self.lastPrunedDateTime = dateTime
 
+    def store(self, packet):
+        if self.writer_thread is not None:
+            self.writer_thread.add_packet(packet)
+        else:
+            self.writer.add(packet)
+        if self.ring is not None:
+            self.ring.append(packet)
+
 # LOOP packet data example #
 #   {
 #      'monthET' : 0.0,
@@ -1133,42 +3021,496 @@ class RawService(StdService):
 #   }
 
 
+class CatchUpThread(threading.Thread):
+    """
+    Takes the catching up of a service's table with the archive off the
+    engine thread. Each archive record wakes the thread, which then calls the
+    service's catch_up() with its own database manager, catch_up_rows records
+    at a time, until it has read everything there is.
+    """
+
+    def __init__(self, service, config_dict, data_binding, log_prefix):
+        threading.Thread.__init__(self, name="%sCatchUpThread" %
+                                  service.__class__.__name__)
+        self.setDaemon(True)
+        self.service = service
+        self.config_dict = config_dict
+        self.data_binding = data_binding
+        self.log_prefix = log_prefix
+        self.wake_event = threading.Event()
+        self.exit_event = threading.Event()
+
+    def wake(self):
+        self.wake_event.set()
+
+    def stop(self):
+        self.exit_event.set()
+        self.wake_event.set()
+        self.join(20.0)
+        if self.is_alive():
+            logerr("%s: unable to shut down %s" % (self.log_prefix,
+                                                   self.name))
+
+    def run(self):
+        dbm = weewx.manager.open_manager_with_config(self.config_dict,
+                                                     self.data_binding)
+        try:
+            while True:
+                self.wake_event.wait()
+                self.wake_event.clear()
+                if self.exit_event.is_set():
+                    break
+                self.catch_up(dbm)
+        finally:
+            dbm.close()
+
+    def catch_up(self, dbm):
+        while not self.exit_event.is_set():
+            try:
+                count = self.service.catch_up(dbm)
+            except weedb.DatabaseError as e:
+                logerr("%s: update failed: %s" % (self.log_prefix, e))
+                return
+            if count < self.service.catch_up_rows:
+                return
+            loginf("%s: catching up, %d archive records read" %
+                   (self.log_prefix, count))
+
+
+class ExtremesService(StdService):
+    """Keeps the lowest and highest value, and when it happened, of each
+    field for every day, month and year, and of all time, in a table next to
+    the archive. stats.php can then look them up instead of reading every
+    archive record in the range.
+
+    Each archive record has a CatchUpThread bring the table up to date from
+    where it last got to, catch_up_rows records at a time, so an existing
+    archive is worked through in the background rather than holding up the
+    engine. Merging a record in twice changes nothing, so there's no harm in
+    starting over.
+    """
+
+    # the period codes, 'a' is all of time and doubles as the record of how
+    # far through the archive the table has got
+    PERIODS = ('d', 'm', 'y', 'a')
+
+    def __init__(self, engine, config_dict):
+        super(ExtremesService, self).__init__(engine, config_dict)
+        d = config_dict['Mesowx'].get('Extremes', {})
+        # the binding of the archive to keep the extremes of, the table goes
+        # in the same database (default: wx_binding)
+        self.data_binding = d.get('data_binding', 'wx_binding')
+        # (default: mesowx_extremes)
+        self.table_name = d.get('table_name', 'mesowx_extremes')
+        # the most archive records to read in one transaction while catching
+        # up (default: 10000)
+        self.catch_up_rows = int(d.get('catch_up_rows', 10000))
+        self.dbm = self.engine.db_binder.get_manager(
+                   data_binding=self.data_binding, initialize=True)
+        fields = weeutil.weeutil.option_as_list(d.get('fields', [
+            'outTemp', 'inTemp', 'outHumidity', 'inHumidity', 'barometer',
+            'windSpeed', 'windGust', 'rainRate', 'dewpoint', 'windchill',
+            'heatindex']))
+        self.fields = [f for f in fields if f in self.dbm.sqlkeys]
+        if len(self.fields) < len(fields):
+            loginf("extremes: no archive column for %s" %
+                   ", ".join(f for f in fields if f not in self.fields))
+        self.create_table()
+        loginf("extremes: keeping %s in %s" %
+               (", ".join(self.fields), self.table_name))
+        self.catch_up_thread = CatchUpThread(self, config_dict,
+                                             self.data_binding, "extremes")
+        self.catch_up_thread.start()
+        self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+
+    def create_table(self):
+        self.dbm.connection.execute(
+            "CREATE TABLE IF NOT EXISTS %s ("
+            "period CHAR(1) NOT NULL, periodStart INTEGER NOT NULL, "
+            "periodEnd INTEGER NOT NULL, field VARCHAR(40) NOT NULL, "
+            "min REAL, minTime INTEGER, max REAL, maxTime INTEGER, "
+            "PRIMARY KEY (period, periodStart, field))" % self.table_name)
+
+    def new_archive_record(self, event):
+        self.catch_up_thread.wake()
+
+    def shutDown(self):
+        self.catch_up_thread.stop()
+
+    def watermark(self, dbm):
+        """The dateTime to carry on from, None to start at the beginning"""
+        done = dict(dbm.genSql(
+                    "SELECT field, periodEnd FROM %s WHERE period = 'a'" %
+                    self.table_name))
+        if any(f not in done for f in self.fields):
+            # a field is new, go over everything again for it
+            return None
+        return min(done[f] for f in self.fields)
+
+    def catch_up(self, dbm):
+        """Merge the next catch_up_rows archive records into the table,
+        returns the number read"""
+        since = self.watermark(dbm)
+        sql = "SELECT dateTime, %s FROM %s" % (", ".join(self.fields),
+                                               dbm.table_name)
+        if since is None:
+            args = ()
+        else:
+            sql += " WHERE dateTime >= ?"
+            args = (since,)
+        sql += " ORDER BY dateTime ASC LIMIT %d" % self.catch_up_rows
+        extremes = {}
+        spans = {}
+        count = 0
+        for row in dbm.genSql(sql, args):
+            count += 1
+            ts = row[0]
+            for period in self.PERIODS:
+                span = spans.get(period)
+                if span is None or not span[0] <= ts < span[1]:
+                    span = spans[period] = self.period_span(period, ts)
+                for field, value in zip(self.fields, row[1:]):
+                    key = (period, span[0], field)
+                    if key not in extremes:
+                        extremes[key] = [span[1], None, None, None, None]
+                    self.merge(extremes[key], value, ts, value, ts)
+            # the end of the all time row is where to carry on from
+            for field in self.fields:
+                extremes[('a', 0, field)][0] = ts + 1
+        if extremes:
+            self.store(dbm, extremes)
+        return count
+
+    @staticmethod
+    def period_span(period, ts):
+        """The [start, end) of the period containing ts, in local time"""
+        if period == 'd':
+            span = weeutil.weeutil.archiveDaySpan(ts, grace=0)
+        elif period == 'm':
+            span = weeutil.weeutil.archiveMonthSpan(ts, grace=0)
+        elif period == 'y':
+            span = weeutil.weeutil.archiveYearSpan(ts, grace=0)
+        else:
+            return (0, ts + 1)
+        return (span.start, span.stop)
+
+    @staticmethod
+    def merge(extreme, low, low_time, high, high_time):
+        """Fold a low and a high into [periodEnd, min, minTime, max,
+        maxTime], the earliest wins a tie"""
+        if low is not None and (extreme[1] is None or low < extreme[1]):
+            extreme[1], extreme[2] = low, low_time
+        if high is not None and (extreme[3] is None or high > extreme[3]):
+            extreme[3], extreme[4] = high, high_time
+
+    def store(self, dbm, extremes):
+        with weedb.Transaction(dbm.connection) as cursor:
+            for (period, start, field), extreme in extremes.items():
+                cursor.execute("SELECT periodEnd, min, minTime, max, maxTime "
+                               "FROM %s WHERE period = ? AND periodStart = ? "
+                               "AND field = ?" % self.table_name,
+                               (period, start, field))
+                row = cursor.fetchone()
+                if row is None:
+                    cursor.execute("INSERT INTO %s (period, periodStart, "
+                                   "periodEnd, field, min, minTime, max, "
+                                   "maxTime) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                                   % self.table_name,
+                                   (period, start, extreme[0], field,
+                                    extreme[1], extreme[2], extreme[3],
+                                    extreme[4]))
+                    continue
+                stored = list(row)
+                if period == 'a':
+                    stored[0] = max(stored[0], extreme[0])
+                self.merge(stored, extreme[1], extreme[2], extreme[3],
+                           extreme[4])
+                if stored != list(row):
+                    cursor.execute("UPDATE %s SET periodEnd = ?, min = ?, "
+                                   "minTime = ?, max = ?, maxTime = ? "
+                                   "WHERE period = ? AND periodStart = ? "
+                                   "AND field = ?" % self.table_name,
+                                   tuple(stored) + (period, start, field))
+
+
+class RollupService(StdService):
+    """Keeps the min, max, sum and count of each field for every 5 minutes,
+    hour and (local) day in rollup tables next to the archive, so data.php
+    can answer a grouped query from a few hundred summary rows rather than
+    grouping every archive record in the range.
+
+    Like ExtremesService it catches up from where it got to on each archive
+    record, on a CatchUpThread. Sums and counts can't be added in twice, so the last dateTime
+    merged is kept in the <table_prefix>_state table and moved on in the
+    same transaction as the rollups.
+    """
+
+    # table suffix and bucket size in seconds, None for local days
+    RESOLUTIONS = (('300', 300), ('3600', 3600), ('day', None))
+
+    def __init__(self, engine, config_dict):
+        super(RollupService, self).__init__(engine, config_dict)
+        d = config_dict['Mesowx'].get('Rollup', {})
+        # the binding of the archive to roll up, the tables go in the same
+        # database (default: wx_binding)
+        self.data_binding = d.get('data_binding', 'wx_binding')
+        # the tables are <table_prefix>_300, _3600, _day and _state
+        # (default: mesowx_rollup)
+        self.table_prefix = d.get('table_prefix', 'mesowx_rollup')
+        # the most archive records to read in one transaction while catching
+        # up (default: 10000)
+        self.catch_up_rows = int(d.get('catch_up_rows', 10000))
+        self.dbm = self.engine.db_binder.get_manager(
+                   data_binding=self.data_binding, initialize=True)
+        fields = weeutil.weeutil.option_as_list(d.get('fields', [
+            'barometer', 'inTemp', 'outTemp', 'inHumidity', 'outHumidity',
+            'windSpeed', 'windDir', 'windGust', 'windGustDir', 'rainRate',
+            'rain', 'dewpoint', 'windchill', 'heatindex']))
+        self.fields = [f for f in fields if f in self.dbm.sqlkeys]
+        if len(self.fields) < len(fields):
+            loginf("rollup: no archive column for %s" %
+                   ", ".join(f for f in fields if f not in self.fields))
+        self.columns = ['dateTime']
+        for field in self.fields:
+            self.columns.extend(['%s_min' % field, '%s_max' % field,
+                                 '%s_sum' % field, '%s_count' % field])
+        self.create_tables()
+        loginf("rollup: keeping %s in %s tables" %
+               (", ".join(self.fields), self.table_prefix))
+        self.catch_up_thread = CatchUpThread(self, config_dict,
+                                             self.data_binding, "rollup")
+        self.catch_up_thread.start()
+        self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+
+    def create_tables(self):
+        columns = ["dateTime INTEGER NOT NULL PRIMARY KEY"]
+        for field in self.fields:
+            columns.extend(["%s_min REAL" % field, "%s_max REAL" % field,
+                            "%s_sum REAL" % field, "%s_count INTEGER" % field])
+        for suffix, seconds in self.RESOLUTIONS:
+            table = "%s_%s" % (self.table_prefix, suffix)
+            self.dbm.connection.execute("CREATE TABLE IF NOT EXISTS %s (%s)" %
+                                        (table, ", ".join(columns)))
+            dbcol = self.dbm.connection.columnsOf(table)
+            if dbcol != self.columns:
+                raise Exception("mesowx rollup: columns of %s don't match the "
+                                "fields, drop the %s tables to rebuild them" %
+                                (table, self.table_prefix))
+        self.dbm.connection.execute("CREATE TABLE IF NOT EXISTS %s_state ("
+                                    "name VARCHAR(40) NOT NULL PRIMARY KEY, "
+                                    "value INTEGER)" % self.table_prefix)
+
+    def new_archive_record(self, event):
+        self.catch_up_thread.wake()
+
+    def shutDown(self):
+        self.catch_up_thread.stop()
+
+    def watermark(self, dbm):
+        """One past the last dateTime rolled up, None if nothing has been"""
+        row = dbm.getSql("SELECT value FROM %s_state WHERE name = "
+                              "'watermark'" % self.table_prefix)
+        return row[0] if row else None
+
+    def catch_up(self, dbm):
+        """Roll up the next catch_up_rows archive records, returns the
+        number read"""
+        since = self.watermark(dbm)
+        sql = "SELECT dateTime, %s FROM %s" % (", ".join(self.fields),
+                                               dbm.table_name)
+        if since is None:
+            args = ()
+        else:
+            sql += " WHERE dateTime >= ?"
+            args = (since,)
+        sql += " ORDER BY dateTime ASC LIMIT %d" % self.catch_up_rows
+        rollups = dict((suffix, {}) for suffix, seconds in self.RESOLUTIONS)
+        day = None
+        count = 0
+        last = None
+        for row in dbm.genSql(sql, args):
+            count += 1
+            last = ts = row[0]
+            if day is None or not day.start <= ts < day.stop:
+                day = weeutil.weeutil.archiveDaySpan(ts, grace=0)
+            for suffix, seconds in self.RESOLUTIONS:
+                bucket = day.start if seconds is None else \
+                    ts // seconds * seconds
+                rollup = rollups[suffix].get(bucket)
+                if rollup is None:
+                    rollup = rollups[suffix][bucket] = \
+                        [None, None, 0.0, 0] * len(self.fields)
+                for i, value in enumerate(row[1:]):
+                    if value is not None:
+                        self.merge(rollup, i * 4, value, value, value, 1)
+        if last is not None:
+            self.store(dbm, rollups, last + 1)
+        return count
+
+    @staticmethod
+    def merge(rollup, i, low, high, total, count):
+        """Fold min, max, sum and count into rollup[i:i + 4]"""
+        if low is not None and (rollup[i] is None or low < rollup[i]):
+            rollup[i] = low
+        if high is not None and (rollup[i + 1] is None or
+                                 high > rollup[i + 1]):
+            rollup[i + 1] = high
+        rollup[i + 2] = (rollup[i + 2] or 0.0) + (total or 0.0)
+        rollup[i + 3] = (rollup[i + 3] or 0) + (count or 0)
+
+    def store(self, dbm, rollups, watermark):
+        with weedb.Transaction(dbm.connection) as cursor:
+            for suffix, buckets in rollups.items():
+                table = "%s_%s" % (self.table_prefix, suffix)
+                for bucket, rollup in buckets.items():
+                    cursor.execute("SELECT %s FROM %s WHERE dateTime = ?" %
+                                   (", ".join(self.columns[1:]), table),
+                                   (bucket,))
+                    row = cursor.fetchone()
+                    if row is None:
+                        cursor.execute("INSERT INTO %s (%s) VALUES (%s)" %
+                                       (table, ", ".join(self.columns),
+                                        ", ".join("?" * len(self.columns))),
+                                       [bucket] + rollup)
+                        continue
+                    stored = list(row)
+                    for i in range(0, len(rollup), 4):
+                        self.merge(stored, i, *rollup[i:i + 4])
+                    cursor.execute("UPDATE %s SET %s WHERE dateTime = ?" %
+                                   (table, ", ".join("%s = ?" % c for c in
+                                                     self.columns[1:])),
+                                   stored + [bucket])
+            cursor.execute("DELETE FROM %s_state WHERE name = 'watermark'" %
+                           self.table_prefix)
+            cursor.execute("INSERT INTO %s_state (name, value) VALUES "
+                           "('watermark', ?)" % self.table_prefix,
+                           (watermark,))
+
+
 # start of original retain.py script
 
+# an empty slot, as None is a value that can be retained
+MISSING = object()
+
+
 class RetainLoopValues(StdService):
     """Service retains previous loop packet values updating any value that
     isn't None from new packets. It then replaces the original packet with a
     new packet that contains all of the values; the original unmodified packet
-    will be stored on the event in a property named 'originalPacket'."""
+    will be stored on the event in a property named 'originalPacket'.
+
+    The retained values are kept in a list, one slot per field, laid out by
+    the schema with any other fields added to the end. With packet_view the
+    new packet is a RetainedPacket over that list, rather than a copy of it
+    as a dict, the list being replaced rather than changed once a packet has
+    been made from it."""
 
     def __init__(self, engine, config_dict):
         super(RetainLoopValues, self).__init__(engine, config_dict)
         self.bind(weewx.NEW_LOOP_PACKET, self.newLoopPacket)
-        self.retainedLoopValues = {}
+        # field name -> slot, replaced rather than changed when a field is
+        # added as the packets already made still use it
+        self.slots = dict((name, i) for i, (name, _) in enumerate(schema))
+        self.values = [MISSING] * len(self.slots)
         self.excludeFields = set([])
-        if 'RetainLoopValues' in config_dict:
-            if 'exclude_fields' in config_dict['Mesowx']['RetainLoopValues']:
-                self.excludeFields = set(weeutil.weeutil.option_as_list
-                                         (config_dict['Mesowx']
-                                          ['RetainLoopValues'].get
-                                          ('exclude_fields', [])))
-                loginf("mesowx RetainLoopValues: excluding fields: %s" %
-                       (self.excludeFields,))
+        d = config_dict.get('Mesowx', {}).get('RetainLoopValues', {})
+        if 'exclude_fields' in d:
+            self.excludeFields = set(weeutil.weeutil.option_as_list(
+                                     d.get('exclude_fields', [])))
+            loginf("mesowx RetainLoopValues: excluding fields: %s" %
+                   (self.excludeFields,))
+        # pass a RetainedPacket on rather than a dict, only if none of the
+        # services after this one needs a real dict (i.e. to json encode or
+        # pickle the packet) (default: false)
+        self.packet_view = weeutil.weeutil.to_bool(d.get('packet_view',
+                                                         False))
 
     def newLoopPacket(self, event):
-        event.originalPacket = event.packet
+        packet = event.packet
+        event.originalPacket = packet
+        slots = self.slots
+        values = list(self.values)
         # replace the values in the retained packet if they have a value other
         # than None or the field is listed in excludeFields
-        self.retainedLoopValues.update(dict((k, v) for k, v in
-                                            event.packet.iteritems() if
-                                            (v is not None or k in
-                                             self.excludeFields)))
+        for k, v in packet.items():
+            if v is None and k not in self.excludeFields:
+                continue
+            slot = slots.get(k)
+            if slot is None:
+                slots = dict(slots)
+                slot = slots[k] = len(values)
+                values.append(MISSING)
+            values[slot] = v
         # if the new packet doesn't contain one of the excludeFields then
-        # remove it from the retainedLoopValues
-        for k in self.excludeFields - set(event.packet.keys()):
-            if k in self.retainedLoopValues:
-                self.retainedLoopValues.pop(k)
-        event.packet = self.retainedLoopValues.copy()
+        # remove it from the retained values
+        for k in self.excludeFields:
+            if k not in packet and k in slots:
+                values[slots[k]] = MISSING
+        self.slots = slots
+        self.values = values
+        if self.packet_view:
+            event.packet = RetainedPacket(slots, values)
+        else:
+            event.packet = {k: values[i] for k, i in slots.items()
+                            if values[i] is not MISSING}
+
+
+class RetainedPacket(MutableMapping):
+    """A loop packet that reads the slots of RetainLoopValues. Writing to it
+    copies it to a dict of its own first, so the slots are never changed."""
+
+    __slots__ = ('_slots', '_values', '_own')
+
+    def __init__(self, slots, values):
+        self._slots = slots
+        self._values = values
+        self._own = None
+
+    def __getitem__(self, key):
+        if self._own is not None:
+            return self._own[key]
+        value = self._values[self._slots[key]]
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        if self._own is not None:
+            return key in self._own
+        slot = self._slots.get(key)
+        return slot is not None and self._values[slot] is not MISSING
+
+    def __iter__(self):
+        if self._own is not None:
+            return iter(self._own)
+        values = self._values
+        return (k for k, i in self._slots.items() if values[i] is not MISSING)
+
+    def __len__(self):
+        if self._own is not None:
+            return len(self._own)
+        return len(self._values) - self._values.count(MISSING)
+
+    def __setitem__(self, key, value):
+        self.own()[key] = value
+
+    def __delitem__(self, key):
+        del self.own()[key]
+
+    def own(self):
+        if self._own is None:
+            self._own = self.copy()
+        return self._own
+
+    def copy(self):
+        if self._own is not None:
+            return dict(self._own)
+        values = self._values
+        return {k: values[i] for k, i in self._slots.items()
+                if values[i] is not MISSING}
+
+    def __repr__(self):
+        return repr(self.copy())
 
 
 class Mesowx(SearchList):
@@ -1457,8 +3799,23 @@ class Mesowx(SearchList):
         # Davis weather station specific value.
         self.davis_dayrain = weeutil.weeutil.to_bool(self.generator.skin_dict[
                              'Extras'].get('davis_dayrain', 'false'))
+        # archive chart data in cacheable tiles of data.php
+        self.archive_tiles = weeutil.weeutil.to_bool(self.generator.skin_dict[
+                             'Extras'].get('archive_tiles', 'false'))
+        # chart data from data.php in the binary columnar form
+        self.binary_data = weeutil.weeutil.to_bool(self.generator.skin_dict[
+                             'Extras'].get('binary_data', 'false'))
         # loginf("davis_dayrain is %s" % self.davis_dayrain)
 
+        # loop packets pushed by RawService instead of polling data.php, the
+        # URL defaults to this host at push_port
+        raw_dict = self.generator.config_dict['Mesowx'].get('Raw', {})
+        self.push_port = int(raw_dict.get('push_port', 0))
+        self.push_url = raw_dict.get('push_url', '')
+        # or fetched from the latest.json written by RawService
+        self.snapshot = weeutil.weeutil.to_bool(raw_dict.get('snapshot',
+                                                             False))
+
         # language keys for chart labels
         # set up with english defaults
         self.chart_atemp = 'Temperature'
@@ -1619,3 +3976,74 @@ class Mesowx(SearchList):
                 self.raw_sec_key,
                 ))
         """
+
+
+def prune_remote(config_path, entity_ids=None):
+    """Ask the remote server to apply the retention policy of each entity,
+    for entities with the "schedule" trigger. Returns the number that
+    failed."""
+    import configobj
+    config_dict = configobj.ConfigObj(config_path, file_error=True)
+    sync_config = config_dict['Mesowx']['RemoteSync']
+    # either entity can be left out, as for SyncService
+    keys = {}
+    for kind in ('raw', 'archive'):
+        if sync_config.get('%s_entity_id' % kind):
+            keys[sync_config['%s_entity_id' % kind]] = \
+                sync_config['%s_security_key' % kind]
+    if not entity_ids:
+        if not sync_config.get('raw_entity_id'):
+            print("no raw_entity_id in [Mesowx][[RemoteSync]], name the "
+                  "entity to prune with --entity")
+            return 1
+        entity_ids = [sync_config['raw_entity_id']]
+    url = sync_config['remote_server_url'] + sync_config.get(
+          'server_prune_path', "prune.php")
+    http = urllib3.PoolManager(headers={
+        'User-Agent': 'MesoWX/%s (https://github.com/glennmckechnie/'
+                      'weewx-mesowx)' % VERSION})
+    failed = 0
+    for entity_id in entity_ids:
+        if entity_id not in keys:
+            print("%s: not an entity in [Mesowx][[RemoteSync]]" % entity_id)
+            failed += 1
+            continue
+        started = time.time()
+        try:
+            response = http.request('POST', url, fields={
+                                    'entity_id': entity_id,
+                                    'security_key': keys[entity_id]})
+        except urllib3.exceptions.HTTPError as e:
+            print("%s: prune failed, unable to reach %s: %s" %
+                  (entity_id, url, e))
+            failed += 1
+            continue
+        if response.status == 200:
+            print("%s: pruned in %.1f seconds" %
+                  (entity_id, time.time() - started))
+        else:
+            print("%s: prune failed (%s %s): %s" %
+                  (entity_id, response.status, response.reason,
+                   response.data.decode('utf-8', 'replace')))
+            failed += 1
+    return failed
+
+
+if __name__ == '__main__':
+    # maintenance commands, run with weewx's bin directory in the path, i.e.
+    #   PYTHONPATH=/usr/share/weewx python3 mesowx.py --prune-remote \
+    #       /etc/weewx/weewx.conf
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="MesoWX maintenance")
+    parser.add_argument('config_path', help="path to weewx.conf")
+    parser.add_argument('--prune-remote', action='store_true',
+                        help="apply the remote server's retention policies "
+                             "(for the 'schedule' trigger)")
+    parser.add_argument('--entity', action='append', dest='entity_ids',
+                        help="the entity to prune (default: raw_entity_id), "
+                             "may be repeated")
+    args = parser.parse_args()
+    if not args.prune_remote:
+        parser.error("nothing to do, use --prune-remote")
+    sys.exit(1 if prune_remote(args.config_path, args.entity_ids) else 0)
@@ -79,6 +79,7 @@ class MesowxInstaller(ExtensionInstaller):
                     'skins/Mesowx/js/lib/jquery-3.5.1.min.js',
                     'skins/Mesowx/js/lib/modules/exporting.js',
                     'skins/Mesowx/meso/data.php',
+                    'skins/Mesowx/meso/prune.php',
                     'skins/Mesowx/meso/stats.php',
                     'skins/Mesowx/meso/updateData.php',
                     'skins/Mesowx/meso/include/.htaccess',
@@ -86,6 +87,8 @@ class MesowxInstaller(ExtensionInstaller):
                     'skins/Mesowx/meso/include/AggregateParameterParser.class.php',
                     'skins/Mesowx/meso/include/AggregateQuery.class.php',
                     'skins/Mesowx/meso/include/AggregateQuerySpec.class.php',
+                    'skins/Mesowx/meso/include/ColumnEncoder.class.php',
+                    'skins/Mesowx/meso/include/Downsampler.class.php',
                     'skins/Mesowx/meso/include/config-example.json',
                     'skins/Mesowx/meso/include/config.json.tmpl',
                     'skins/Mesowx/meso/include/config-RemoteSync.json.tmpl',
@@ -106,6 +109,9 @@ class MesowxInstaller(ExtensionInstaller):
                     'skins/Mesowx/meso/js/MesoConsole.js',
                     'skins/Mesowx/meso/js/meso.js',
                     'skins/Mesowx/meso/js/PollingRealTimeRawDataProvider.js',
+                    'skins/Mesowx/meso/js/PushRealTimeRawDataProvider.js',
+                    'skins/Mesowx/meso/js/SnapshotRealTimeRawDataProvider.js',
+                    'skins/Mesowx/meso/js/TileDataProvider.js',
                     'skins/Mesowx/meso/js/SocketIoRealTimeRawDataProvider.js',
                     'skins/Mesowx/meso/js/StatsDataProvider.js',
                     'skins/Mesowx/style/mesowx.css',
@@ -2,6 +2,8 @@ var mesowx = mesowx || {};
 
 mesowx.RealTimeChart = (function() {
 
+    var INITIAL_RANGE = 1200; // 20 minutes
+
     var RealTimeChart = function(options) {
         this._realTimeDataProvider = options.realTimeDataProvider;
         this._dataSubscription = null;
@@ -25,11 +27,25 @@ mesowx.RealTimeChart = (function() {
         this._dataSubscription = this._realTimeDataProvider.subscribe(
                 meso.Util.bind(this, this._onNewData), this._fieldDefs);
     };
+    // a provider with the recent packets at hand (i.e. last24h.json) saves asking data.php for them
+    RealTimeChart.prototype._loadInitialDataAndCreate = function() {
+        if(!this._realTimeDataProvider.getRecent) {
+            _super._loadInitialDataAndCreate.call(this);
+            return;
+        }
+        this._realTimeDataProvider.getRecent(
+                meso.Util.bind(this, this._handleInitialLoad),
+                this._fieldDefs,
+                Math.floor(Date.now() / 1000) - INITIAL_RANGE,
+                meso.Util.bind(this, function() {
+                    _super._loadInitialDataAndCreate.call(this);
+                }));
+    };
     // data is only load once and is not grouped
     RealTimeChart.prototype._buildFetchDataQuery = function(successCallback, fieldDefs, start, end) {
         var query = _super._buildFetchDataQuery.call(this, successCallback, fieldDefs, start, end);
         query.start = {
-            value: 1200, // 20 minutes
+            value: INITIAL_RANGE,
             type: 'ago'
         };
         return query;
@@ -26,6 +26,10 @@ header('HTTP/1.0 500 Internal Server Error');
  *          - days, e.g. "7:days:ms"
  *          - months, e.g. "1:months:ms"
  *          - year, e.g. "1:years:s"
+ *      - by picking rows rather than aggregating them, from the given number of equal periods
+ *        (see Downsampler), so peaks aren't flattened
+ *          - largest triangle three buckets, e.g. "500:lttb:ms"
+ *          - first, last, min and max, e.g. "500:m4:ms"
  *   - data
  *      - fieldId:agg:unit:decimals (agg, unit, and decimals are optional)
  *      - i.e. "outTemp,outDew:mean::1,bar::mb"
@@ -33,7 +37,16 @@ header('HTTP/1.0 500 Internal Server Error');
  *      - sort (by datetime only for now), "asc"/"desc"
  *   - limit
  *      - the number of records to return
+ *   - tile
+ *      - in place of start and end, the number of a fixed span of time from the epoch, sized
+ *        to the group, which must be in seconds (see TimeTile), i.e. "tile=19700&group=300"
+ *        is the 5 minute groups of the 19700th day. Once there's a later record the response
+ *        can be cached for a while, and for good once it's also complete (see
+ *        TimeTile::isComplete())
  *
+ * The rows are JSON, "[[dateTime,value,...],...]", unless the Accept header has
+ * "application/x-mesowx-columns", when they're sent in a binary columnar form (see
+ * ColumnEncoder), the values quantized to the decimals asked for.
  */
 require_once("include/HttpUtil.class.php");
 require_once("include/JsonConfig.class.php");
@@ -41,6 +54,7 @@ require_once("include/AggregateParameterParser.class.php");
 require_once("include/AggregateQuery.class.php");
 require_once("include/PDOConnectionFactory.class.php");
 require_once 'include/TableEntity.class.php';
+require_once("include/ColumnEncoder.class.php");
 
 // always try to prevent caching of this page
 HttpUtil::sendPreventCacheHeaders();
@@ -58,7 +72,8 @@ $db_config = $config['dataSource'][$spec->entityConfig['dataSource']];
 $db = PDOConnectionFactory::openConnection($db_config);
 
 // TODO need to support calculated fields (i.e. actual rainRate)
-$query = new AggregateQuery($spec, $db);
+// answered from a rollup table when there's one that will do
+$query = AggregateQueryPlanner::plan($spec, $db);
 
 header( "X-Meso-Query: ". str_replace("\n", " ", $query->sql) );
 
@@ -67,8 +82,13 @@ $_start = microtime(true);
 try {
     $data = $db->query( $query->sql );
 } catch(PDOException $e) { // XXX a quick and dirty fix for automatically creating the table if it doesn't yet exist
+    if($query instanceof RollupAggregateQuery) {
+        // most likely a field that isn't rolled up, the entity's table has them all
+        $query = new AggregateQuery($spec, $db);
+        header( "X-Meso-Query: ". str_replace("\n", " ", $query->sql) );
+        $data = $db->query( $query->sql );
     // table doesn't exist eror code: 42S02
-    if($e->getCode() == '42S02') {
+    } else if($e->getCode() == '42S02') {
         // attempt to create the table and retry
         $entity->createTable();
         $data = $db->query( $query->sql );
@@ -82,21 +102,78 @@ header( "X-Meso-Query-Time: ". (microtime(true) - $_start) );
 
 $data->setFetchMode(PDO::FETCH_NUM);
 
+// a tile that's over and complete won't change, one that's only over may still get records
+if($spec->tile !== NULL && $spec->tile->isOver($spec, $db)) {
+    if($spec->tile->isComplete($spec, $entity)) {
+        HttpUtil::sendCacheForeverHeaders();
+    } else {
+        HttpUtil::sendCacheHeaders(TimeTile::UNCONFIRMED_MAX_AGE);
+    }
+}
+
+// the same URL can be JSON or binary
+header("Vary: Accept");
+
 // success! reset to 200 status
 header('HTTP/1.0 200 OK');
 
-echo '[';
+$encoder = NULL;
+if(ColumnEncoder::isAccepted()) {
+    // the decimals of each column, a group's time is to the whole ms or s
+    $decimals = array();
+    if($query instanceof DownsampleQuery || ($spec->isGrouped() && !$spec->group->isSingle())) {
+        $decimals[] = 0;
+    }
+    foreach($spec->data as $field) {
+        $decimals[] = $field->decimals === NULL ? NULL : (int) $field->decimals;
+    }
+    $encoder = new ColumnEncoder($decimals);
+    header("Content-Type: ". ColumnEncoder::CONTENT_TYPE);
+} else {
+    echo '[';
+}
 
 $i = 1;
-while( $row = $data->fetch() ) {
+$echoRow = function($row) use (&$i, $encoder) {
+    if( $encoder ) {
+        $encoder->add($row);
+        return;
+    }
     if( $i != 1 ) echo ",";
     $row = array_map( function($column) {
         return $column === NULL ? "null" : $column;
     }, $row);
     echo "[" . join( ",", $row ) . "]";
     $i++;
+};
+
+if($query instanceof DownsampleQuery) {
+    // the rows are picked as they're read, the dateTime converted to the group's unit
+    $downsampler = $query->newDownsampler();
+    $dateTimeUnit = $spec->entityConfig['columns'][$spec->dateTimeColumn]['unit'];
+    $groupUnit = $spec->group->unit;
+    $emit = function($rows) use ($echoRow, $dateTimeUnit, $groupUnit) {
+        foreach($rows as $row) {
+            if($groupUnit) {
+                $row[0] = UnitConvert::convert($row[0], $dateTimeUnit, $groupUnit);
+            }
+            $echoRow($row);
+        }
+    };
+    while( $row = $data->fetch() ) {
+        $emit($downsampler->add($row));
+    }
+    $emit($downsampler->flush());
+} else {
+    while( $row = $data->fetch() ) {
+        $echoRow($row);
+    }
 }
 
-echo ']';
+if( $encoder ) {
+    echo $encoder->encode();
+} else {
+    echo ']';
+}
 
 ?>
@@ -10,6 +10,7 @@ class AggregateParameterParser {
     const DATA_PARAM = "data";
     const ORDER_PARAM = "order";
     const LIMIT_PARAM = "limit";
+    const TILE_PARAM = "tile";
 
     protected $get;
     protected $config;
@@ -28,6 +29,7 @@ class AggregateParameterParser {
         $spec->setStart($this->parseStart());
         $spec->setEnd($this->parseEnd());
         $spec->setGroup($this->parseGroup());
+        $spec->setTile($this->parseTile($spec));
         $spec->setData($this->parseData());
         $spec->setOrder($this->parseOrder());
         $spec->setLimit($this->parseLimit());
@@ -117,6 +119,21 @@ class AggregateParameterParser {
         return $group;
     }
 
+    // a tile stands in for the start and end
+    protected function parseTile($spec) {
+        $index = $this->getParam(self::TILE_PARAM);
+        if($index === NULL) {
+            return NULL;
+        }
+        if($spec->start !== NULL || $spec->end !== NULL) {
+            throw new Exception("A tile can't be given a start or end");
+        }
+        $tile = new TimeTile($index, $spec->group);
+        $spec->setStart($tile->start);
+        $spec->setEnd($tile->end);
+        return $tile;
+    }
+
     protected function parseData() {
         $data = array();
         $value = $this->getParam(self::DATA_PARAM);
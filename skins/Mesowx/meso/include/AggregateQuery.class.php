@@ -1,6 +1,7 @@
 <?php
 
 require('Unit.class.php');
+require_once('Downsampler.class.php');
 
 class AggregateQuery {
 
@@ -12,10 +13,14 @@ class AggregateQuery {
         $this->spec = $spec;
         $this->dbHelper = $dbHelper;
         $this->dateTimeColumnQuoted = $this->quote($spec->dateTimeColumn);
-        $this->tableNameQuoted = $this->quote($spec->table);
+        $this->tableNameQuoted = $this->quote($this->getTable());
         $this->build();
     }
 
+    protected function getTable() {
+        return $this->spec->table;
+    }
+
     protected function build() {
         $this->sql = "select \n"
             . $this->buildSelects() ."\n"
@@ -71,7 +76,7 @@ class AggregateQuery {
 
         $select = $this->quote($field);
         if( $this->isGrouped() ) {
-            $select = "$agg($select)";
+            $select = $this->buildAggregate($field, $agg);
         }
         $select = $this->buildUnitConversion($select, $field, $unit);
         $alias = $this->buildDataSelectAlias($field, $agg);
@@ -81,6 +86,10 @@ class AggregateQuery {
         return $select;
     }
 
+    protected function buildAggregate($field, $agg) {
+        return "$agg({$this->quote($field)})";
+    }
+
     protected function buildUnitConversion($value, $field, $unit) {
         if( $unit == NULL ) {
             return $value;
@@ -225,4 +234,322 @@ class AggregateQuery {
     }
 }
 
+/**
+ * Answers the query from one of the rollup tables kept by user.mesowx.RollupService rather than
+ * the entity's table. Each row of a rollup holds the min, max, sum and count of each field for
+ * one bucket of time, starting at its dateTime. Only the buckets wholly within the range are
+ * used, the records of a bucket that the start or end cuts through (the planner passes the start
+ * of the first whole bucket as $headEnd and the start of the one cut by the end as $tailStart)
+ * come from the entity's table, each as a bucket of its own.
+ */
+class RollupAggregateQuery extends AggregateQuery {
+
+    protected $rollupTable;
+    protected $headEnd;
+    protected $tailStart;
+
+    function __construct( AggregateQuerySpec $spec, DBHelper $dbHelper, $rollupTable, $headEnd=NULL, $tailStart=NULL ) {
+        $this->rollupTable = $rollupTable;
+        $this->headEnd = $headEnd;
+        $this->tailStart = $tailStart;
+        parent::__construct($spec, $dbHelper);
+    }
+
+    protected function getTable() {
+        return $this->rollupTable;
+    }
+
+    protected function buildFrom() {
+        if($this->headEnd === NULL && $this->tailStart === NULL) {
+            return parent::buildFrom();
+        }
+        $rollupSelects = array($this->dateTimeColumnQuoted);
+        $entitySelects = array($this->dateTimeColumnQuoted);
+        $fields = array();
+        foreach($this->spec->data as $data) {
+            $fields[$data->field] = true;
+        }
+        foreach(array_keys($fields) as $field) {
+            $value = $this->quote($field);
+            foreach(array(Agg::min, Agg::max, Agg::sum) as $agg) {
+                $rollupSelects[] = $this->quote($field .'_'. $agg);
+                $entitySelects[] = "$value ". $this->quote($field .'_'. $agg);
+            }
+            $rollupSelects[] = $this->quote($field .'_count');
+            $entitySelects[] = "case when $value is null then 0 else 1 end ". $this->quote($field .'_count');
+        }
+        $entityWhere = array();
+        if($this->headEnd !== NULL) {
+            $entityWhere[] = "({$this->dateTimeColumnQuoted} >= {$this->spec->start} and {$this->dateTimeColumnQuoted} < {$this->headEnd})";
+        }
+        if($this->tailStart !== NULL) {
+            $entityWhere[] = "({$this->dateTimeColumnQuoted} >= {$this->tailStart} and {$this->dateTimeColumnQuoted} <= {$this->spec->end})";
+        }
+        $bucketWhere = $this->getBucketWhere();
+        return "from (select ". join(", ", $rollupSelects) ." ". parent::buildFrom()
+            . (count($bucketWhere) > 0 ? " where ". join(" and ", $bucketWhere) : "") ."\n"
+            . "union all\n"
+            . "select ". join(", ", $entitySelects) ." from ". $this->quote($this->spec->table) ." where ". join(" or ", $entityWhere) .") "
+            . $this->tableNameQuoted;
+    }
+
+    protected function buildWhere() {
+        if($this->headEnd === NULL && $this->tailStart === NULL) {
+            return parent::buildWhere();
+        }
+        // it's in the from
+        return "";
+    }
+
+    // the buckets wholly within the range
+    protected function getBucketWhere() {
+        $where = array();
+        $start = $this->spec->start;
+        if( $start != NULL ) {
+            $where[] = "{$this->dateTimeColumnQuoted} >= $start";
+        }
+        if( $this->tailStart !== NULL ) {
+            $where[] = "{$this->dateTimeColumnQuoted} < {$this->tailStart}";
+        } else if( $this->spec->end != NULL ) {
+            $where[] = "{$this->dateTimeColumnQuoted} <= {$this->spec->end}";
+        }
+        return $where;
+    }
+
+    protected function buildAggregate($field, $agg) {
+        $sum = "sum({$this->quote($field .'_sum')})";
+        $count = "sum({$this->quote($field .'_count')})";
+        if($agg == Agg::avg) {
+            return "$sum / nullif($count, 0)";
+        }
+        if($agg == Agg::sum) {
+            // null rather than 0 when there were no values, as it would be from the entity's table
+            return "(case when $count > 0 then $sum end)";
+        }
+        return "$agg({$this->quote($field .'_'. $agg)})";
+    }
+}
+
+/**
+ * The rows for a Downsampler to pick from: the dateTime as it's stored then each field, ungrouped
+ * and oldest first.
+ */
+class DownsampleQuery extends AggregateQuery {
+
+    protected function buildSelects() {
+        return $this->dateTimeColumnQuoted .",\n". parent::buildSelects();
+    }
+
+    protected function buildOrderBy() {
+        return "order by {$this->dateTimeColumnQuoted} asc";
+    }
+
+    protected function buildLimit() {
+        return NULL;
+    }
+
+    protected function isGrouped() {
+        return false;
+    }
+
+    public function newDownsampler() {
+        $start = $this->spec->start;
+        $end = $this->spec->end;
+        if($start == NULL || $end == NULL) {
+            $row = $this->dbHelper->query("select min({$this->dateTimeColumnQuoted}), max({$this->dateTimeColumnQuoted}) "
+                . $this->buildFrom())->fetch(PDO::FETCH_NUM);
+            if($start == NULL) $start = $row ? $row[0] : 0;
+            if($end == NULL) $end = $row ? $row[1] : 0;
+        }
+        $group = $this->spec->group;
+        return new Downsampler($group->type, $group->value, $start, $end, count($this->spec->data));
+    }
+}
+
+/**
+ * Picks the coarsest rollup table that still gives the resolution a grouped query asks for,
+ * falling back to the entity's own table. Enabled by setting "rollupTablePrefix" on the entity.
+ */
+class AggregateQueryPlanner {
+
+    // bucket size in seconds by table suffix, coarsest first. The day buckets are local days so
+    // they're only exact for day, month and year groups.
+    public static $ROLLUPS = array(
+        'day' => 86400,
+        '3600' => 3600,
+        '300' => 300
+    );
+
+    // the fewest rollup buckets to a group when grouping by a number of groups. The group
+    // boundaries rarely fall on bucket boundaries, each bucket goes to the group it starts in, so
+    // an interior group can take in up to a bucket of its neighbour's records, with more buckets
+    // to a group that's a smaller share of it
+    const MIN_BUCKETS_PER_GROUP = 4;
+
+    public static function plan( AggregateQuerySpec $spec, DBHelper $db ) {
+        if($spec->isGrouped() && $spec->group->isDownsample()) {
+            return new DownsampleQuery($spec, $db);
+        }
+        $rollupTable = self::chooseRollup($spec, $db);
+        if($rollupTable) {
+            $edges = self::getEdges($spec, $db, $rollupTable);
+            if($edges !== false) {
+                return new RollupAggregateQuery($spec, $db, $rollupTable, $edges[0], $edges[1]);
+            }
+        }
+        return new AggregateQuery($spec, $db);
+    }
+
+    protected static function chooseRollup( AggregateQuerySpec $spec, DBHelper $db ) {
+        if(!array_key_exists('rollupTablePrefix', $spec->entityConfig) || !$spec->isGrouped()) {
+            return NULL;
+        }
+        $prefix = $spec->entityConfig['rollupTablePrefix'];
+        $type = $spec->group->type;
+        $value = $spec->group->value;
+        $suffix = NULL;
+        if($type == GroupType::days || $type == GroupType::months || $type == GroupType::years) {
+            $suffix = 'day';
+        } else if($type == GroupType::seconds && !$spec->group->isSingle()) {
+            // exact as long as the slice is a whole number of buckets, the buckets cut by the start
+            // or end are answered from the entity's table (see getEdges())
+            foreach(self::$ROLLUPS as $candidate => $seconds) {
+                if($candidate != 'day' && $value % $seconds == 0) {
+                    $suffix = $candidate;
+                    break;
+                }
+            }
+        } else {
+            // a number of groups, or a single one
+            $range = self::getRange($spec, $db);
+            if($range === NULL) {
+                return NULL;
+            }
+            $groups = $type == GroupType::groups ? max($value, 1) : 1;
+            $slice = ($range[1] - $range[0]) / $groups;
+            foreach(self::$ROLLUPS as $candidate => $seconds) {
+                if($seconds * self::MIN_BUCKETS_PER_GROUP <= $slice) {
+                    $suffix = $candidate;
+                    break;
+                }
+            }
+        }
+        if($suffix === NULL || !self::isCaughtUp($spec, $db, $prefix)) {
+            return NULL;
+        }
+        if($suffix == 'day' && !self::isDayAligned($spec, $db, "{$prefix}_day")) {
+            return NULL;
+        }
+        return "{$prefix}_{$suffix}";
+    }
+
+    /**
+     * Whether the first and last of the daily rollup rows, which start at midnight in weewx's time
+     * zone, also start a day in the database session's time zone, the one from_unixtime() groups
+     * the entity's table by days, months and years in. If the zones differ the groups would come
+     * out differently from the rollups, so they aren't used.
+     */
+    protected static function isDayAligned( AggregateQuerySpec $spec, DBHelper $db, $rollupTable ) {
+        $dateTime = $db->quoteIdentifier($spec->dateTimeColumn);
+        $rollup = $db->quoteIdentifier($rollupTable);
+        $startsDay = array();
+        foreach(array('min', 'max') as $agg) {
+            $bucket = "(select $agg($dateTime) from $rollup)";
+            $startsDay[] = "dayofyear(from_unixtime($bucket - 1)) <> dayofyear(from_unixtime($bucket))";
+        }
+        try {
+            $row = $db->query("select ". implode(' and ', $startsDay))->fetch(PDO::FETCH_NUM);
+        } catch(PDOException $e) {
+            return false;
+        }
+        if($row[0] === NULL) {
+            // no daily rollups yet
+            return false;
+        }
+        if(!$row[0]) {
+            error_log("Not using $rollupTable, its days don't start at midnight in the database's time zone,"
+                . " set the MySQL time_zone to weewx's");
+            return false;
+        }
+        return true;
+    }
+
+    /**
+     * The start of the first bucket and of the last one for a RollupAggregateQuery on
+     * $rollupTable, where the start or end of the range cuts through a bucket with records outside
+     * the range (NULL where it doesn't), or false if no bucket is wholly within the range. The
+     * records from the start to the first bucket starting in the range belong to a bucket that
+     * starts before it, and those after the end but before the next bucket to the one the end is in.
+     */
+    protected static function getEdges( AggregateQuerySpec $spec, DBHelper $db, $rollupTable ) {
+        $dateTime = $db->quoteIdentifier($spec->dateTimeColumn);
+        $rollup = $db->quoteIdentifier($rollupTable);
+        $table = $db->quoteIdentifier($spec->table);
+        $start = $spec->start;
+        $end = $spec->end;
+        try {
+            $first = $db->query("select min($dateTime) from $rollup"
+                . ($start != NULL ? " where $dateTime >= $start" : ""))->fetchColumn();
+            $last = $db->query("select max($dateTime) from $rollup"
+                . ($end != NULL ? " where $dateTime <= $end" : ""))->fetchColumn();
+            if($first === NULL || $last === NULL || $first === false || $last === false || $first > $last) {
+                return false;
+            }
+            $headEnd = NULL;
+            if($start != NULL && $db->query("select 1 from $table where $dateTime >= $start and $dateTime < $first limit 1")->fetchColumn()) {
+                $headEnd = $first;
+            }
+            $tailStart = NULL;
+            if($end != NULL) {
+                $next = $db->query("select min($dateTime) from $rollup where $dateTime > $end")->fetchColumn();
+                if($db->query("select 1 from $table where $dateTime > $end"
+                        . ($next !== NULL && $next !== false ? " and $dateTime < $next" : "") ." limit 1")->fetchColumn()) {
+                    if($first >= $last) {
+                        return false;
+                    }
+                    $tailStart = $last;
+                }
+            }
+        } catch(PDOException $e) {
+            // the rollup table hasn't been created
+            return false;
+        }
+        return array($headEnd, $tailStart);
+    }
+
+    protected static function getRange( AggregateQuerySpec $spec, DBHelper $db ) {
+        $start = $spec->start;
+        $end = $spec->end;
+        if($start == NULL || $end == NULL) {
+            $dateTimeColumnQuoted = $db->quoteIdentifier($spec->dateTimeColumn);
+            $row = $db->query("select min($dateTimeColumnQuoted), max($dateTimeColumnQuoted) from "
+                . $db->quoteIdentifier($spec->table))->fetch(PDO::FETCH_NUM);
+            if(!$row || $row[0] === NULL) {
+                return NULL;
+            }
+            if($start == NULL) $start = $row[0];
+            if($end == NULL) $end = $row[1];
+        }
+        return array($start, $end);
+    }
+
+    // the rollups are only used once they've caught up with the entity's table
+    protected static function isCaughtUp( AggregateQuerySpec $spec, DBHelper $db, $prefix ) {
+        try {
+            $row = $db->query("select value from ". $db->quoteIdentifier("{$prefix}_state")
+                ." where name = 'watermark'")->fetch(PDO::FETCH_NUM);
+        } catch(PDOException $e) {
+            // the rollup tables haven't been created
+            return false;
+        }
+        if(!$row) {
+            return false;
+        }
+        $dateTimeColumnQuoted = $db->quoteIdentifier($spec->dateTimeColumn);
+        $latest = $db->query("select max($dateTimeColumnQuoted) from "
+            . $db->quoteIdentifier($spec->table))->fetch(PDO::FETCH_NUM);
+        return $latest[0] === NULL || $row[0] > $latest[0];
+    }
+}
+
 ?>
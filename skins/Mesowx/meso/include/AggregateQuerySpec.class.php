@@ -10,6 +10,7 @@ class AggregateQuerySpec {
     public $data = array();
     public $order;
     public $limit;
+    public $tile;
 
     public $table;
     public $dateTimeColoumn;
@@ -81,6 +82,11 @@ class AggregateQuerySpec {
         return $this;
     }
 
+    public function setTile(TimeTile $tile=NULL) {
+        $this->tile = $tile;
+        return $this;
+    }
+
     public function setOrder($order) {
         if( $order != Order::asc && $order != Order::desc ) {
             throw new Exception("Invaild order value: '$order'");
@@ -167,6 +173,10 @@ class Group {
         $this->unit = $unit;
     }
 
+    public function isDownsample() {
+        return $this->type == GroupType::lttb || $this->type == GroupType::m4;
+    }
+
     public function isSingle() {
         return ($this->type == GroupType::seconds && 
             ($this->value == NULL || $this->value == 0) ||
@@ -185,7 +195,7 @@ class Group {
                     throw new Exception("Group value must be greater than zero: '$value' for type '$type'" );
                 }
             }
-        } else if( $type == GroupType::groups ) {
+        } else if( $type == GroupType::groups || $type == GroupType::lttb || $type == GroupType::m4 ) {
             if( !is_numeric($value) ) {
                 throw new Exception("Invalid group value: '$value' for type '$type'" );
             }
@@ -208,12 +218,88 @@ class Group {
     }
 }
 
+/**
+ * One of the fixed, epoch aligned spans of time that a seconds group is split into, numbered
+ * from the epoch. The span is the largest of TimeTile::$SPANS that's a whole number of groups,
+ * but no more than MAX_GROUPS of them, i.e. day tiles of 5 minute groups, 30 day tiles of hourly
+ * groups and 360 day tiles of daily groups. A tile that has ended doesn't change.
+ */
+class TimeTile {
+    public $index;
+    public $span;
+    public $start;
+    public $end;
+
+    public static $SPANS = array( 31104000, 2592000, 86400 );
+
+    const MAX_GROUPS = 1440;
+
+    // seconds a tile that's over but not known to be complete may be cached for
+    const UNCONFIRMED_MAX_AGE = 600;
+
+    function __construct($index, Group $group=NULL) {
+        if(!preg_match("/^-?\d+$/", $index)) {
+            throw new Exception("Invalid tile: '$index'");
+        }
+        if($group == NULL || $group->type != GroupType::seconds || $group->isSingle()) {
+            throw new Exception("A tile must be grouped by seconds");
+        }
+        $span = self::getSpan($group->value);
+        if($span === NULL) {
+            throw new Exception("No tiles for groups of $group->value seconds");
+        }
+        $this->index = (int) $index;
+        $this->span = $span;
+        $this->start = $this->index * $span;
+        $this->end = $this->start + $span - 1;
+    }
+
+    public static function getSpan($groupSeconds) {
+        foreach(self::$SPANS as $span) {
+            if($span % $groupSeconds == 0 && $span / $groupSeconds <= self::MAX_GROUPS) {
+                return $span;
+            }
+        }
+        return NULL;
+    }
+
+    // over once there's a record after it
+    public function isOver(AggregateQuerySpec $spec, DBHelper $db) {
+        $dateTimeColumnQuoted = $db->quoteIdentifier($spec->dateTimeColumn);
+        try {
+            $row = $db->query("select max($dateTimeColumnQuoted) from "
+                . $db->quoteIdentifier($spec->table))->fetch(PDO::FETCH_NUM);
+        } catch(PDOException $e) {
+            return false;
+        }
+        return $row && $row[0] !== NULL && $row[0] > $this->end;
+    }
+
+    /**
+     * Whether a tile that's over won't change. A later record is enough for a table weewx writes
+     * itself ("tileWatermark" : "latest"), but the records of a synced one can arrive out of
+     * order or not at all (a failed or skipped back-fill), so by default it also has to end
+     * before the entity's watermark, up to which the sync has confirmed it sent every record.
+     */
+    public function isComplete(AggregateQuerySpec $spec, TableEntity $entity) {
+        if(array_key_exists('tileWatermark', $spec->entityConfig)
+                && $spec->entityConfig['tileWatermark'] == 'latest') {
+            return true;
+        }
+        $watermark = $entity->getWatermark();
+        return $watermark !== NULL && $watermark >= $this->end;
+    }
+}
+
 class GroupType {
     const groups = "groups";
     const seconds = "seconds";
     const days = "days";
     const months = "months";
     const years = "years";
+    // picks rows from value buckets of time rather than aggregating them (see Downsampler)
+    const lttb = "lttb";
+    const m4 = "m4";
 }
 
 class Order {
@@ -0,0 +1,139 @@
+<?php
+
+/**
+ * data.php's rows in a binary columnar form, for a client that asks for it in its Accept header.
+ * The rows are a 16 byte header ("MWXC", a version byte, a column count byte, two unused bytes
+ * and a uint32 row count, then four unused bytes) followed by each column: an 8 byte header (a
+ * kind byte, a width byte, a signed decimals byte, an unused byte and the uint32 length of the
+ * values) then its values, padded to a multiple of 8 bytes so that they can be read as a typed
+ * array where they are. The kinds are:
+ *   - COLUMN_DELTA, the first value as a float64 then the difference of each value from the one
+ *     before, as int16 or int32 (the width) of value * 10^decimals. Used where there are no
+ *     nulls, which suits the group's time especially.
+ *   - COLUMN_QUANTIZED, each value as int16 or int32 of value * 10^decimals, the lowest int16 or
+ *     int32 is null.
+ *   - COLUMN_FLOAT, each value as a float64, NAN is null, when the others won't do.
+ * Values are only quantized to the decimals asked for, or if they're whole. All little-endian.
+ */
+class ColumnEncoder {
+
+    const CONTENT_TYPE = "application/x-mesowx-columns";
+
+    const COLUMN_FLOAT = 0;
+    const COLUMN_QUANTIZED = 1;
+    const COLUMN_DELTA = 2;
+
+    const MAX_DECIMALS = 9;
+
+    private $decimals;
+    private $columns = array();
+    private $rowCount = 0;
+
+    /**
+     * $decimals has the decimals of each column, NULL where none were asked for.
+     */
+    function __construct($decimals) {
+        $this->decimals = $decimals;
+        foreach($decimals as $index => $value) {
+            $this->columns[$index] = array();
+        }
+    }
+
+    public static function isAccepted() {
+        return isset($_SERVER['HTTP_ACCEPT']) && strpos($_SERVER['HTTP_ACCEPT'], self::CONTENT_TYPE) !== false;
+    }
+
+    public function add($row) {
+        foreach($this->decimals as $index => $decimals) {
+            $this->columns[$index][] = $row[$index] === NULL ? NULL : (float) $row[$index];
+        }
+        $this->rowCount++;
+    }
+
+    public function encode() {
+        $encoded = "MWXC" . pack("CCvVV", 1, count($this->columns), 0, $this->rowCount, 0);
+        foreach($this->columns as $index => $values) {
+            list($kind, $width, $decimals, $payload) = self::encodeColumn($values, $this->decimals[$index]);
+            $length = strlen($payload);
+            $encoded .= pack("CCcCV", $kind, $width, $decimals, 0, $length)
+                . $payload . str_repeat("\0", (8 - $length % 8) % 8);
+        }
+        return $encoded;
+    }
+
+    private static function encodeColumn($values, $decimals) {
+        if($decimals === NULL && self::isWhole($values)) {
+            $decimals = 0;
+        }
+        // any more decimals than MAX_DECIMALS are as good as float64
+        if($decimals !== NULL && $decimals <= self::MAX_DECIMALS) {
+            $scale = pow(10, $decimals);
+            $ints = array();
+            $hasNull = false;
+            foreach($values as $value) {
+                if($value === NULL) {
+                    $ints[] = NULL;
+                    $hasNull = true;
+                } else {
+                    // round() is half away from zero, as SQL's. Left a float until it's known to fit
+                    $ints[] = round($value * $scale);
+                }
+            }
+            if($ints && !$hasNull) {
+                $deltas = array();
+                for($i = 1; $i < count($ints); $i++) {
+                    $deltas[] = $ints[$i] - $ints[$i - 1];
+                }
+                $width = self::getIntWidth($deltas);
+                if($width) {
+                    return array(self::COLUMN_DELTA, $width, $decimals,
+                        pack("e", $ints[0]) . self::packInts($deltas, $width));
+                }
+            }
+            $width = self::getIntWidth(array_filter($ints, function($int) {
+                return $int !== NULL;
+            }));
+            if($width) {
+                $null = -(1 << (8 * $width - 1));
+                foreach($ints as $i => $int) {
+                    if($int === NULL) $ints[$i] = $null;
+                }
+                return array(self::COLUMN_QUANTIZED, $width, $decimals, self::packInts($ints, $width));
+            }
+        }
+        $doubles = array_map(function($value) {
+            return $value === NULL ? NAN : $value;
+        }, $values);
+        return array(self::COLUMN_FLOAT, 8, 0, $doubles ? pack("e*", ...$doubles) : "");
+    }
+
+    private static function isWhole($values) {
+        foreach($values as $value) {
+            if($value !== NULL && floor($value) != $value) {
+                return false;
+            }
+        }
+        return true;
+    }
+
+    // 2 or 4 bytes, leaving the lowest of each for null, or NULL if the ints won't fit either
+    private static function getIntWidth($ints) {
+        $low = $ints ? min($ints) : 0;
+        $high = $ints ? max($ints) : 0;
+        foreach(array(2, 4) as $width) {
+            $limit = (1 << (8 * $width - 1)) - 1;
+            if(-$limit <= $low && $high <= $limit) {
+                return $width;
+            }
+        }
+        return NULL;
+    }
+
+    // pack() takes the low bits of a negative number for the unsigned little-endian formats
+    private static function packInts($ints, $width) {
+        $ints = array_map('intval', $ints);
+        return $ints ? pack($width == 2 ? "v*" : "V*", ...$ints) : "";
+    }
+}
+
+?>
@@ -0,0 +1,186 @@
+<?php
+
+/**
+ * Picks about $count rows from rows of (dateTime, value, ...) added oldest first, keeping the
+ * shape of each field's line rather than averaging it away. The range is cut into $count equal
+ * buckets of time:
+ *   - lttb (largest triangle three buckets) takes, for each field, the row of a bucket that makes
+ *     the largest triangle with the row taken from the bucket before and the average of the
+ *     bucket after.
+ *   - m4 takes the first and last row of a bucket and the rows with the lowest and highest value
+ *     of each field.
+ * The rows taken for any field are returned whole, along with the first and last row, so there
+ * can be more than $count of them with several fields. Only two buckets are held at a time.
+ */
+class Downsampler {
+
+    private $mode;
+    private $count;
+    private $start;
+    private $slice;
+    private $fields;
+
+    // the buckets not yet done with, each array(bucket index, rows), at most two
+    private $buckets = array();
+    // array(dateTime, value) of the row last taken for each field
+    private $taken;
+    // rows are kept as array(sequence, row) so that a row taken twice is only returned once
+    private $sequence = 0;
+    private $last = NULL;
+
+    function __construct($mode, $count, $start, $end, $fields) {
+        $this->mode = $mode;
+        $this->count = max(1, (int) $count);
+        $this->start = (float) $start;
+        $this->slice = ((float) $end - $this->start) / $this->count;
+        $this->fields = $fields;
+        $this->taken = array_fill(0, $fields, NULL);
+    }
+
+    // the rows picked on adding $row, oldest first
+    public function add($row) {
+        $picked = array();
+        $entry = array($this->sequence++, $row);
+        if($entry[0] == 0) {
+            // the first row is always taken
+            $picked[] = $entry;
+            for($f = 0; $f < $this->fields; $f++) {
+                if($row[$f + 1] !== NULL) {
+                    $this->taken[$f] = array($row[0], $row[$f + 1]);
+                }
+            }
+        }
+        $this->last = $entry;
+        $index = $this->bucket($row[0]);
+        $held = count($this->buckets);
+        if($held > 0 && $this->buckets[$held - 1][0] == $index) {
+            $this->buckets[$held - 1][1][] = $entry;
+            return self::rows($picked);
+        }
+        $this->buckets[] = array($index, array($entry));
+        if($this->mode == GroupType::m4 && $held == 1) {
+            $bucket = array_shift($this->buckets);
+            $picked = array_merge($picked, self::withoutFirst($this->pickM4($bucket[1])));
+        } else if($held == 2) {
+            $bucket = array_shift($this->buckets);
+            $picked = array_merge($picked, self::withoutFirst($this->pickLttb($bucket[1], $this->buckets[0][1])));
+        }
+        return self::rows($picked);
+    }
+
+    // the rest of the rows picked, ending with the last
+    public function flush() {
+        $picked = array();
+        while($this->buckets) {
+            $bucket = array_shift($this->buckets);
+            if($this->mode == GroupType::m4) {
+                $picked = array_merge($picked, $this->pickM4($bucket[1]));
+            } else {
+                // the last row stands in for the bucket after the last
+                $after = $this->buckets ? $this->buckets[0][1] : array($this->last);
+                $picked = array_merge($picked, $this->pickLttb($bucket[1], $after));
+            }
+        }
+        $picked = self::withoutFirst($picked);
+        // as is the last row
+        if($this->last !== NULL && $this->last[0] != 0
+                && (!$picked || $picked[count($picked) - 1][0] != $this->last[0])) {
+            $picked[] = $this->last;
+        }
+        return self::rows($picked);
+    }
+
+    private function bucket($dateTime) {
+        if($this->slice <= 0) {
+            return 0;
+        }
+        return min($this->count - 1, (int) floor(($dateTime - $this->start) / $this->slice));
+    }
+
+    private function pickLttb($entries, $after) {
+        $picked = array();
+        for($f = 0; $f < $this->fields; $f++) {
+            $column = $f + 1;
+            $n = 0;
+            $cx = 0;
+            $cy = 0;
+            foreach($after as $entry) {
+                if($entry[1][$column] !== NULL) {
+                    $cx += $entry[1][0];
+                    $cy += $entry[1][$column];
+                    $n++;
+                }
+            }
+            if($n == 0) {
+                continue;
+            }
+            $cx /= $n;
+            $cy /= $n;
+            list($ax, $ay) = $this->taken[$f] !== NULL ? $this->taken[$f] : array($cx, $cy);
+            $best = NULL;
+            $bestArea = -1;
+            foreach($entries as $entry) {
+                $row = $entry[1];
+                if($row[$column] === NULL) {
+                    continue;
+                }
+                $area = abs(($ax - $cx) * ($row[$column] - $ay) - ($ax - $row[0]) * ($cy - $ay));
+                if($area > $bestArea) {
+                    $best = $entry;
+                    $bestArea = $area;
+                }
+            }
+            if($best !== NULL) {
+                $this->taken[$f] = array($best[1][0], $best[1][$column]);
+                $picked[] = $best;
+            }
+        }
+        return self::inOrder($picked);
+    }
+
+    private function pickM4($entries) {
+        $picked = array($entries[0], $entries[count($entries) - 1]);
+        for($f = 0; $f < $this->fields; $f++) {
+            $column = $f + 1;
+            $min = NULL;
+            $max = NULL;
+            foreach($entries as $entry) {
+                $value = $entry[1][$column];
+                if($value === NULL) {
+                    continue;
+                }
+                if($min === NULL || $value < $min[1][$column]) $min = $entry;
+                if($max === NULL || $value > $max[1][$column]) $max = $entry;
+            }
+            if($min !== NULL) {
+                $picked[] = $min;
+                $picked[] = $max;
+            }
+        }
+        return self::inOrder($picked);
+    }
+
+    // rows are added oldest first so their sequence is their order
+    private static function inOrder($entries) {
+        $unique = array();
+        foreach($entries as $entry) {
+            $unique[$entry[0]] = $entry;
+        }
+        ksort($unique);
+        return array_values($unique);
+    }
+
+    private static function withoutFirst($entries) {
+        return array_values(array_filter($entries, function($entry) {
+            return $entry[0] != 0;
+        }));
+    }
+
+    private static function rows($entries) {
+        return array_map(function($entry) {
+            return $entry[1];
+        }, $entries);
+    }
+}
+
+?>
@@ -43,20 +43,62 @@ abstract class Entity {
      * Delete records before a certain time.
      *
      * @param dateTime the date in seconds since epoch
+     * @param chunkSeconds delete at most this many seconds of records per statement (optional)
+     * @param timeBudget stop starting new chunks after this many seconds (optional)
      */
-    public abstract function deleteRecordsBeforeDateTime($dateTime);
+    public abstract function deleteRecordsBeforeDateTime($dateTime, $chunkSeconds=NULL, $timeBudget=NULL);
 
     protected function applyRetentionPolicy() {
         
         if(array_key_exists('retentionPolicy', $this->entityConfig)) {
             $policyConfig = $this->entityConfig['retentionPolicy'];
-            if($policyConfig['trigger'] == 'update') {
+            // a chunked one waits for applyDeferredRetentionPolicy()
+            if($policyConfig['trigger'] == 'update' && !self::isChunked($policyConfig)) {
                 $policy = EntityRetentionPolicyFactory::createEntityRetentionPolicy($policyConfig);
                 $policy->applyPolicy($this);
             }
         }
     }
 
+    /**
+     * For the "everyNthUpdate" trigger, applies the retention policy after roughly one in every
+     * "every" updates, and for the "update" trigger with "chunkSeconds", after every update.
+     * Called once the update is committed so it doesn't hold up the insert, and so the chunks are
+     * deleted one short statement at a time rather than all in the update's transaction.
+     */
+    public function applyDeferredRetentionPolicy() {
+        if(array_key_exists('retentionPolicy', $this->entityConfig)) {
+            $policyConfig = $this->entityConfig['retentionPolicy'];
+            if($policyConfig['trigger'] == 'update' && self::isChunked($policyConfig)) {
+                $policy = EntityRetentionPolicyFactory::createEntityRetentionPolicy($policyConfig);
+                $policy->applyPolicy($this);
+            } else if($policyConfig['trigger'] == 'everyNthUpdate') {
+                $every = array_key_exists('every', $policyConfig) ? (int) $policyConfig['every'] : 100;
+                // requests share no state, so pick one at random
+                if($every <= 1 || mt_rand(1, $every) == 1) {
+                    $policy = EntityRetentionPolicyFactory::createEntityRetentionPolicy($policyConfig);
+                    $policy->applyPolicy($this);
+                }
+            }
+        }
+    }
+
+    protected static function isChunked($policyConfig) {
+        return array_key_exists('chunkSeconds', $policyConfig) && $policyConfig['chunkSeconds'];
+    }
+
+    /**
+     * Applies the retention policy whatever its trigger, i.e. for the "schedule" trigger from
+     * prune.php.
+     */
+    public function applyRetention() {
+        if(!array_key_exists('retentionPolicy', $this->entityConfig)) {
+            throw new EntityConfigurationException("No retentionPolicy configured for entity ID: $this->entityId");
+        }
+        $policy = EntityRetentionPolicyFactory::createEntityRetentionPolicy($this->entityConfig['retentionPolicy']);
+        $policy->applyPolicy($this);
+    }
+
     protected abstract function performInsert($data);
 }
 
@@ -67,4 +109,7 @@ class EntitySecurityException extends EntityException { }
 
 class EntityConfigurationException extends EntityException { }
 
+// the request can't be applied to what's stored, i.e. the base of a delta is missing
+class EntityConflictException extends EntityException { }
+
 ?>
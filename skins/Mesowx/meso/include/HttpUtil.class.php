@@ -9,6 +9,20 @@ class HttpUtil {
         header("Pragma: no-cache");
     }
 
+    // for a response that will never change
+    public static function sendCacheForeverHeaders() {
+        header("Cache-Control: public, max-age=31536000, immutable");
+        header("Expires: ". gmdate("D, d M Y H:i:s", time() + 31536000) ." GMT");
+        header_remove("Pragma");
+    }
+
+    // for a response that may yet change, but not often
+    public static function sendCacheHeaders($maxAge) {
+        header("Cache-Control: public, max-age=$maxAge");
+        header("Expires: ". gmdate("D, d M Y H:i:s", time() + $maxAge) ." GMT");
+        header_remove("Pragma");
+    }
+
     public static function send405($message) {
         self::sendError("HTTP/1.0 405 Method Not Allowed", $message);
     }
@@ -21,6 +35,14 @@ class HttpUtil {
         self::sendError("HTTP/1.0 403 Forbidden", $message);
     }
 
+    public static function send409($message) {
+        self::sendError("HTTP/1.0 409 Conflict", $message);
+    }
+
+    public static function send413($message) {
+        self::sendError("HTTP/1.0 413 Request Entity Too Large", $message);
+    }
+
     public static function send500($message) {
         self::sendError("HTTP/1.0 500 Internal Server Error", $message);
     }
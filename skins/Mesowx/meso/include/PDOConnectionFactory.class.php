@@ -42,6 +42,10 @@ interface DBHelper {
     function quoteIdentifier($identifier);
     
     function quoteIdentifiers($identifiers);
+
+    // the start and end of an insert statement that skips the rows whose primary key is already
+    // stored, rather than failing the whole statement (and the transaction around it)
+    function insertIgnoringDuplicates($quotedPrimaryKey);
 }
 
 abstract class AbstractDBHelper extends PDO implements DBHelper {
@@ -61,6 +65,11 @@ class MySQLPDOHelper extends AbstractDBHelper implements DBHelper {
     public function quoteIdentifier($column) {
         return self::IDENTIFIER_QUOTE . $column . self::IDENTIFIER_QUOTE;
     }
+
+    public function insertIgnoringDuplicates($quotedPrimaryKey) {
+        // not "insert ignore", which would turn every other error into a warning too
+        return array("insert into", "on duplicate key update $quotedPrimaryKey = $quotedPrimaryKey");
+    }
 }
 
 class SQLitePDOHelper extends AbstractDBHelper implements DBHelper {
@@ -70,6 +79,10 @@ class SQLitePDOHelper extends AbstractDBHelper implements DBHelper {
     public function quoteIdentifier($column) {
         return self::IDENTIFIER_QUOTE . $column . self::IDENTIFIER_QUOTE;
     }
+
+    public function insertIgnoringDuplicates($quotedPrimaryKey) {
+        return array("insert or ignore into", "");
+    }
 }
 
 ?>
@@ -7,6 +7,9 @@ class TableEntity extends Entity {
 
     protected $db;
 
+    // the watermark of each entity, see getWatermark()
+    const WATERMARK_TABLE = 'mesowx_watermark';
+
     // only number supported for now
     protected static $COLUMN_SQL_TYPES = array(
         'number' => 'real',
@@ -24,16 +27,35 @@ class TableEntity extends Entity {
         return $db;
     }
 
-    public function deleteRecordsBeforeDateTime($dateTime) {
+    public function deleteRecordsBeforeDateTime($dateTime, $chunkSeconds=NULL, $timeBudget=NULL) {
         // XXX dateTime is for now assumed to be the primary key
         $pkColumn = $this->getPrimaryKeyColumn();
         $columns = $this->entityConfig['columns'];
         $pkUnit = $columns[$pkColumn]['unit'];
-        // make sure the dateTime is converted to the appropriate unit
-        $windowMin = UnitConvert::getSqlFormula($dateTime, Unit::s, $pkUnit);
         $table = $this->getTable();
-        $deleteSql = "delete from $table where $pkColumn < $windowMin";
-        $this->db->query($deleteSql);
+        if(!$chunkSeconds) {
+            // make sure the dateTime is converted to the appropriate unit
+            $windowMin = UnitConvert::getSqlFormula($dateTime, Unit::s, $pkUnit);
+            $deleteSql = "delete from $table where $pkColumn < $windowMin";
+            $this->db->query($deleteSql);
+            return;
+        }
+        // walk forward from the oldest record a chunk at a time, keeping each delete short
+        $oldest = $this->db->query("select min($pkColumn) from $table")->fetchColumn();
+        if($oldest === NULL || $oldest === false) {
+            return;
+        }
+        $chunkStart = UnitConvert::convert($oldest, $pkUnit, Unit::s);
+        $started = microtime(true);
+        while($chunkStart < $dateTime) {
+            $chunkEnd = min($chunkStart + $chunkSeconds, $dateTime);
+            $windowMin = UnitConvert::getSqlFormula($chunkEnd, Unit::s, $pkUnit);
+            $this->db->query("delete from $table where $pkColumn < $windowMin");
+            $chunkStart = $chunkEnd;
+            if($timeBudget && microtime(true) - $started > $timeBudget) {
+                break;
+            }
+        }
     }
 
     public function upsert($data) {
@@ -47,6 +69,61 @@ class TableEntity extends Entity {
             $this->db->rollBack();
             throw $e;
         }
+        try {
+            $this->applyDeferredRetentionPolicy();
+        } catch(Exception $e) {
+            // the update itself went in, it'll be pruned another time
+            error_log("Unable to apply retention policy to entity $this->entityId: " . $e->getMessage());
+        }
+    }
+
+    /**
+     * The dateTime, in seconds, up to which the sync has confirmed the entity has every record, or
+     * NULL if it hasn't.
+     */
+    public function getWatermark() {
+        $table = self::WATERMARK_TABLE;
+        try {
+            $query = $this->db->prepare("select dateTime from $table where entityId = ?");
+            $query->execute(array($this->entityId));
+            $watermark = $query->fetchColumn();
+        } catch(PDOException $e) {
+            // nothing has been synced with a watermark yet
+            return NULL;
+        }
+        return $watermark === false ? NULL : $watermark;
+    }
+
+    /**
+     * Move the watermark on to $to, given the sync says it has sent every record after $from up to
+     * $to, as long as that carries on from the watermark, or $from is 0, everything.
+     */
+    public function extendWatermark($from, $to) {
+        if(!is_numeric($from) || !is_numeric($to)) {
+            throw new EntityException("Invalid watermark: '$from' to '$to'");
+        }
+        $table = self::WATERMARK_TABLE;
+        $db = $this->db;
+        $entityId = $this->entityId;
+        $extend = function() use ($db, $table, $entityId, $from, $to) {
+            if($from == 0) {
+                list($insert, $onDuplicate) = $db->insertIgnoringDuplicates('entityId');
+                $db->prepare("$insert $table(entityId, dateTime) values (?, ?) $onDuplicate")
+                        ->execute(array($entityId, $to));
+            }
+            $db->prepare("update $table set dateTime = ? where entityId = ? and dateTime >= ? and dateTime < ?")
+                    ->execute(array($to, $entityId, $from, $to));
+        };
+        try {
+            $extend();
+        } catch(PDOException $e) {
+            // table doesn't exist eror code: 42S02
+            if($e->getCode() != '42S02') {
+                throw $e;
+            }
+            $db->exec("create table $table (entityId varchar(64) not null, dateTime real not null, primary key (entityId))");
+            $extend();
+        }
     }
 
     public function getTable() {
@@ -65,6 +142,15 @@ class TableEntity extends Entity {
 
     protected function performInsert($data) {
 
+        if(self::isColumnar($data)) {
+            $this->performColumnarInsert($data);
+            return;
+        }
+        if(self::isDelta($data)) {
+            $this->performInsert($this->applyDeltas($data['delta']));
+            return;
+        }
+
         $columns = $this->getColumnNames();
 
         // if we just have one row wrap it in an array for easier processing
@@ -72,9 +158,15 @@ class TableEntity extends Entity {
         if(!is_array(current($data))) {
             $data = array($data);
         }
-        // get the keys that are the intersection of columns in the data and defined for the entity
-        // use the first entry in the array if more than one (the rest MUST match)
-        $insertColumns = array_values(array_intersect(array_keys($data[0]), $columns));
+        // get the keys that are the intersection of columns in the data and defined for the entity,
+        // across all of the records as nulls may have been left out of some of them
+        $dataColumns = array();
+        foreach($data as $record) {
+            if(is_array($record)) {
+                $dataColumns += array_flip(array_keys($record));
+            }
+        }
+        $insertColumns = array_values(array_intersect(array_keys($dataColumns), $columns));
 
         // TODO how to handle this? is it an error? null missing values?
         /*if( count($insertColumns) !== count($columns) ) {
@@ -82,16 +174,103 @@ class TableEntity extends Entity {
         }*/
 
         $table = $this->getTable();
-        $insertSql = self::buildInsertSql($this->db, $table, $insertColumns);
+        $insertSql = $this->buildInsertSql($this->db, $table, $insertColumns);
+
+        $db = $this->db;
+        $this->executeCreatingTable(function() use ($db, $insertSql, $insertColumns, $data) {
+            TableEntity::executeInsert($db, $insertSql, $insertColumns, $data);
+        });
+    }
 
+    /**
+     * Columnar data names the columns once and sends each row as an array of
+     * values in the same order, i.e. {"columns":["dateTime","outTemp"],"rows":[[1,2],[3,4]]}
+     */
+    protected static function isColumnar($data) {
+        return is_array($data) && array_key_exists('columns', $data) && array_key_exists('rows', $data);
+    }
+
+    protected function performColumnarInsert($data) {
+
+        $columns = $this->getColumnNames();
+
+        // the positions of the data columns that are defined for the entity
+        $positions = array_keys(array_intersect($data['columns'], $columns));
+        $insertColumns = array();
+        foreach($positions as $position) {
+            $insertColumns[] = $data['columns'][$position];
+        }
+
+        $table = $this->getTable();
+        $insertSql = $this->buildInsertSql($this->db, $table, $insertColumns);
+
+        $db = $this->db;
+        $columnCount = count($data['columns']);
+        $rows = $data['rows'];
+        $this->executeCreatingTable(function() use ($db, $insertSql, $positions, $columnCount, $rows) {
+            TableEntity::executeColumnarInsert($db, $insertSql, $positions, $columnCount, $rows);
+        });
+    }
+
+    /**
+     * Delta data holds only what changed from one record to the next, starting from the stored
+     * record with the primary key "base", i.e.
+     * {"delta":{"base":1000,"records":[{"dateTime":1002,"outTemp":3},{"dateTime":1004}]}}
+     */
+    protected static function isDelta($data) {
+        return is_array($data) && array_key_exists('delta', $data) && is_array($data['delta'])
+                && array_key_exists('records', $data['delta']);
+    }
+
+    /**
+     * Rebuild the full records from the deltas, throws an EntityConflictException when the base
+     * record isn't stored so the sender knows to send the records in full.
+     */
+    protected function applyDeltas($delta) {
+        $base = array_key_exists('base', $delta) ? $delta['base'] : NULL;
+        $current = array();
+        if($base !== NULL) {
+            $pkColumn = $this->db->quoteIdentifier($this->getPrimaryKeyColumn());
+            $table = $this->getTable();
+            try {
+                $query = $this->db->prepare("select * from $table where $pkColumn = ?");
+                $query->execute(array($base));
+                $current = $query->fetch(PDO::FETCH_ASSOC);
+            } catch(PDOException $e) {
+                // table doesn't exist eror code: 42S02
+                if($e->getCode() != '42S02') {
+                    throw $e;
+                }
+                $current = false;
+            }
+            if(!$current) {
+                throw new EntityConflictException("Delta base $base not found, send the records in full");
+            }
+        }
+        $records = array();
+        foreach($delta['records'] as $record) {
+            if(!is_array($record)) {
+                throw new EntityException('All records in the request must be objects');
+            }
+            // the changed values, nulls included, replace the previous ones
+            $current = array_merge($current, $record);
+            $records[] = $current;
+        }
+        return $records;
+    }
+
+    /**
+     * Run the insert, creating the table and trying again if it doesn't exist.
+     */
+    protected function executeCreatingTable($insert) {
         try {
-            self::executeInsert($this->db, $insertSql, $insertColumns, $data);
+            $insert();
         } catch(PDOException $e) {
             // table doesn't exist eror code: 42S02
             if($e->getCode() == '42S02') {
                 // attempt to create the table and retry
                 $this->createTable();
-                self::executeInsert($this->db, $insertSql, $insertColumns, $data);
+                $insert();
             } else {
                 // re-throw all other errors encountered
                 // XXX wrap in EntityConfigurationException instead?
@@ -100,31 +279,62 @@ class TableEntity extends Entity {
         }
     }
 
-    protected static function buildInsertSql($db, $table, $insertColumns) {
+    protected function buildInsertSql($db, $table, $insertColumns) {
 
         // wrap column names in quotes
         $quoted_column_names = $db->quoteIdentifiers($insertColumns);
 
-        $sql = "insert into $table(". implode(',', $quoted_column_names) .") values (";
+        // records already stored are skipped, so a batch that's sent again (the response to it was
+        // lost, or the sender restarted before it knew it was stored) doesn't fail for them and
+        // take the new records in it down with it
+        list($insert, $onDuplicate) = $db->insertIgnoringDuplicates(
+                $db->quoteIdentifier($this->getPrimaryKeyColumn()));
+        $sql = "$insert $table(". implode(',', $quoted_column_names) .") values (";
         // create ? binding placeholders for each value
         $sql .= implode(',', array_fill(0, count($insertColumns), '?')) . ")";
+        if($onDuplicate) {
+            $sql .= " $onDuplicate";
+        }
 
         return $sql;
     }
 
-    protected static function executeInsert($db, $sql, $insertColumns, $data) {
+    public static function executeInsert($db, $sql, $insertColumns, $data) {
 
         $query = $db->prepare($sql);
 
         foreach($data as $record) {
 
-            $insert_data = array_intersect_key($record, array_flip($insertColumns));
+            if(!is_array($record)) {
+                throw new EntityException('All records in the request must be objects');
+            }
+
+            // columns missing from the record are null
+            $insert_data = array();
+            foreach($insertColumns as $column) {
+                $insert_data[] = array_key_exists($column, $record) ? $record[$column] : NULL;
+            }
+
+            $query->execute($insert_data);
+        }
+    }
+
+    public static function executeColumnarInsert($db, $sql, $positions, $columnCount, $rows) {
+
+        $query = $db->prepare($sql);
+
+        foreach($rows as $row) {
+
+            if(!is_array($row) || count($row) !== $columnCount) {
+                throw new EntityException('Every row in the request must have a value for each column');
+            }
 
-            if(count($insert_data) !== count($insertColumns)) {
-                throw new EntityException('All records in the request must have at least the same columns');
+            $values = array();
+            foreach($positions as $position) {
+                $values[] = $row[$position];
             }
 
-            $query->execute(array_values($insert_data));
+            $query->execute($values);
         }
     }
 
@@ -5,6 +5,8 @@ require_once('EntityRetentionPolicy.class.php');
 class WindowRetentionPolicy implements EntityRetentionPolicy {
 
     protected $windowSize;
+    protected $chunkSeconds;
+    protected $timeBudget;
 
     public function __construct($policyConfig) {
         $windowSize = $policyConfig['windowSize'];
@@ -13,11 +15,15 @@ class WindowRetentionPolicy implements EntityRetentionPolicy {
             throw new EntityException("Invalid windowSize, must be numeric: '$windowSize'");
         }
         $this->windowSize = $windowSize;
+        // optionally delete in chunks of this many seconds of records, stopping after timeBudget
+        // seconds, whatever's left goes next time
+        $this->chunkSeconds = array_key_exists('chunkSeconds', $policyConfig) ? $policyConfig['chunkSeconds'] : NULL;
+        $this->timeBudget = array_key_exists('timeBudget', $policyConfig) ? $policyConfig['timeBudget'] : NULL;
     }
 
     public function applyPolicy(Entity $entity) {
         $windowMin = time() - $this->windowSize;
-        $entity->deleteRecordsBeforeDateTime($windowMin);
+        $entity->deleteRecordsBeforeDateTime($windowMin, $this->chunkSeconds, $this->timeBudget);
     }
 }
 
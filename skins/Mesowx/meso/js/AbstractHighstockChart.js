@@ -57,7 +57,11 @@ meso.AbstractHighstockChart = (function() {
         // XXX don't like this parameter either, caching of stats on the server could help eliminate
         // the need for this, or perhaps the total number of data points could be calculated ahead of time
         // along with the extremes query?
-        maxStatRange: null
+        maxStatRange: null,
+        // When set, the navigator series of a lazy chart is loaded by picking a point or so per pixel
+        // from the rows instead of averaging them, so the peaks still show over the whole range. Either
+        // 'lttb' (largest triangle three buckets) or 'm4' (first, last, min and max), see data.php
+        navigatorDownsample: null
     };
 
     //////////////// constructor
@@ -357,6 +361,21 @@ meso.AbstractHighstockChart = (function() {
         fieldDefs = [
             navigatorFieldDef
         ];
+        if(this._lazy && this.options.navigatorDownsample) {
+            // the dateTime is returned as the first column as when grouping
+            this._aggregateDataProvider.getData({
+                success: meso.Util.bind(this, this._handleNavigatorDataLoad),
+                data: fieldDefs,
+                group: {
+                    type: this.options.navigatorDownsample,
+                    value: Math.round(this.chart.plotSizeX / this.options.groupPixelWidth),
+                    unit: meso.Unit.ms
+                },
+                start: { value: Math.floor(min / 1000), type: 'datetime' },
+                end: { value: Math.ceil(max / 1000), type: 'datetime' }
+            });
+            return;
+        }
         this._fetchData(meso.Util.bind(this, this._handleNavigatorDataLoad), min, max, fieldDefs);
     };
 
@@ -2,15 +2,137 @@ var meso = meso || {};
 
 meso.AggregateDataProvider = (function() {
 
+    // the binary columnar form of data.php's rows, see ColumnEncoder.class.php
+    var COLUMNS_TYPE = 'application/x-mesowx-columns';
+    var COLUMN_FLOAT = 0;
+    var COLUMN_QUANTIZED = 1;
+    var COLUMN_DELTA = 2;
+    var LITTLE_ENDIAN = new Uint8Array(new Uint16Array([1]).buffer)[0] === 1;
+
+    // Set binary to ask data.php for its rows in the binary form rather than JSON, they're
+    // decoded into the same rows.
     var AggregateDataProvider = function(options) {
         this._baseUrl = options.baseUrl;
+        this._binary = !!options.binary;
     };
 
     AggregateDataProvider.prototype.getData = function(query) {
         if( !query.success ) throw new Error("Must supply a success function");
         if( !query.data ) throw new Error("Must supply the data to return");
         var url = this._buildUrl(query);
-        $.getJSON(url, query.success);
+        this._fetch(url, function(data) {
+            query.success(data);
+        });
+    };
+    // calls success with the rows and the request
+    AggregateDataProvider.prototype._fetch = function(url, success) {
+        if( !this._binary ) {
+            $.ajax({
+                url : url,
+                dataType : 'json',
+                success : function(data, status, xhr) {
+                    success(data, xhr);
+                }
+            });
+            return;
+        }
+        var xhr = new XMLHttpRequest();
+        xhr.open('GET', url);
+        xhr.responseType = 'arraybuffer';
+        xhr.setRequestHeader('Accept', COLUMNS_TYPE + ', application/json;q=0.5');
+        xhr.onload = function() {
+            if( xhr.status != 200 ) return;
+            var data;
+            if( (xhr.getResponseHeader('Content-Type') || '').indexOf(COLUMNS_TYPE) === 0 ) {
+                data = AggregateDataProvider.toRows(AggregateDataProvider.decodeColumns(xhr.response));
+            } else {
+                // a data.php that only knows JSON
+                data = JSON.parse(new TextDecoder().decode(xhr.response));
+            }
+            success(data, xhr);
+        };
+        xhr.send();
+    };
+
+    // The columns of a binary response, each a Float64Array with NaN for null. The response is a
+    // 16 byte header ("MWXC", version, column count, row count) then each column, an 8 byte
+    // header (kind, width, decimals, length) and its values, padded to 8 bytes. A column is
+    // float64, or int16/int32 of the value * 10^decimals, either the values (the lowest is
+    // null) or the first as a float64 then the difference of each from the one before it. All
+    // little-endian.
+    AggregateDataProvider.decodeColumns = function(buffer) {
+        var view = new DataView(buffer);
+        if( String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3)) !== 'MWXC' ) {
+            throw new Error("Not a binary data response");
+        }
+        var columnCount = view.getUint8(5);
+        var rowCount = view.getUint32(8, true);
+        var offset = 16;
+        var columns = [];
+        for( var c=0; c<columnCount; c++ ) {
+            var kind = view.getUint8(offset);
+            var width = view.getUint8(offset + 1);
+            var scale = Math.pow(10, view.getInt8(offset + 2));
+            var length = view.getUint32(offset + 4, true);
+            offset += 8;
+            var column;
+            if( kind === COLUMN_FLOAT ) {
+                column = LITTLE_ENDIAN
+                    ? new Float64Array(buffer, offset, rowCount)
+                    : readValues(view, offset, rowCount, 8);
+            } else if( kind === COLUMN_DELTA ) {
+                column = new Float64Array(rowCount);
+                if( rowCount ) {
+                    var deltas = readValues(view, offset + 8, rowCount - 1, width);
+                    var value = view.getFloat64(offset, true);
+                    column[0] = value / scale;
+                    for( var i=1; i<rowCount; i++ ) {
+                        value += deltas[i - 1];
+                        column[i] = value / scale;
+                    }
+                }
+            } else if( kind === COLUMN_QUANTIZED ) {
+                column = new Float64Array(rowCount);
+                var values = readValues(view, offset, rowCount, width);
+                var nullValue = -Math.pow(2, 8 * width - 1);
+                for( var i=0; i<rowCount; i++ ) {
+                    column[i] = values[i] === nullValue ? NaN : values[i] / scale;
+                }
+            } else {
+                throw new Error("Unknown column kind: " + kind);
+            }
+            columns.push(column);
+            offset += Math.ceil(length / 8) * 8;
+        }
+        return columns;
+    };
+    // the values as a typed array, a view of the buffer where the byte order allows
+    var readValues = function(view, offset, count, width) {
+        var type = width === 2 ? Int16Array : width === 4 ? Int32Array : Float64Array;
+        if( LITTLE_ENDIAN ) {
+            return new type(view.buffer, view.byteOffset + offset, count);
+        }
+        var values = new type(count);
+        for( var i=0; i<count; i++ ) {
+            values[i] = width === 2 ? view.getInt16(offset + i * 2, true)
+                : width === 4 ? view.getInt32(offset + i * 4, true)
+                : view.getFloat64(offset + i * 8, true);
+        }
+        return values;
+    };
+    // the columns as the rows data.php returns as JSON
+    AggregateDataProvider.toRows = function(columns) {
+        var rowCount = columns.length ? columns[0].length : 0;
+        var rows = new Array(rowCount);
+        for( var i=0; i<rowCount; i++ ) {
+            var row = new Array(columns.length);
+            for( var c=0; c<columns.length; c++ ) {
+                var value = columns[c][i];
+                row[c] = value === value ? value : null;
+            }
+            rows[i] = row;
+        }
+        return rows;
     };
     AggregateDataProvider.prototype._buildUrl = function(query) {
         var url = this._baseUrl;
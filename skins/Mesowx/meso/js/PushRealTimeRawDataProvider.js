@@ -0,0 +1,74 @@
+var meso = meso || {};
+
+meso.PushRealTimeRawDataProvider = (function() {
+
+    var DEFAULT_OPTIONS = {
+        url : null, // http(s):// for server-sent events, ws(s):// for a WebSocket
+        providedFields : null,
+        reconnectInterval : 5000 // WebSocket only, EventSource reconnects itself
+    }
+
+    var PushRealTimeRawDataProvider = function(options) {
+        meso.AbstractRealTimeRawDataProvider.call(this); // call super
+
+        options = meso.Util.applyDefaults(options, DEFAULT_OPTIONS);
+        this._url = options.url;
+        this._reconnectInterval = options.reconnectInterval;
+        this._providedFields = options.providedFields;
+        for(var field in this._providedFields) {
+            var providedField = this._providedFields[field];
+            if(!providedField.index) providedField.index = field;
+        }
+        this._connect();
+    };
+    // extend AbstractRealTimeDataProvider
+    var _super = meso.AbstractRealTimeRawDataProvider.prototype;
+    PushRealTimeRawDataProvider.prototype = Object.create( _super );
+
+    PushRealTimeRawDataProvider.prototype._connect = function() {
+        if(/^wss?:/.test(this._url)) {
+            var socket = new WebSocket(this._url);
+            socket.onmessage = meso.Util.bind(this, this._handleMessage);
+            socket.onclose = meso.Util.bind(this, function() {
+                setTimeout(meso.Util.bind(this, this._connect), this._reconnectInterval);
+            });
+        } else {
+            var source = new EventSource(this._url);
+            source.onmessage = meso.Util.bind(this, this._handleMessage);
+        }
+    };
+    PushRealTimeRawDataProvider.prototype._handleMessage = function(event) {
+        this._notifySubscribers(JSON.parse(event.data));
+    };
+    PushRealTimeRawDataProvider.prototype._adaptData = function(rawData, desiredData) {
+        var adapted = desiredData.map(function(fieldDef) {
+            var meta = this._providedFields[fieldDef.fieldId];
+            var value = meta ? rawData[meta.index] : null;
+            if( value === undefined || value === null ) return null;
+            if( meta.unit !== fieldDef.unit ) {
+                value = meta.unit.convert[fieldDef.unit](value);
+            }
+            return meso.Util.round(value, fieldDef.decimals);
+        }, this);
+        return adapted;
+    };
+
+    return PushRealTimeRawDataProvider;
+
+})();
+
+// example configuration, the push_port of [[Raw]] in weewx.conf
+
+    /*Config.realTimeDataProvider = new meso.PushRealTimeRawDataProvider({
+        url : 'http://wx.example.com:8081/raw',
+        providedFields: {
+            "dateTime" : { unit: meso.Unit.s },
+            "outTemp" : { unit: mesowx.Unit.c },
+            "dewpoint" : { unit: mesowx.Unit.c },
+            "rainRate" : { unit: mesowx.Unit.mmHr },
+            "windSpeed" : { unit: mesowx.Unit.kph },
+            "windDir" : { unit: mesowx.Unit.deg },
+            "outHumidity" : { unit: mesowx.Unit.perc },
+            "barometer" : { unit: mesowx.Unit.hPa },
+        }
+    });*/
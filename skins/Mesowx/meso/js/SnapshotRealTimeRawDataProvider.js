@@ -0,0 +1,60 @@
+var meso = meso || {};
+
+meso.SnapshotRealTimeRawDataProvider = (function() {
+
+    var DEFAULT_OPTIONS = {
+        url : 'latest.json', // written by the weewx RawService (snapshot = true)
+        recentUrl : 'last24h.json', // the packets of the last snapshot_hours, also by RawService
+        providedFields : null,
+        pollingInterval : 2000 // 2 seconds
+    }
+
+    // polls a static latest.json, only a changed file is downloaded again
+    var SnapshotRealTimeRawDataProvider = function(options) {
+        options = meso.Util.applyDefaults(options, DEFAULT_OPTIONS);
+        this._pollingInterval = options.pollingInterval;
+        this._recentUrl = options.recentUrl;
+        meso.PushRealTimeRawDataProvider.call(this, options); // call super
+    };
+    // extend PushRealTimeRawDataProvider, for the adapting of the packets
+    var _super = meso.PushRealTimeRawDataProvider.prototype;
+    SnapshotRealTimeRawDataProvider.prototype = Object.create( _super );
+
+    SnapshotRealTimeRawDataProvider.prototype._connect = function() {
+        $.ajax({
+            url : this._url,
+            dataType : 'json',
+            ifModified : true,
+            // unchanged (304) leaves data undefined, which is ignored
+            success : meso.Util.bind(this, this._notifySubscribers),
+            complete : meso.Util.bind(this, function() {
+                setTimeout(meso.Util.bind(this, this._connect), this._pollingInterval);
+            })
+        });
+    };
+
+    // the packets since start (in seconds) from last24h.json, adapted the same as the ones
+    // passed to the subscribers, errorCallback is called when the file can't be had
+    SnapshotRealTimeRawDataProvider.prototype.getRecent = function(callback, desiredData, start, errorCallback) {
+        $.ajax({
+            url : this._recentUrl,
+            dataType : 'json',
+            success : meso.Util.bind(this, function(recent) {
+                var data = [];
+                recent.data.forEach(function(row) {
+                    if(row[0] < start) return;
+                    var record = {};
+                    recent.fields.forEach(function(field, index) {
+                        record[field] = row[index];
+                    });
+                    data.push(this._adaptData(record, desiredData));
+                }, this);
+                callback(data);
+            }),
+            error : errorCallback
+        });
+    };
+
+    return SnapshotRealTimeRawDataProvider;
+
+})();
@@ -0,0 +1,122 @@
+var meso = meso || {};
+
+meso.TileDataProvider = (function() {
+
+    // as TimeTile in AggregateQuerySpec.class.php
+    var TILE_SPANS = [31104000, 2592000, 86400];
+    var TILE_MAX_GROUPS = 1440;
+
+    var DEFAULT_OPTIONS = {
+        baseUrl : null,
+        maxTiles : 16, // any more and it's asked for in one go instead
+        maxCachedTiles : 64 // the tiles kept, the least recently used go first
+    }
+
+    // Answers the queries grouped by seconds from fixed tiles of data.php, the tiles that are
+    // over and complete are kept, so only the current one is fetched again, and can be cached by
+    // the browser and any proxies too. Everything else is passed on to AggregateDataProvider.
+    var TileDataProvider = function(options) {
+        options = meso.Util.applyDefaults(options, DEFAULT_OPTIONS);
+        meso.AggregateDataProvider.call(this, options); // call super
+        this._maxTiles = options.maxTiles;
+        this._maxCachedTiles = options.maxCachedTiles;
+        // the data of the tiles that are over and complete, by url
+        this._tiles = {};
+        // their urls, the least recently used first
+        this._tileUrls = [];
+    };
+    // extend AggregateDataProvider
+    var _super = meso.AggregateDataProvider.prototype;
+    TileDataProvider.prototype = Object.create( _super );
+
+    TileDataProvider.getTileSpan = function(groupSeconds) {
+        for(var i=0; i<TILE_SPANS.length; i++) {
+            var span = TILE_SPANS[i];
+            if(span % groupSeconds === 0 && span / groupSeconds <= TILE_MAX_GROUPS) {
+                return span;
+            }
+        }
+        return null;
+    };
+
+    TileDataProvider.prototype.getData = function(query) {
+        var span = this._getQueryTileSpan(query);
+        var first = span && Math.floor(query.start.value / span);
+        var last = span && Math.floor(query.end.value / span);
+        if( !span || last - first >= this._maxTiles ) {
+            return _super.getData.call(this, query);
+        }
+        if( !query.success ) throw new Error("Must supply a success function");
+        var tiles = [];
+        var pending = last - first + 1;
+        var tileLoaded = meso.Util.bind(this, function() {
+            if(--pending === 0) {
+                query.success(this._trim([].concat.apply([], tiles), query));
+            }
+        });
+        for(var index=first; index<=last; index++) {
+            this._getTile(query, index, tiles, index - first, tileLoaded);
+        }
+    };
+    // the seconds in each tile, or null if the query can't be answered from tiles
+    TileDataProvider.prototype._getQueryTileSpan = function(query) {
+        var group = query.group;
+        if( !group || group.type !== 'seconds' || !group.value || query.limit || query.order === 'desc'
+                || !query.start || query.start.type === 'ago' || !query.end || query.end.type === 'ago' ) {
+            return null;
+        }
+        return TileDataProvider.getTileSpan(group.value);
+    };
+    TileDataProvider.prototype._getTile = function(query, index, tiles, position, callback) {
+        var url = this._buildTileUrl(query, index);
+        if( this._tiles[url] ) {
+            this._touchTile(url);
+            tiles[position] = this._tiles[url];
+            callback();
+            return;
+        }
+        this._fetch(url, meso.Util.bind(this, function(data, xhr) {
+            tiles[position] = data;
+            if( /immutable/.test(xhr.getResponseHeader('Cache-Control')) ) {
+                this._tiles[url] = data;
+                this._touchTile(url);
+            }
+            callback();
+        }));
+    };
+    // mark the tile as the most recently used, dropping the least recently used over the limit
+    TileDataProvider.prototype._touchTile = function(url) {
+        var i = this._tileUrls.indexOf(url);
+        if( i != -1 ) {
+            this._tileUrls.splice(i, 1);
+        }
+        this._tileUrls.push(url);
+        while( this._tileUrls.length > this._maxCachedTiles ) {
+            delete this._tiles[this._tileUrls.shift()];
+        }
+    };
+    TileDataProvider.prototype._buildTileUrl = function(query, index) {
+        var url = this._baseUrl;
+        url += url.indexOf('?') == -1 ? '?' : '&';
+        url += this._buildDataUrlParam(query.data);
+        url += '&group='+query.group.value+':seconds';
+        if(query.group.unit) {
+            url += ':'+query.group.unit;
+        }
+        url += '&tile='+index;
+        return url;
+    };
+    // the groups from the one the start is in to the end, the tiles cover whole days or more
+    TileDataProvider.prototype._trim = function(rows, query) {
+        var scale = query.group.unit == meso.Unit.ms ? 1000 : 1;
+        var slice = query.group.value;
+        var from = Math.floor(query.start.value / slice) * slice * scale;
+        var to = query.end.value * scale;
+        return rows.filter(function(row) {
+            return row[0] >= from && row[0] <= to;
+        });
+    };
+
+    return TileDataProvider;
+
+})();
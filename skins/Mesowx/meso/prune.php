@@ -0,0 +1,61 @@
+<?php
+
+// if display_errors = on, errors will result in a 200 status, so setting the
+// status to 500 ahead of time, then resetting to 200 on success
+// see: https://bugs.php.net/bug.php?id=50921
+header('HTTP/1.0 500 Internal Server Error');
+
+require_once('include/Unit.class.php');
+
+/*
+
+Apply an entity's retention policy, whatever its trigger. Meant for the "schedule" trigger so that
+pruning happens at a time of your choosing rather than as part of each update, see
+mesowx.py --prune-remote.
+
+Input Parameters:
+- entity_id - the entity to prune
+- security_key - the entity's update security key
+
+*/
+
+require_once 'include/TableEntity.class.php';
+require_once 'include/HttpUtil.class.php';
+require_once 'include/JsonConfig.class.php';
+
+if($_SERVER['REQUEST_METHOD'] != 'POST') {
+    HttpUtil::send405('Request method must be a POST');
+    exit;
+}
+
+if(!array_key_exists('entity_id', $_POST)) {
+    HttpUtil::send400('Must specify an entity_id');
+    exit;
+}
+$entity_id = $_POST['entity_id'];
+
+if(!array_key_exists('security_key', $_POST)) {
+    HttpUtil::send400('Must specify a security_key');
+    exit;
+}
+$security_key = $_POST['security_key'];
+
+$config = JsonConfig::getInstance();
+
+try {
+    // TODO need a factory to create this, only support TableEnity for now
+    $entity = new TableEntity($entity_id, $config);
+    $entity->canUpdate($security_key);
+    $entity->applyRetention();
+    // success!
+    header('HTTP/1.0 200 OK');
+
+} catch(EntitySecurityException $e) {
+    HttpUtil::send403("Unable to prune entity: " . $e->getMessage());
+} catch(EntityException $e) {
+    HttpUtil::send400("Unable to prune entity: " . $e->getMessage());
+} catch(Exception $e) {
+    HttpUtil::send500("Unable to prune entity due to unexpected error: " . $e->getMessage());
+}
+
+?>
@@ -91,10 +91,7 @@ $dateTimeColumnUnit = $columnConfigs[$dateTimeColumn]['unit'];
 
 $timeUnit = property_exists($params, 'timeUnit') ? $params->timeUnit : NULL;
 
-$sql = "select $dateTimeColumnQuoted, ". implode(', ', $db->quoteIdentifiers($fieldIds)) ." from ". $db->quoteIdentifier($entity->getTable());
-
-// apply the start / end where clause
-$where = array();
+// apply the start / end
 $start = NULL;
 $end = NULL;
 if(property_exists($params, 'start') && $params->start) {
@@ -111,39 +108,14 @@ if(property_exists($params, 'end') && $params->end) {
         $end = time() + $end;
     }
 }
-if($start || $end) {
-    if($start) {
-        $startSql = ':start';
-        if($timeUnit) {
-            $startSql = UnitConvert::getSqlFormula($startSql, $timeUnit, $dateTimeColumnUnit);
-        }
-        $where[] = "$dateTimeColumnQuoted >= $startSql";
-    }
-    if($end) {
-        $endSql = ':end';
-        if($timeUnit) {
-            $endSql = UnitConvert::getSqlFormula($endSql, $timeUnit, $dateTimeColumnUnit);
-        }
-        $where[] = "$dateTimeColumnQuoted <= $endSql";
-    }
-}
-if(count($where) > 0) {
-    $sql .= " where " . join(" and ", $where);
+// the same in the units of the date time column
+$rangeStart = $start;
+$rangeEnd = $end;
+if($timeUnit) {
+    if($start) $rangeStart = UnitConvert::convert($start, $timeUnit, $dateTimeColumnUnit);
+    if($end) $rangeEnd = UnitConvert::convert($end, $timeUnit, $dateTimeColumnUnit);
 }
 
-
-// execute the query
-header( "X-Meso-Query: ". str_replace("\n", " ", $sql) . " (start: $start, end: $end)" );
-
-$_start = microtime(true);
-
-$stmt = $db->prepare( $sql );
-
-if($start) $stmt->bindValue(':start', $start, PDO::PARAM_INT );
-if($end) $stmt->bindValue(':end', $end, PDO::PARAM_INT );
-
-$result = $stmt->execute();
-
 // process the result
 abstract class CompareTracker {
     public $value;
@@ -196,16 +168,143 @@ foreach($params->data as $field) {
     $allTrackers[$field->fieldId] = $fieldTrackers;
 }
 
-// find the stats
-while( $row = $stmt->fetch(PDO::FETCH_ASSOC) ) {
-    foreach( $allTrackers as $key => $trackers ) {
-        foreach( $trackers as $tracker ) {
-            if( $row[$key] != null )
-                $tracker->test($row[$key], $row[$dateTimeColumn]);
+/*
+ * Feeds the records from $from (inclusive) to $to (inclusive or not) to the trackers, either
+ * may be NULL for no limit.
+ */
+function scanRecords($db, $entity, $fieldIds, $allTrackers, $from, $to, $toInclusive, &$queries) {
+    $dateTimeColumn = $entity->getPrimaryKeyColumn();
+    $dateTimeColumnQuoted = $db->quoteIdentifier($dateTimeColumn);
+    $sql = "select $dateTimeColumnQuoted, ". implode(', ', $db->quoteIdentifiers($fieldIds)) ." from ". $db->quoteIdentifier($entity->getTable());
+    $where = array();
+    if($from !== NULL) {
+        $where[] = "$dateTimeColumnQuoted >= :start";
+    }
+    if($to !== NULL) {
+        $where[] = "$dateTimeColumnQuoted ". ($toInclusive ? "<=" : "<") ." :end";
+    }
+    if(count($where) > 0) {
+        $sql .= " where " . join(" and ", $where);
+    }
+    $queries[] = str_replace("\n", " ", $sql) . " (start: $from, end: $to)";
+    $stmt = $db->prepare( $sql );
+    if($from !== NULL) $stmt->bindValue(':start', $from, PDO::PARAM_INT );
+    if($to !== NULL) $stmt->bindValue(':end', $to, PDO::PARAM_INT );
+    $stmt->execute();
+    // find the stats
+    while( $row = $stmt->fetch(PDO::FETCH_ASSOC) ) {
+        foreach( $allTrackers as $key => $trackers ) {
+            foreach( $trackers as $tracker ) {
+                if( $row[$key] != null )
+                    $tracker->test($row[$key], $row[$dateTimeColumn]);
+            }
+        }
+    }
+}
+
+/*
+ * Covers the range with the longest periods of the extremes table that fit entirely inside it,
+ * then the shorter periods either side of those, and finally scans the records left over at the
+ * edges. The periods are [periodStart, periodEnd).
+ */
+function coverRange($db, $entity, $extremesTable, $fieldIds, $allTrackers, $from, $to, $toInclusive, $periods, &$queries) {
+    if($from !== NULL && $to !== NULL && ($toInclusive ? $from > $to : $from >= $to)) {
+        return;
+    }
+    if(count($periods) == 0) {
+        scanRecords($db, $entity, $fieldIds, $allTrackers, $from, $to, $toInclusive, $queries);
+        return;
+    }
+    $period = array_shift($periods);
+    $fieldParams = array();
+    foreach($fieldIds as $index => $fieldId) {
+        $fieldParams[":field$index"] = $fieldId;
+    }
+    $sql = "select field, periodStart, periodEnd, min, minTime, max, maxTime from ". $db->quoteIdentifier($extremesTable)
+        ." where period = :period and field in (". implode(', ', array_keys($fieldParams)) .")";
+    if($from !== NULL) {
+        $sql .= " and periodStart >= :start";
+    }
+    if($to !== NULL) {
+        $sql .= " and periodEnd <= :end";
+    }
+    $queries[] = "$period (start: $from, end: $to)";
+    $stmt = $db->prepare( $sql );
+    $stmt->bindValue(':period', $period);
+    foreach($fieldParams as $name => $fieldId) {
+        $stmt->bindValue($name, $fieldId);
+    }
+    if($from !== NULL) $stmt->bindValue(':start', $from, PDO::PARAM_INT );
+    // periodEnd is exclusive
+    if($to !== NULL) $stmt->bindValue(':end', $toInclusive ? $to + 1 : $to, PDO::PARAM_INT );
+    $stmt->execute();
+    $coveredStart = NULL;
+    $coveredEnd = NULL;
+    while( $row = $stmt->fetch(PDO::FETCH_ASSOC) ) {
+        foreach( $allTrackers[$row['field']] as $tracker ) {
+            $isMin = $tracker->getType() == 'min';
+            $value = $isMin ? $row['min'] : $row['max'];
+            if( $value !== null )
+                $tracker->test($value, $isMin ? $row['minTime'] : $row['maxTime']);
         }
+        if($coveredStart === NULL || $row['periodStart'] < $coveredStart) $coveredStart = $row['periodStart'];
+        if($coveredEnd === NULL || $row['periodEnd'] > $coveredEnd) $coveredEnd = $row['periodEnd'];
+    }
+    if($coveredStart === NULL) {
+        coverRange($db, $entity, $extremesTable, $fieldIds, $allTrackers, $from, $to, $toInclusive, $periods, $queries);
+    } else {
+        coverRange($db, $entity, $extremesTable, $fieldIds, $allTrackers, $from, $coveredStart, false, $periods, $queries);
+        coverRange($db, $entity, $extremesTable, $fieldIds, $allTrackers, $coveredEnd, $to, $toInclusive, $periods, $queries);
     }
 }
 
+/*
+ * Returns how far through the records the extremes table has got for all of the fields, or NULL
+ * if it can't be used.
+ */
+function extremesWatermark($db, $extremesTable, $fieldIds) {
+    try {
+        $stmt = $db->query("select field, periodEnd from ". $db->quoteIdentifier($extremesTable) ." where period = 'a'");
+    } catch(PDOException $e) {
+        // not created yet
+        return NULL;
+    }
+    if(!$stmt) return NULL;
+    $done = array();
+    while( $row = $stmt->fetch(PDO::FETCH_ASSOC) ) {
+        $done[$row['field']] = $row['periodEnd'];
+    }
+    $watermark = NULL;
+    foreach($fieldIds as $fieldId) {
+        if(!array_key_exists($fieldId, $done)) return NULL;
+        if($watermark === NULL || $done[$fieldId] < $watermark) $watermark = $done[$fieldId];
+    }
+    return $watermark;
+}
+
+$_start = microtime(true);
+
+$queries = array();
+$entityConfig = $config['entity'][$entity_id];
+$extremesTable = array_key_exists('extremesTable', $entityConfig) ? $entityConfig['extremesTable'] : NULL;
+$watermark = $extremesTable ? extremesWatermark($db, $extremesTable, $fieldIds) : NULL;
+if($watermark === NULL) {
+    // every record in the range
+    scanRecords($db, $entity, $fieldIds, $allTrackers, $rangeStart, $rangeEnd, true, $queries);
+} else {
+    // the summaries only go as far as the watermark, the rest are scanned
+    if($rangeEnd === NULL || $rangeEnd >= $watermark) {
+        coverRange($db, $entity, $extremesTable, $fieldIds, $allTrackers, $rangeStart, $watermark, false, array('a', 'y', 'm', 'd'), $queries);
+        $from = ($rangeStart === NULL || $rangeStart < $watermark) ? $watermark : $rangeStart;
+        scanRecords($db, $entity, $fieldIds, $allTrackers, $from, $rangeEnd, true, $queries);
+    } else {
+        coverRange($db, $entity, $extremesTable, $fieldIds, $allTrackers, $rangeStart, $rangeEnd, true, array('a', 'y', 'm', 'd'), $queries);
+    }
+}
+
+// what was queried
+header( "X-Meso-Query: ". implode("; ", $queries) );
+
 header( "X-Meso-Process-Time: ". (microtime(true) - $_start) );
 
 // output
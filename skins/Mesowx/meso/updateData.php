@@ -13,11 +13,26 @@ Add data to an entity.
 
 Input Parameters:
 - entity_id - the entity name to update
-- data - the data to insert/update in as a json object of key/value pairs (column name->value)
+- data - the data to insert/update in as a json object of key/value pairs (column name->value),
+  an array of such objects, or in columnar form, an object holding the column names and
+  an array of rows with the values in column order, i.e. {"columns":["a","b"],"rows":[[1,2],[3,4]]},
+  or as deltas, each record holding only what changed since the one before, the first since
+  the stored record with the primary key "base" (or everything if that's null), i.e.
+  {"delta":{"base":1000,"records":[{"dateTime":1002,"b":3},{"dateTime":1004,"a":null}]}}
+  which gets a 409 status if the base record isn't there, send the records in full then
 - security_key - the required security key to update the entity data
+- complete_from, complete_to - optional, the sender has confirmed that every record after
+  complete_from up to complete_to (dateTime in seconds) is stored, which moves the entity's
+  watermark on if it carries on from it (see TimeTile::isComplete())
 
 e.g. /updateData.php?entity_id=test&data={%22a%22:28888888,%22b%22:2,%22c%22:3}&security_key=z
 
+A POST body may also be compressed, in which case the Content-Encoding header must be "gzip"
+or "deflate", the body the compressed url encoded form with the data, and the entity_id and
+security_key in the query string, so they're checked before the body is decompressed (see
+sync_compression in mesowx.py). A body that decompresses to more than MAX_DECOMPRESSED_LENGTH
+bytes gets a 413 status. Columns missing from a record are stored as null.
+
 */
 
 require_once 'include/TableEntity.class.php';
@@ -25,44 +40,87 @@ require_once 'include/HttpUtil.class.php';
 require_once 'include/JsonUtil.class.php';
 require_once 'include/JsonConfig.class.php';
 
+// the most a compressed request body may decompress to, in bytes
+define('MAX_DECOMPRESSED_LENGTH', 16 * 1024 * 1024);
+
 $request_method = $_SERVER['REQUEST_METHOD'];
 if($request_method != 'GET' && $request_method != 'POST') {
     HttpUtil::send405('Request must be a GET or POST method');
     exit;
 }
 
-if(!array_key_exists('entity_id', $_REQUEST)) {
-    HttpUtil::send400('Must specify an entity_id');
-    exit;
+$params = $_REQUEST;
+$content_encoding = array_key_exists('HTTP_CONTENT_ENCODING', $_SERVER) ?
+        strtolower(trim($_SERVER['HTTP_CONTENT_ENCODING'])) : 'identity';
+if($content_encoding != 'identity') {
+    if($content_encoding != 'gzip' && $content_encoding != 'deflate') {
+        HttpUtil::send400("Unsupported Content-Encoding: $content_encoding");
+        exit;
+    }
+    // the body is only decompressed once the sender is known, the entity_id and security_key of
+    // a compressed request come from the query string
+    $params = $_GET;
 }
-$entity_id = $_REQUEST['entity_id'];
 
-if(!array_key_exists('data', $_REQUEST)) {
-    HttpUtil::send400('Must specify data');
+if(!array_key_exists('entity_id', $params)) {
+    HttpUtil::send400('Must specify an entity_id');
     exit;
 }
-$dataJson = $_REQUEST['data'];
+$entity_id = $params['entity_id'];
 
-if(!array_key_exists('security_key', $_REQUEST)) {
+if(!array_key_exists('security_key', $params)) {
     HttpUtil::send400('Must specify a security_key');
     exit;
 }
-$security_key = $_REQUEST['security_key'];
+$security_key = $params['security_key'];
 
 $config = JsonConfig::getInstance();
 
+$dataJson = NULL;
 try {
     // TODO need a factory to create this, only support TableEnity for now
     $entity = new TableEntity($entity_id, $config);
     $entity->canUpdate($security_key);
+    if($content_encoding != 'identity') {
+        // PHP doesn't decompress request bodies, unpack the form ourselves, no further than the
+        // limit so a small body can't inflate into more than the memory PHP has
+        $body = file_get_contents('php://input');
+        if($content_encoding == 'gzip') {
+            $body = @gzdecode($body, MAX_DECOMPRESSED_LENGTH);
+        } else {
+            $body = @gzuncompress($body, MAX_DECOMPRESSED_LENGTH);
+        }
+        if($body === false) {
+            // zlib reports hitting the limit as running out of memory
+            $error = error_get_last();
+            if($error && strpos($error['message'], 'insufficient memory') !== false) {
+                HttpUtil::send413("Request body decompresses to more than " . MAX_DECOMPRESSED_LENGTH . " bytes");
+            } else {
+                HttpUtil::send400("Unable to decompress $content_encoding request body");
+            }
+            exit;
+        }
+        $params = array();
+        parse_str($body, $params);
+    }
+    if(!array_key_exists('data', $params)) {
+        HttpUtil::send400('Must specify data');
+        exit;
+    }
+    $dataJson = $params['data'];
     // parse data into associative array
     $data = JsonUtil::parseJson($dataJson);
     $entity->upsert($data);
+    if(array_key_exists('complete_from', $params) && array_key_exists('complete_to', $params)) {
+        $entity->extendWatermark($params['complete_from'], $params['complete_to']);
+    }
     // success!
     header('HTTP/1.0 200 OK');
 
 } catch(EntitySecurityException $e) {
     HttpUtil::send403("Unable to update entity: " . $e->getMessage());
+} catch(EntityConflictException $e) {
+    HttpUtil::send409("Unable to update entity: " . $e->getMessage());
 } catch(EntityException $e) {
     HttpUtil::send400("Unable to update entity: " . $e->getMessage());
 } catch(JsonParseException $e) {
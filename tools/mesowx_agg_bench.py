@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#
+# Compares the SQL and NumPy aggregation of the MesoWx endpoints.
+#
+# Distributed under the terms of the GNU Public License (GPLv3)
+#
+# https://github.com/glennmckechnie/weewx-mesowx
+"""
+Times the chart's grouped data.php queries and the console's stats.php highs
+and lows over a few years of synthetic archive records, done in SQL as
+mesowx_server.py does by default, and with NumPy by mesowx_arrays.py, and
+checks that they give the same answer. NumPy is timed reading the range from
+the table for each query, and from the columns ArrayEngine keeps (as
+mesowx_server.py --engine numpy does) once they've been read.
+
+    python3 tools/mesowx_agg_bench.py --years 5 --repeat 5
+
+The SQL is SQLite's, with the MySQL date functions and floor() supplied as
+Python functions as mesowx_server.py does, so the SQL times are only a guide
+to MySQL's. The database is made in a temporary directory unless --database
+names one, which is kept and reused.
+
+Needs NumPy.
+"""
+
+import argparse
+import math
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mesowx_arrays  # noqa: E402
+import mesowx_bench  # noqa: E402
+import mesowx_server  # noqa: E402
+
+FIELDS = ('outTemp', 'dewpoint', 'outHumidity', 'barometer', 'windSpeed',
+          'windGust', 'rainRate')
+
+
+def data_queries(start, end):
+    """(name, data.php parameters) as the archive chart asks for them"""
+    year = max(start, end - 365 * 86400)
+    chart = 'dateTime,outTemp:avg:c:1,barometer:avg:mb:1,windSpeed:avg::1'
+    return [
+        ('year, 667 groups', {'data': chart, 'group': '667:groups:ms',
+                              'start': '%d' % year, 'end': '%d' % end}),
+        ('all, 667 groups', {'data': chart, 'group': '667:groups:ms'}),
+        ('all, hourly', {'data': chart, 'group': '3600:seconds:ms'}),
+        ('all, daily', {'data': chart, 'group': '1:days:ms'}),
+        ('all, monthly min/max', {'data': 'outTemp:min,outTemp:max,'
+                                          'windGust:max,rain:sum',
+                                  'group': '1:months:ms'}),
+        ('all, one group', {'data': 'outTemp:avg,windGust:max,rain:sum',
+                            'group': '1:groups'}),
+    ]
+
+
+def stats_queries(start, end):
+    """(name, stats.php request) as the console asks for them"""
+    queries = []
+    for name, length in (('day', 86400), ('year', 365 * 86400),
+                         ('all', end - start)):
+        queries.append(('stats, %s' % name, {
+            'entityId': 'weewx_archive', 'timeUnit': 'ms',
+            'start': max(start, end - length) * 1000, 'end': end * 1000,
+            'data': [{'fieldId': f, 'decimals': 1, 'stats': ['min', 'max']}
+                     for f in FIELDS]}))
+    return queries
+
+
+def timed(function, repeat):
+    """The best time of repeat calls, and what the last returned"""
+    best = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def same(a, b):
+    """Whether two results agree, but for the last bits of the floats"""
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same(a[k], b[k]) for k in a)
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6)
+    return a == b
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare SQL and NumPy aggregation")
+    parser.add_argument('--years', type=int, default=3,
+                        help="years of synthetic archive records")
+    parser.add_argument('--database', help="keep the synthetic database "
+                        "here, it's made if it doesn't exist")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    path = args.database or os.path.join(tempfile.mkdtemp(),
+                                         'mesowx_agg_bench.sdb')
+    if not os.path.exists(path):
+        print("making %d years of records in %s" % (args.years, path))
+        start, end = mesowx_bench.make_database(path, args.years * 365)
+    else:
+        db = sqlite3.connect(path)
+        start, end = db.execute('select min("dateTime"), max("dateTime") '
+                                'from archive').fetchone()
+        db.close()
+    config = mesowx_bench.make_config()
+    db = mesowx_server.open_database(path)
+    count = db.execute('select count(*) from archive').fetchone()[0]
+    print("%d archive records, best of %d\n" % (count, args.repeat))
+    print("%-22s %6s %9s %9s %9s %8s  %s" % (
+          'query', 'rows', 'SQL ms', 'NumPy ms', 'cached ms', 'speedup',
+          'same'))
+    engines = (None, mesowx_arrays.ArrayEngine(cache=False),
+               mesowx_arrays.ArrayEngine())
+
+    def compare(name, rows, query):
+        times, results = [], []
+        for engine in engines:
+            if engine is not None and engine.tables is not None:
+                # read the columns, it's the later queries that are timed
+                query(engine)
+            elapsed, result = timed(lambda: query(engine), args.repeat)
+            times.append(elapsed)
+            results.append(result[0])
+        print("%-22s %6d %9.1f %9.1f %9.1f %7.1fx  %s" % (
+              name, rows(results[0]), times[0] * 1000, times[1] * 1000,
+              times[2] * 1000, times[0] / times[2],
+              'yes' if same(results[0], results[1]) and
+              same(results[0], results[2]) else 'NO'))
+
+    for name, params in data_queries(start, end):
+        params = dict(params, entity_id='weewx_archive')
+        compare(name, len, lambda engine: mesowx_server.query_data(
+                db, config, params, engine))
+    for name, params in stats_queries(start, end):
+        compare(name, len, lambda engine: mesowx_server.query_stats(
+                db, config, params, engine))
+
+
+if __name__ == '__main__':
+    main()
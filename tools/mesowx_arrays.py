@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+#
+# NumPy aggregation for the MesoWx endpoints.
+#
+# Distributed under the terms of the GNU Public License (GPLv3)
+#
+# https://github.com/glennmckechnie/weewx-mesowx
+"""
+Answers the grouped data.php queries and the stats.php highs and lows for
+mesowx_server.py (--engine numpy) without having the database do the
+grouping. The records are read, oldest first, into a contiguous float64 array
+per column with the missing values as NaN. Each row is given the index of its
+group, and as the rows are in order the groups are runs, so the min, max, sum
+and count of every group are each one ufunc.reduceat() over the run starts. A
+high or low is a nanargmax()/nanargmin() of the column.
+
+Reading the records is most of the work, so by default ArrayEngine keeps the
+columns of each table it's read and after that only reads the records added
+since, or drops those pruned. A range is then a binary search of the times.
+The cache is checked against the table's count, first and last dateTime on
+each query, any other change and the table is read again, but a record
+replaced in place with different values isn't noticed.
+
+The groups and their times are those of AggregateQuery.class.php: N:seconds
+and N:groups are floor(dateTime / slice) * slice, and N:days, N:months and
+N:years are by the local calendar, as MySQL's from_unixtime() has it. Queries
+that aren't grouped, are downsampled or are answered from a rollup table are
+left to the SQL.
+
+See mesowx_agg_bench.py for how it compares with the SQL on a few years of
+archive records. Unlike the rest of tools/ this needs NumPy.
+"""
+
+import math
+import threading
+import time
+
+import numpy
+
+import mesowx_server
+
+# rows converted to arrays at a time, so there's never more than this many
+# rows of Python objects
+CHUNK_ROWS = 65536
+
+
+class TableArrays(object):
+    """The columns of a table read so far, oldest first"""
+
+    def __init__(self, table, date_time):
+        self.table = table
+        self.date_time = date_time
+        self.times = numpy.zeros(0)
+        self.columns = {}
+
+    def refresh(self, db, fields):
+        """Catches up with the table, returns a description of what was read"""
+        quote = mesowx_server.quote
+        table, pk = quote(self.table), quote(self.date_time)
+        count = db.execute("select count(*) from %s" % table).fetchone()[0]
+        # min() and max() on their own are a lookup, together they're a scan
+        first = db.execute("select min(%s) from %s" % (pk, table)).fetchone()
+        last = db.execute("select max(%s) from %s" % (pk, table)).fetchone()
+        first, last = first[0], last[0]
+        wanted = list(self.columns) + [f for f in fields
+                                       if f not in self.columns]
+        if len(wanted) == len(self.columns) and len(self.times):
+            # drop what's been pruned and read what's been added since
+            keep = numpy.searchsorted(self.times, first) if first is not None \
+                else len(self.times)
+            columns = numpy.empty((len(wanted) + 1, 0))
+            if last is not None and last > self.times[-1]:
+                sql = "select %s, %s from %s where %s > ? order by %s asc" % (
+                      pk, ", ".join(quote(f) for f in wanted), table, pk, pk)
+                columns = read_columns(db, sql, [self.times[-1].item()],
+                                       len(wanted) + 1)
+            added = columns.shape[1]
+            if len(self.times) - keep + added == count:
+                if keep or added:
+                    self.times = numpy.concatenate((self.times[keep:],
+                                                    columns[0]))
+                    for i, field in enumerate(wanted):
+                        self.columns[field] = numpy.concatenate(
+                            (self.columns[field][keep:], columns[i + 1]))
+                return "%d records dropped, %d read" % (keep, added)
+        # the first time, a new field or any other change, read it all
+        sql = "select %s, %s from %s order by %s asc" % (
+              pk, ", ".join(quote(f) for f in wanted), table, pk)
+        columns = read_columns(db, sql, [], len(wanted) + 1)
+        self.times = columns[0]
+        self.columns = dict(zip(wanted, columns[1:]))
+        return sql
+
+    def between(self, fields, low, high, high_inclusive=True):
+        """The times and each field's values from low to high, as views"""
+        start = 0 if low is None else numpy.searchsorted(self.times, low)
+        end = len(self.times) if high is None else numpy.searchsorted(
+            self.times, high, 'right' if high_inclusive else 'left')
+        return self.times[start:end], \
+            [self.columns[f][start:end] for f in fields]
+
+
+class ArrayEngine(object):
+    """The engine for query_data() and query_stats(). With cache false the
+    range is read from the table for each query."""
+
+    def __init__(self, cache=True):
+        self.tables = {} if cache else None
+        # the arrays are replaced rather than changed, so the lock is only
+        # needed while reading
+        self.lock = threading.Lock()
+
+    def can_aggregate(self, query):
+        """Whether aggregate() answers query, a plain grouped
+        AggregateQuery"""
+        return type(query).__name__ == 'AggregateQuery' and \
+            query.is_grouped() and \
+            query.group['type'] not in mesowx_server.DOWNSAMPLE_TYPES
+
+    def read(self, db, table, date_time, fields, low, high,
+             high_inclusive=True):
+        """The times and values of the fields from low to high, and a
+        description of what was read"""
+        if self.tables is None:
+            sql, args = range_sql(table, date_time, fields, low, high,
+                                  high_inclusive)
+            columns = read_columns(db, sql, args, len(fields) + 1)
+            return columns[0], columns[1:], sql
+        with self.lock:
+            arrays = self.tables.get(table)
+            if arrays is None or arrays.date_time != date_time:
+                arrays = self.tables[table] = TableArrays(table, date_time)
+            description = arrays.refresh(db, fields)
+            times, values = arrays.between(fields, low, high,
+                                           high_inclusive)
+        return times, values, "%s from %s (%s)" % (
+            ", ".join(fields), table, description)
+
+    def aggregate(self, db, query):
+        """The rows of a grouped query and a description of how they were
+        got, as query_data() would have them from the query's SQL"""
+        fields = []
+        for name, agg, unit, decimals in query.data:
+            if name not in fields:
+                fields.append(name)
+        times, columns, description = self.read(
+            db, query.table, query.entity.primary_key, fields, query.start,
+            query.end)
+        values = dict(zip(fields, columns))
+        single = query.is_single_group()
+        if single:
+            ids, labels = numpy.zeros(len(times), dtype=numpy.int64), None
+        elif query.group['type'] in ('groups', 'seconds'):
+            ids, labels = slice_groups(db, query, times)
+        else:
+            ids, labels = calendar_groups(times, query.group['type'],
+                                          query.group['value'])
+        starts = run_starts(ids)
+        result = []
+        if labels is not None:
+            result.append(convert(labels, 's', query.group['unit']))
+        for name, agg, unit, decimals in query.data:
+            column = reduce_runs(values[name], starts, agg)
+            if unit is not None:
+                column = convert(column, query.entity.columns[name]['unit'],
+                                 unit)
+            if decimals is not None:
+                column = round_half_away(column, int(decimals))
+            result.append(column)
+        if single and not len(times):
+            # an aggregate with no group by has a row even with no records
+            result = [numpy.array([numpy.nan]) for column in result]
+        rows = list(zip(*[to_list(column) for column in result]))
+        if query.order == 'desc':
+            rows.reverse()
+        if query.limit:
+            rows = rows[:int(query.limit)]
+        return rows, "%s, grouped by %s with NumPy" % (
+            description, 'nothing' if single else query.build_group())
+
+    def extremes(self, db, table, date_time, fields, low, high,
+                 high_inclusive):
+        """[min, minTime, max, maxTime] of each field between low and high,
+        as query_stats() scans for them, the earliest where there's a tie,
+        and a description of what was read"""
+        times, columns, description = self.read(db, table, date_time, fields,
+                                                low, high, high_inclusive)
+        result = {}
+        for field, values in zip(fields, columns):
+            if not len(values) or numpy.isnan(values).all():
+                continue
+            low_index = int(numpy.nanargmin(values))
+            high_index = int(numpy.nanargmax(values))
+            result[field] = [values[low_index].item(),
+                             times[low_index].item(),
+                             values[high_index].item(),
+                             times[high_index].item()]
+        return result, description
+
+
+def read_columns(db, sql, args, count):
+    """The count columns sql selects, each as a contiguous float64 array"""
+    cursor = db.execute(sql, args)
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(CHUNK_ROWS)
+        if not rows:
+            break
+        chunks.append(numpy.array(rows, dtype=numpy.float64))
+    if not chunks:
+        return numpy.empty((count, 0))
+    return numpy.ascontiguousarray(numpy.concatenate(chunks).T)
+
+
+def range_sql(table, date_time, fields, low, high, high_inclusive=True):
+    quote = mesowx_server.quote
+    pk = quote(date_time)
+    sql = "select %s, %s from %s" % (pk, ", ".join(quote(f) for f in fields),
+                                     quote(table))
+    where, args = [], []
+    if low is not None:
+        where.append("%s >= ?" % pk)
+        args.append(low)
+    if high is not None:
+        where.append("%s %s ?" % (pk, "<=" if high_inclusive else "<"))
+        args.append(high)
+    if where:
+        sql += " where " + " and ".join(where)
+    return sql + " order by %s asc" % pk, args
+
+
+def slice_groups(db, query, times):
+    """The group of each time, and each group's time, for N:seconds and
+    N:groups"""
+    if query.group['type'] == 'seconds':
+        size = float(query.group['value'])
+    else:
+        start, end = query.start, query.end
+        if start is None or end is None:
+            row = db.execute("select min(%s), max(%s) from %s" % (
+                             query.date_time, query.date_time,
+                             mesowx_server.quote(query.table))).fetchone()
+            start = row[0] if start is None else start
+            end = row[1] if end is None else end
+        if start is None or end is None:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+        size = (end - start) / float(query.group['value'])
+    if size <= 0:
+        # one group, as floor(x / 0) is null for every row
+        ids = numpy.zeros(len(times), dtype=numpy.int64)
+        return ids, numpy.full(min(1, len(times)), numpy.nan)
+    groups = numpy.floor(times / size)
+    ids = groups.astype(numpy.int64)
+    return ids, groups[run_starts(ids)] * size
+
+
+def calendar_groups(times, kind, value):
+    """The group of each time, and each group's time, for N:days, N:months
+    and N:years. A group is found for each local day in the range, and the
+    rows are put in their day with a binary search of the day starts."""
+    if not len(times):
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+    first = time.localtime(times[0])
+    year, month, day = first.tm_year, first.tm_mon, first.tm_mday
+    day_starts, day_groups, labels = [], [], []
+    key = None
+    while True:
+        start = time.mktime((year, month, day, 0, 0, 0, 0, 0, -1))
+        if start > times[-1]:
+            break
+        local = time.localtime(start)
+        day_key, label = calendar_group(local, kind, value)
+        if day_key != key:
+            key = day_key
+            labels.append(label)
+        day_starts.append(start)
+        day_groups.append(len(labels) - 1)
+        year, month, day = local.tm_year, local.tm_mon, local.tm_mday + 1
+    days = numpy.searchsorted(numpy.array(day_starts), times, 'right') - 1
+    ids = numpy.array(day_groups, dtype=numpy.int64)[days]
+    used = numpy.unique(ids)
+    return ids, numpy.array(labels, dtype=numpy.float64)[used]
+
+
+def calendar_group(local, kind, value):
+    """The group of a local day and its time, as buildGroup() and
+    buildGroupSelect() in AggregateQuery.class.php"""
+    def part(number):
+        return number if value == 1 else int(math.ceil(number / value))
+    if kind == 'days':
+        key = (local.tm_year, part(local.tm_yday))
+        text = mesowx_server._concat(mesowx_server._makedate(
+            key[0], key[1] * value - (value - 1)), ' 00:00:00')
+    elif kind == 'months':
+        key = (local.tm_year, part(local.tm_mon))
+        text = mesowx_server._concat(key[0], '-', key[1] * value - (value - 1),
+                                     '-01 00:00:00')
+    else:
+        key = (part(local.tm_year),)
+        text = mesowx_server._concat(key[0] * value - (value - 1),
+                                     '-01-01 00:00:00')
+    return key, mesowx_server._unix_timestamp(text)
+
+
+def run_starts(ids):
+    """The index of the first row of each run of the same group"""
+    if not len(ids):
+        return numpy.zeros(0, dtype=numpy.intp)
+    return numpy.concatenate(([0], numpy.flatnonzero(ids[1:] != ids[:-1]) + 1))
+
+
+def reduce_runs(values, starts, agg):
+    """agg of the values of each run, NaN where there are none"""
+    if not len(starts):
+        return numpy.zeros(0)
+    if agg == 'min':
+        return numpy.fmin.reduceat(values, starts)
+    if agg == 'max':
+        return numpy.fmax.reduceat(values, starts)
+    present = ~numpy.isnan(values)
+    count = numpy.add.reduceat(present, starts, dtype=numpy.int64)
+    total = numpy.add.reduceat(numpy.where(present, values, 0.0), starts)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        if agg == 'avg':
+            return total / count
+        return numpy.where(count > 0, total, numpy.nan)
+
+
+def convert(values, from_unit, to_unit):
+    """UnitConvert on an array, the formulas are plain arithmetic"""
+    if from_unit == to_unit or not to_unit:
+        return values
+    return eval(mesowx_server.FORMULA[from_unit][to_unit].replace('#', 'v'),
+                {}, {'v': values})
+
+
+def round_half_away(values, decimals):
+    """round() as SQL does it, halves away from zero"""
+    scale = 10.0 ** decimals
+    return numpy.sign(values) * numpy.floor(numpy.abs(values) * scale + 0.5) \
+        / scale
+
+
+def to_list(values):
+    return [None if v != v else v for v in values.tolist()]
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+#
+# Load test for the MesoWx endpoints.
+#
+# Distributed under the terms of the GNU Public License (GPLv3)
+#
+# https://github.com/glennmckechnie/weewx-mesowx
+"""
+Replays the requests the MesoWx pages and SyncService make, the chart
+data.php queries, the console's stats.php min/max, and updateData.php sync
+posts, from a number of clients at once, and reports the throughput and the
+p50/p99 latency of each.
+
+With no --url it makes a SQLite database of synthetic archive and raw
+records and serves it with mesowx_server.py in this process, so the server
+and queries can be profiled on their own:
+
+    python3 tools/mesowx_bench.py --days 365 --clients 8 --duration 30
+
+Against a real server give the meso/ URL, and the security key for the sync
+posts (which are left out without one):
+
+    python3 tools/mesowx_bench.py --url http://example.com/meso/ \\
+        --security-key KEY
+
+--mix sets the proportion of each request, i.e. chart=6,console=3,sync=1.
+
+Needs Python 3.7 or later, and nothing outside the standard library.
+"""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mesowx_server  # noqa: E402
+
+FIELDS = ('barometer', 'inTemp', 'outTemp', 'inHumidity', 'outHumidity',
+          'windSpeed', 'windDir', 'windGust', 'windGustDir', 'rainRate',
+          'rain', 'dewpoint', 'windchill', 'heatindex')
+UNITS = {'barometer': 'inHg', 'inTemp': 'f', 'outTemp': 'f',
+         'inHumidity': 'perc', 'outHumidity': 'perc', 'windSpeed': 'mph',
+         'windDir': 'deg', 'windGust': 'mph', 'windGustDir': 'deg',
+         'rainRate': 'inHr', 'rain': 'in', 'dewpoint': 'f', 'windchill': 'f',
+         'heatindex': 'f'}
+SECURITY_KEY = 'bench'
+
+
+def make_config(archive='weewx_archive', raw='weewx_raw'):
+    """The config.json for the synthetic database, as config-example.json"""
+    columns = dict((f, {'unit': u}) for f, u in UNITS.items())
+    columns['dateTime'] = {'type': 'number', 'unit': 's'}
+    update = {'update': {'allow': True, 'securityKey': SECURITY_KEY}}
+    archive_columns = dict(columns)
+    archive_columns['interval'] = {}
+    return {
+        'dataSource': {'bench': {'type': 'sqlite', 'file': ''}},
+        'entity': {
+            archive: {
+                'type': 'table', 'dataSource': 'bench',
+                'tableName': 'archive', 'accessControl': update,
+                'columns': archive_columns,
+                'constraints': {'primaryKey': 'dateTime'},
+            },
+            raw: {
+                'type': 'table', 'dataSource': 'bench', 'tableName': 'raw',
+                'accessControl': update,
+                'retentionPolicy': {'type': 'window', 'trigger': 'update',
+                                    'windowSize': 86400},
+                'columns': columns,
+                'constraints': {'primaryKey': 'dateTime'},
+            },
+        },
+    }
+
+
+def synthetic_record(ts):
+    day = 2 * math.pi * (ts % 86400) / 86400
+    year = 2 * math.pi * (ts % 31557600) / 31557600
+    out_temp = 55 - 20 * math.cos(year) - 10 * math.cos(day) + \
+        random.uniform(-1, 1)
+    wind = max(0.0, 8 + 6 * math.sin(day) + random.uniform(-3, 3))
+    return {
+        'barometer': 30 + 0.3 * math.sin(ts / 200000.0),
+        'inTemp': 70 + random.uniform(-0.5, 0.5),
+        'outTemp': out_temp,
+        'inHumidity': 40 + random.uniform(-2, 2),
+        'outHumidity': 60 + 25 * math.cos(day),
+        'windSpeed': wind,
+        'windDir': random.uniform(0, 360),
+        'windGust': wind * 1.4,
+        'windGustDir': random.uniform(0, 360),
+        'rainRate': 0.0,
+        'rain': 0.0,
+        'dewpoint': out_temp - 10,
+        'windchill': out_temp,
+        'heatindex': out_temp,
+    }
+
+
+def make_database(path, days, archive_interval=300, raw_interval=2):
+    """Fill a SQLite database with days of archive records and a day of raw
+    records, up to now"""
+    db = sqlite3.connect(path)
+    columns = ', '.join('"%s" real' % f for f in FIELDS)
+    db.execute('create table archive ("dateTime" integer primary key, '
+               '"interval" integer, %s)' % columns)
+    db.execute('create table raw ("dateTime" integer primary key, %s)' %
+               columns)
+    names = ', '.join('"%s"' % f for f in FIELDS)
+    marks = ', '.join('?' * len(FIELDS))
+    now = int(time.time())
+    end = now - now % archive_interval
+    start = end - days * 86400
+
+    def rows(first, last, step, *extra):
+        for ts in range(first, last, step):
+            record = synthetic_record(ts)
+            yield (ts,) + extra + tuple(record[f] for f in FIELDS)
+    db.executemany('insert into archive ("dateTime", "interval", %s) values '
+                   '(?, ?, %s)' % (names, marks),
+                   rows(start, end, archive_interval, archive_interval // 60))
+    db.executemany('insert into raw ("dateTime", %s) values (?, %s)' %
+                   (names, marks), rows(now - 86400, now, raw_interval))
+    db.commit()
+    db.close()
+    return start, end
+
+
+class Client(object):
+    """One keep-alive connection, like a browser or SyncService"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path if parts.path.endswith('/') else \
+            parts.path + '/'
+        self.connection = None
+
+    def request(self, method, endpoint, body=None, headers=None):
+        if self.connection is None:
+            cls = http.client.HTTPSConnection if self.https else \
+                http.client.HTTPConnection
+            self.connection = cls(self.host, self.port, timeout=60)
+        try:
+            self.connection.request(method, self.path + endpoint, body,
+                                    headers or {})
+            response = self.connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self.connection.close()
+            self.connection = None
+            raise
+        if response.getheader('Connection', '').lower() == 'close':
+            self.connection.close()
+            self.connection = None
+        return response.status, data
+
+
+class Workload(object):
+    """The requests, as the pages' data providers and SyncService make
+    them"""
+
+    def __init__(self, archive, raw, span, security_key):
+        self.archive = archive
+        self.raw = raw
+        self.span_start, self.span_end = span
+        self.security_key = security_key
+        self.lock = threading.Lock()
+        self.next_time = int(time.time()) + 1
+
+    def chart(self):
+        """An AggregateDataProvider query for a chart, zoomed somewhere"""
+        fields = random.sample(('outTemp', 'dewpoint', 'barometer',
+                                'windSpeed', 'windGust', 'outHumidity',
+                                'rainRate'), 3)
+        kind = random.choice(('groups', 'groups', 'seconds', 'days', 'raw'))
+        length = random.choice((86400, 7 * 86400, 30 * 86400, 365 * 86400))
+        length = min(length, self.span_end - self.span_start)
+        end = random.randint(self.span_start + length, self.span_end)
+        start = end - length
+        data = ['dateTime'] + ['%s:avg:%s:1' % (f, 'c' if UNITS[f] == 'f'
+                                                else UNITS[f]) for f in fields]
+        params = {'entity_id': self.archive, 'data': ','.join(data),
+                  'start': '%d:datetime' % start, 'end': '%d:datetime' % end}
+        if kind == 'groups':
+            # about a point every 1.5 pixels of a 1000 pixel chart
+            params['group'] = '667:groups:ms'
+        elif kind == 'seconds':
+            params['group'] = '%d:seconds:ms' % random.choice((3600, 10800,
+                                                               86400))
+        elif kind == 'days':
+            params['group'] = '1:days:ms'
+        else:
+            params['entity_id'] = self.raw
+            params['start'] = '%d:ago' % random.choice((600, 3600, 10800))
+            del params['end']
+        return 'GET', 'data.php?' + urlencode(params), None, {}
+
+    def console(self):
+        """A StatsDataProvider request for the day's highs and lows"""
+        fields = ('outTemp', 'dewpoint', 'outHumidity', 'barometer',
+                  'windSpeed', 'windGust', 'rainRate')
+        end = random.randint(self.span_start + 86400, self.span_end)
+        start = end - random.choice((86400, 86400, 30 * 86400, 365 * 86400))
+        body = {'entityId': self.archive, 'timeUnit': 'ms',
+                'start': max(start, self.span_start) * 1000,
+                'end': end * 1000,
+                'data': [{'fieldId': f, 'decimals': 1, 'stats': ['min', 'max']}
+                         for f in fields]}
+        return 'POST', 'stats.php', json.dumps(body), \
+            {'Content-Type': 'application/json'}
+
+    def sync(self):
+        """A RawSyncThread post of a few new raw packets"""
+        with self.lock:
+            first = self.next_time
+            self.next_time += 5
+        records = []
+        for ts in range(first, first + 5):
+            record = synthetic_record(ts)
+            record['dateTime'] = ts
+            records.append(record)
+        body = urlencode({'entity_id': self.raw,
+                          'security_key': self.security_key,
+                          'data': json.dumps(records)})
+        return 'POST', 'updateData.php', body, \
+            {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) -
+                                                             1))))]
+
+
+def run(url, workload, mix, clients, duration):
+    """Send requests from the clients for the duration, returns the latencies
+    and errors by request kind"""
+    kinds = [kind for kind, weight in mix for _ in range(weight)]
+    latencies = dict((kind, []) for kind, _ in mix)
+    errors = dict((kind, 0) for kind, _ in mix)
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client_loop():
+        client = Client(url)
+        while time.time() < deadline:
+            kind = random.choice(kinds)
+            method, endpoint, body, headers = getattr(workload, kind)()
+            started = time.time()
+            try:
+                status, _ = client.request(method, endpoint, body, headers)
+                ok = status == 200
+            except (http.client.HTTPException, OSError):
+                ok = False
+            elapsed = time.time() - started
+            with lock:
+                if ok:
+                    latencies[kind].append(elapsed)
+                else:
+                    errors[kind] += 1
+
+    threads = [threading.Thread(target=client_loop) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def report(latencies, errors, duration):
+    print("%-8s %8s %8s %10s %10s %10s" % ('request', 'count', 'errors',
+                                           'req/s', 'p50 ms', 'p99 ms'))
+    total = 0
+    for kind in latencies:
+        times = latencies[kind]
+        total += len(times)
+        print("%-8s %8d %8d %10.1f %10.1f %10.1f" % (
+              kind, len(times), errors[kind], len(times) / duration,
+              percentile(times, 0.5) * 1000, percentile(times, 0.99) * 1000))
+    print("%-8s %8d %8d %10.1f" % ('total', total, sum(errors.values()),
+                                   total / duration))
+
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in ('chart', 'console', 'sync'):
+            raise argparse.ArgumentTypeError("unknown request: %s" % kind)
+        if int(weight or 1) > 0:
+            mix.append((kind, int(weight or 1)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test the MesoWx endpoints")
+    parser.add_argument('--url', help="the meso/ URL of a running server, by "
+                        "default a synthetic database is served locally")
+    parser.add_argument('--archive-entity', default='weewx_archive')
+    parser.add_argument('--raw-entity', default='weewx_raw')
+    parser.add_argument('--security-key',
+                        help="the raw entity's key, for the sync posts")
+    parser.add_argument('--start', type=int,
+                        help="with --url, the earliest archive record")
+    parser.add_argument('--days', type=int, default=90,
+                        help="days of synthetic archive records")
+    parser.add_argument('--database', help="keep the synthetic database "
+                        "here, it's made if it doesn't exist")
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--mix', type=parse_mix,
+                        default=parse_mix('chart=6,console=3,sync=1'))
+    args = parser.parse_args()
+
+    server = None
+    security_key = args.security_key
+    mix = args.mix
+    if args.url:
+        url = args.url
+        end = int(time.time())
+        span = (args.start or end - args.days * 86400, end)
+        if security_key is None:
+            mix = [(kind, weight) for kind, weight in mix if kind != 'sync']
+    else:
+        path = args.database or os.path.join(tempfile.mkdtemp(),
+                                             'mesowx_bench.sdb')
+        if not os.path.exists(path):
+            print("making %d days of records in %s" % (args.days, path))
+            span = make_database(path, args.days)
+        else:
+            db = sqlite3.connect(path)
+            span = db.execute('select min("dateTime"), max("dateTime") from '
+                              'archive').fetchone()
+            db.close()
+        config = make_config(args.archive_entity, args.raw_entity)
+        server = mesowx_server.MesoServer(('127.0.0.1', 0), config, path,
+                                          quiet=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        security_key = SECURITY_KEY
+    if not mix:
+        parser.error("nothing to send")
+
+    workload = Workload(args.archive_entity, args.raw_entity, span,
+                        security_key)
+    print("%d clients for %gs against %s" % (args.clients, args.duration,
+                                             url))
+    latencies, errors = run(url, workload, mix, args.clients, args.duration)
+    report(latencies, errors, args.duration)
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
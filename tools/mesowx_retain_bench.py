@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark of RetainLoopValues.
+#
+# Distributed under the terms of the GNU Public License (GPLv3)
+#
+# https://github.com/glennmckechnie/weewx-mesowx
+"""
+Times RetainLoopValues.newLoopPacket on packets like those of a Vantage
+console, ~60 fields with a few of them None in turn, comparing the old way
+(a dict of the new values, a set difference and a copy of the whole retained
+dict each packet) with the slots, producing a dict (packet_view = false, the
+default) or a RetainedPacket.
+
+It needs weewx, so run it with weewx's bin directory on the path along with
+this one's, i.e.
+
+    PYTHONPATH=/usr/share/weewx:bin python3 tools/mesowx_retain_bench.py
+
+Each is timed on its own, and again with a typical consumer reading a dozen
+fields of each packet. At a loop packet a second, the engine thread time is
+simply the time per packet.
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+import user.mesowx as mesowx
+
+READ_FIELDS = ('dateTime', 'usUnits', 'outTemp', 'outHumidity', 'barometer',
+               'windSpeed', 'windDir', 'windGust', 'rainRate', 'dewpoint',
+               'windchill', 'heatindex')
+
+
+class Engine(object):
+
+    def bind(self, event_type, callback):
+        pass
+
+
+class Event(object):
+
+    def __init__(self, packet):
+        self.packet = packet
+
+
+class OldRetainLoopValues(object):
+    """RetainLoopValues as it was, with items() in place of iteritems()"""
+
+    def __init__(self, exclude_fields=()):
+        self.retainedLoopValues = {}
+        self.excludeFields = set(exclude_fields)
+
+    def newLoopPacket(self, event):
+        event.originalPacket = event.packet
+        self.retainedLoopValues.update(dict((k, v) for k, v in
+                                            event.packet.items() if
+                                            (v is not None or k in
+                                             self.excludeFields)))
+        for k in self.excludeFields - set(event.packet.keys()):
+            if k in self.retainedLoopValues:
+                self.retainedLoopValues.pop(k)
+        event.packet = self.retainedLoopValues.copy()
+
+
+def make_packets(count):
+    fields = [name for name, _ in mesowx.schema]
+    extra = ['monthET', 'yearET', 'dayRain', 'monthRain', 'yearRain',
+             'stormRain', 'sunrise', 'sunset', 'forecastRule',
+             'forecastIcon', 'windSpeed10', 'insideAlarm', 'rainAlarm']
+    now = int(time.time())
+    packets = []
+    for i in range(count):
+        packet = dict((f, random.uniform(0, 100)) for f in fields + extra)
+        packet['dateTime'] = now + 2 * i
+        packet['usUnits'] = 1
+        # a few fields missing from each packet, as the console sends them
+        for f in random.sample(fields[2:], 6):
+            packet[f] = None
+        packets.append(packet)
+    return packets
+
+
+def new_service(packet_view):
+    config = {'Mesowx': {'RetainLoopValues': {
+              'packet_view': 'true' if packet_view else 'false'}}}
+    return mesowx.RetainLoopValues(Engine(), config)
+
+
+def run(service, packets, read):
+    events = [Event(p) for p in packets]
+    started = time.perf_counter()
+    for event in events:
+        service.newLoopPacket(event)
+        if read:
+            packet = event.packet
+            for field in READ_FIELDS:
+                packet.get(field)
+    return (time.perf_counter() - started) / len(events)
+
+
+def allocated(service, packets):
+    """Bytes left allocated by each packet, while the packets are kept"""
+    events = [Event(p) for p in packets]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for event in events:
+        service.newLoopPacket(event)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / float(len(events))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time RetainLoopValues per loop packet")
+    parser.add_argument('--packets', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    packets = make_packets(args.packets)
+    candidates = (
+        ('old dict copy', lambda: OldRetainLoopValues()),
+        ('slots, dict', lambda: new_service(False)),
+        ('slots, view', lambda: new_service(True)),
+    )
+    print("%-14s %12s %12s %14s %16s" % ('', 'us/packet', 'with reads',
+                                         'bytes/packet', 'CPU at 1 Hz'))
+    for name, factory in candidates:
+        alone = min(run(factory(), packets, False)
+                    for _ in range(args.repeat))
+        reading = min(run(factory(), packets, True)
+                      for _ in range(args.repeat))
+        size = allocated(factory(), packets[:2000])
+        print("%-14s %12.2f %12.2f %14.0f %15.4f%%" % (
+              name, alone * 1e6, reading * 1e6, size, reading * 100))
+
+
+if __name__ == '__main__':
+    main()
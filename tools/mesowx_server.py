@@ -0,0 +1,1488 @@
+#!/usr/bin/env python3
+#
+# A Python stand-in for the MesoWx PHP endpoints.
+#
+# Distributed under the terms of the GNU Public License (GPLv3)
+#
+# https://github.com/glennmckechnie/weewx-mesowx
+"""
+Serves data.php, stats.php, updateData.php and prune.php from SQLite with the
+same query parameters and the same JSON as the PHP in skins/Mesowx/meso, along
+with any other files under --root. It reads the same config.json, so it's a
+stand-in remote server for trying out SyncService, and the read path can be
+profiled and load tested (see mesowx_bench.py) without a web server and PHP.
+
+The SQL is built the way AggregateQuery.class.php builds it, MySQL functions
+and all, those that SQLite lacks are supplied as Python functions.
+
+    python3 tools/mesowx_server.py \\
+        --config skins/Mesowx/meso/include/config-example.json \\
+        --sqlite /tmp/mesowx.sdb --port 8080
+
+then point remote_server_url at http://localhost:8080/meso/
+
+With --engine numpy the grouped data.php queries and the stats.php scans
+are done with NumPy by mesowx_arrays.py rather than in SQL, from columns it
+keeps in memory.
+
+Needs Python 3.7 or later, and nothing outside the standard library but for
+--engine numpy.
+"""
+
+import argparse
+import array
+import email.parser
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# UnitConvert::$FORMULA from Unit.class.php, '#' is the value
+FORMULA = {
+    # temperature
+    'f': {'c': "(5.0/9.0) * (#-32)"},
+    'c': {'f': "(9.0/5.0) * # + 32"},
+    # pressure
+    'inHg': {'mb': "# * 33.86", 'mmHg': "# * 25.4", 'hPa': "# * 33.86",
+             'kPa': "# * 3.386"},
+    'mb': {'inHg': "# * 0.0295333727", 'mmHg': "# * 0.750061683",
+           'hPa': "#", 'kPa': "# * 0.1"},
+    'mmHg': {'inHg': "# * 0.039374592", 'mb': "# * 1.33322368",
+             'hPa': "# * 1.33322368", 'kPa': "# * 0.1333223684"},
+    'hPa': {'inHg': "# * 0.0295333727", 'mb': "#",
+            'mmHg': "# * 0.750061683", 'kPa': "# * 0.1"},
+    'kPa': {'inHg': "# * 0.295333727", 'mb': "# * 10",
+            'mmHg': "# * 7.50061683", 'hPa': "# * 10"},
+    # length
+    'in': {'mm': "# * 25.4", 'cm': "# * 2.54"},
+    'mm': {'in': "# * 0.0393700787", 'cm': "# * 0.1"},
+    'cm': {'in': "# * 0.393700787", 'mm': "# * 10.0"},
+    # speed (small scale)
+    'inHr': {'mmHr': "# * 25.4", 'cmHr': "# * 2.54"},
+    'mmHr': {'inHr': "# * 0.0393700787", 'cmHr': "# * 0.10"},
+    'cmHr': {'inHr': "# * 0.393700787", 'mmHr': "# * 10.0"},
+    # speed (large scale)
+    'mph': {'kph': "# * 1.609344", 'knot': "# * 0.868976242",
+            'mps': "# * 0.44704"},
+    'kph': {'mph': "# * 0.621371192", 'knot': "# * 0.539956803",
+            'mps': "# * 0.277777778"},
+    'knot': {'mph': "# * 1.15077945", 'kph': "# * 1.85200",
+             'mps': "# * 0.514444444"},
+    'mps': {'mph': "# * 2.23693629", 'knot': "# * 1.94384449",
+            'kph': "# * 3.6"},
+    # time
+    's': {'ms': "# * 1000"},
+    'ms': {'s': "# * 0.001"},
+}
+
+AGGS = ('avg', 'min', 'max', 'sum')
+GROUP_TYPES = ('groups', 'seconds', 'days', 'months', 'years', 'lttb', 'm4')
+# the group types that pick rows rather than aggregate them
+DOWNSAMPLE_TYPES = ('lttb', 'm4')
+# TimeTile in AggregateQuerySpec.class.php
+TILE_SPANS = (31104000, 2592000, 86400)
+TILE_MAX_GROUPS = 1440
+# seconds a tile that's over but not known to be complete may be cached for
+UNCONFIRMED_MAX_AGE = 600
+# the watermark of each entity, see TableEntity.class.php
+WATERMARK_TABLE = 'mesowx_watermark'
+# the binary form of data.php's rows, see ColumnEncoder.class.php
+COLUMNS_TYPE = 'application/x-mesowx-columns'
+COLUMNS_MAGIC = b'MWXC'
+COLUMN_FLOAT, COLUMN_QUANTIZED, COLUMN_DELTA = 0, 1, 2
+COLUMN_MAX_DECIMALS = 9
+# the most a compressed request body may decompress to, as updateData.php
+MAX_DECOMPRESSED_LENGTH = 16 * 1024 * 1024
+
+
+class RequestError(Exception):
+    """Sent back as a 400, like HttpUtil::send400()"""
+
+
+class ForbiddenError(Exception):
+    """Sent back as a 403"""
+
+
+class ConflictError(Exception):
+    """Sent back as a 409, i.e. the base of a delta isn't stored"""
+
+
+class TooLargeError(Exception):
+    """Sent back as a 413, a request body that decompresses to too much"""
+
+
+def sql_formula(value, from_unit, to_unit):
+    if from_unit == to_unit or not to_unit:
+        return value
+    return FORMULA[from_unit][to_unit].replace('#', str(value))
+
+
+def convert(value, from_unit, to_unit):
+    if from_unit == to_unit or not to_unit or value is None:
+        return value
+    return eval(FORMULA[from_unit][to_unit].replace('#', 'v'), {},
+                {'v': float(value)})
+
+
+def quote(identifier):
+    return '"%s"' % identifier
+
+
+def load_config(path):
+    """Read config.json the way JsonConfig.class.php does, comments and
+    all"""
+    with open(path) as f:
+        text = f.read()
+    text = re.sub(r"(//.*)|(?s:/\*.*?\*/)", '', text)
+    return json.loads(text)
+
+
+#
+# The MySQL functions used by AggregateQuery that SQLite doesn't have. Times
+# are local, as MySQL's from_unixtime() would be with the server's time zone.
+#
+
+def _from_unixtime(ts):
+    return ts
+
+
+def _year(ts):
+    return None if ts is None else time.localtime(ts).tm_year
+
+
+def _month(ts):
+    return None if ts is None else time.localtime(ts).tm_mon
+
+
+def _dayofyear(ts):
+    return None if ts is None else time.localtime(ts).tm_yday
+
+
+def _makedate(year, day_of_year):
+    if year is None or day_of_year is None:
+        return None
+    return time.strftime('%Y-%m-%d', time.localtime(time.mktime(
+        (int(year), 1, int(day_of_year), 0, 0, 0, 0, 0, -1))))
+
+
+def _concat(*args):
+    if any(a is None for a in args):
+        return None
+    return ''.join(str(int(a)) if isinstance(a, float) and a.is_integer()
+                   else str(a) for a in args)
+
+
+def _unix_timestamp(text):
+    if text is None:
+        return None
+    parts = [int(p) for p in re.findall(r'\d+', text)]
+    parts += [0] * (6 - len(parts))
+    return int(time.mktime(tuple(parts[:6]) + (0, 0, -1)))
+
+
+def _floor(value):
+    return None if value is None else math.floor(value)
+
+
+def _ceil(value):
+    return None if value is None else math.ceil(value)
+
+
+def open_database(path):
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    db.create_function('from_unixtime', 1, _from_unixtime)
+    db.create_function('year', 1, _year)
+    db.create_function('month', 1, _month)
+    db.create_function('dayofyear', 1, _dayofyear)
+    db.create_function('makedate', 2, _makedate)
+    db.create_function('concat', -1, _concat)
+    db.create_function('unix_timestamp', 1, _unix_timestamp)
+    db.create_function('floor', 1, _floor)
+    db.create_function('ceil', 1, _ceil)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+class TableEntity(object):
+    """An entity from config.json, as TableEntity.class.php"""
+
+    def __init__(self, entity_id, config):
+        if entity_id not in config['entity']:
+            raise RequestError("Entity couldn't be found with id: %s" %
+                               entity_id)
+        self.entity_id = entity_id
+        self.config = config['entity'][entity_id]
+        self.table = self.config['tableName']
+        self.columns = self.config['columns']
+        self.primary_key = self.config['constraints']['primaryKey']
+        self.primary_key_unit = self.columns[self.primary_key].get('unit')
+
+    def can_update(self, security_key):
+        update = self.config.get('accessControl', {}).get('update', {})
+        if not update.get('allow'):
+            raise ForbiddenError("Update not allowed for this entity")
+        if not update.get('securityKey'):
+            raise RequestError("You must configure the securityKey for "
+                               "entity ID: %s" % self.entity_id)
+        if update['securityKey'] != security_key:
+            raise ForbiddenError("Provided security key doesn't match.")
+
+    def create_table(self, db):
+        columns = ["%s real" % quote(c) for c in self.columns]
+        columns.append("primary key (%s)" % quote(self.primary_key))
+        db.execute("create table %s (%s)" % (self.table, ', '.join(columns)))
+
+    def execute_creating_table(self, db, sql, rows):
+        try:
+            db.executemany(sql, rows)
+        except sqlite3.OperationalError as e:
+            if 'no such table' not in str(e):
+                raise
+            self.create_table(db)
+            db.executemany(sql, rows)
+
+    def watermark(self, db):
+        """TableEntity::getWatermark()"""
+        try:
+            row = db.execute("select dateTime from %s where entityId = ?" %
+                             WATERMARK_TABLE, (self.entity_id,)).fetchone()
+        except sqlite3.OperationalError as e:
+            if 'no such table' not in str(e):
+                raise
+            return None
+        return row[0] if row else None
+
+    def extend_watermark(self, db, complete_from, complete_to):
+        """TableEntity::extendWatermark()"""
+        try:
+            complete_from = float(complete_from)
+            complete_to = float(complete_to)
+        except ValueError:
+            raise RequestError("Invalid watermark: '%s' to '%s'" %
+                               (complete_from, complete_to))
+        db.execute("create table if not exists %s (entityId varchar(64) not "
+                   "null, dateTime real not null, primary key (entityId))" %
+                   WATERMARK_TABLE)
+        if complete_from == 0:
+            db.execute("insert or ignore into %s(entityId, dateTime) "
+                       "values (?, ?)" % WATERMARK_TABLE,
+                       (self.entity_id, complete_to))
+        db.execute("update %s set dateTime = ? where entityId = ? and "
+                   "dateTime >= ? and dateTime < ?" % WATERMARK_TABLE,
+                   (complete_to, self.entity_id, complete_from, complete_to))
+
+    def apply_deltas(self, db, delta):
+        """The full records from delta data, as TableEntity::applyDeltas()"""
+        base = delta.get('base')
+        current = {}
+        if base is not None:
+            try:
+                cursor = db.execute("select * from %s where %s = ?" %
+                                    (self.table, quote(self.primary_key)),
+                                    (base,))
+                row = cursor.fetchone()
+            except sqlite3.OperationalError as e:
+                if 'no such table' not in str(e):
+                    raise
+                row = None
+            if row is None:
+                raise ConflictError("Delta base %s not found, send the "
+                                    "records in full" % base)
+            current = dict(zip([c[0] for c in cursor.description], row))
+        records = []
+        for record in delta['records']:
+            if not isinstance(record, dict):
+                raise RequestError("All records in the request must be "
+                                   "objects")
+            current = dict(current, **record)
+            records.append(current)
+        return records
+
+    def insert(self, db, data):
+        if isinstance(data, dict) and isinstance(data.get('delta'), dict) \
+                and 'records' in data['delta']:
+            data = self.apply_deltas(db, data['delta'])
+        if isinstance(data, dict) and 'columns' in data and 'rows' in data:
+            positions = [i for i, c in enumerate(data['columns'])
+                         if c in self.columns]
+            columns = [data['columns'][i] for i in positions]
+            rows = []
+            for row in data['rows']:
+                if not isinstance(row, list) or \
+                        len(row) != len(data['columns']):
+                    raise RequestError("Every row in the request must have a "
+                                       "value for each column")
+                rows.append([row[i] for i in positions])
+        else:
+            if isinstance(data, dict):
+                data = [data]
+            keys = {}
+            for record in data:
+                if not isinstance(record, dict):
+                    raise RequestError("All records in the request must be "
+                                       "objects")
+                keys.update(dict.fromkeys(record))
+            columns = [c for c in keys if c in self.columns]
+            rows = [[record.get(c) for c in columns] for record in data]
+        # records already stored are skipped, as TableEntity::buildInsertSql()
+        sql = "insert or ignore into %s(%s) values (%s)" % (
+              self.table, ','.join(quote(c) for c in columns),
+              ','.join('?' * len(columns)))
+        self.execute_creating_table(db, sql, rows)
+
+    def upsert(self, db, data):
+        # as Entity::applyRetentionPolicy(), a chunked delete waits for the
+        # commit
+        chunked = bool((self.config.get('retentionPolicy') or {}).get(
+                       'chunkSeconds'))
+        db.execute("begin")
+        try:
+            self.insert(db, data)
+            if not chunked:
+                self.apply_retention_policy(db, 'update')
+            db.execute("commit")
+        except Exception:
+            db.execute("rollback")
+            raise
+        if chunked:
+            self.apply_retention_policy(db, 'update')
+        self.apply_retention_policy(db, 'everyNthUpdate')
+
+    def apply_retention_policy(self, db, trigger=None):
+        """Apply the window policy if it has this trigger, or whatever its
+        trigger with None"""
+        policy = self.config.get('retentionPolicy')
+        if policy is None:
+            if trigger is None:
+                raise RequestError("No retentionPolicy configured for entity "
+                                   "ID: %s" % self.entity_id)
+            return
+        if trigger is not None and policy['trigger'] != trigger:
+            return
+        if trigger == 'everyNthUpdate':
+            every = int(policy.get('every', 100))
+            if every > 1 and random.randint(1, every) != 1:
+                return
+        self.delete_before(db, time.time() - policy['windowSize'],
+                           policy.get('chunkSeconds'),
+                           policy.get('timeBudget'))
+
+    def delete_before(self, db, date_time, chunk_seconds=None,
+                      time_budget=None):
+        pk = self.primary_key
+        if not chunk_seconds:
+            db.execute("delete from %s where %s < %s" % (
+                       self.table, pk,
+                       sql_formula(date_time, 's', self.primary_key_unit)))
+            return
+        oldest = db.execute("select min(%s) from %s" %
+                            (pk, self.table)).fetchone()[0]
+        if oldest is None:
+            return
+        chunk_start = convert(oldest, self.primary_key_unit, 's')
+        started = time.time()
+        while chunk_start < date_time:
+            chunk_end = min(chunk_start + chunk_seconds, date_time)
+            db.execute("delete from %s where %s < %s" % (
+                       self.table, pk,
+                       sql_formula(chunk_end, 's', self.primary_key_unit)))
+            chunk_start = chunk_end
+            if time_budget and time.time() - started > time_budget:
+                break
+
+
+class AggregateQuery(object):
+    """The SQL for a data.php request, as AggregateQuery.class.php builds
+    it. The parameters are as AggregateParameterParser.class.php takes
+    them."""
+
+    def __init__(self, entity, params):
+        self.entity = entity
+        self.start = self.parse_time(params.get('start'))
+        self.end = self.parse_time(params.get('end'))
+        self.group = self.parse_group(params.get('group'))
+        self.data = self.parse_data(params.get('data'))
+        self.order = params.get('order') or 'asc'
+        if self.order not in ('asc', 'desc'):
+            raise RequestError("Invaild order value: '%s'" % self.order)
+        self.limit = params.get('limit')
+        if self.limit:
+            if not self.limit.isdigit() or int(self.limit) < 1:
+                raise RequestError("Invalid limit: %s" % self.limit)
+        self.table = entity.table
+        self.date_time = quote(entity.primary_key)
+        self.tile = self.parse_tile(params.get('tile'))
+
+    def parse_tile(self, value):
+        """A tile stands in for the start and end, returns its end"""
+        if not value:
+            return None
+        if self.start is not None or self.end is not None:
+            raise RequestError("A tile can't be given a start or end")
+        if not re.match(r'^-?\d+$', value):
+            raise RequestError("Invalid tile: '%s'" % value)
+        if self.group is None or self.group['type'] != 'seconds' or \
+                self.is_single_group():
+            raise RequestError("A tile must be grouped by seconds")
+        span = tile_span(self.group['value'])
+        if span is None:
+            raise RequestError("No tiles for groups of %s seconds" %
+                               self.group['value'])
+        self.start = int(value) * span
+        self.end = self.start + span - 1
+        return self.end
+
+    @staticmethod
+    def parse_time(value):
+        if not value:
+            return None
+        parts = value.split(':', 1)
+        if not re.match(r'^-?\d+$', parts[0]):
+            raise RequestError("Invaild time value: '%s'" % parts[0])
+        kind = parts[1] if len(parts) > 1 and parts[1] else 'datetime'
+        if kind == 'datetime':
+            return int(parts[0])
+        if kind == 'ago':
+            return int(time.time()) - int(parts[0])
+        raise RequestError("Invalid time type: '%s'" % kind)
+
+    @staticmethod
+    def parse_group(value):
+        if not value:
+            return None
+        parts = [p.strip() for p in value.split(':', 2)] + [None, None]
+        kind = parts[1] or 'seconds'
+        unit = parts[2] or None
+        if kind not in GROUP_TYPES:
+            raise RequestError("Invalid group type: '%s'" % kind)
+        if parts[0]:
+            if not parts[0].isdigit() or int(parts[0]) < 1:
+                raise RequestError("Invalid group value: '%s' for type '%s'"
+                                   % (parts[0], kind))
+            count = int(parts[0])
+        else:
+            count = None if kind == 'seconds' else 1
+        if unit is not None and unit not in ('ms', 's'):
+            raise RequestError("Invalid grouping unit: '%s'." % unit)
+        return {'value': count, 'type': kind, 'unit': unit}
+
+    def parse_data(self, value):
+        data = []
+        for field in (value or '').split(','):
+            if not field.strip():
+                continue
+            parts = [p.strip() or None for p in field.split(':', 3)]
+            parts += [None] * (4 - len(parts))
+            name, agg, unit, decimals = parts
+            agg = agg or 'avg'
+            if name not in self.entity.columns:
+                raise RequestError("Undefined field: '%s'" % name)
+            if agg not in AGGS:
+                raise RequestError("Invalid aggregation: '%s' for field '%s'"
+                                   % (agg, name))
+            if unit is not None:
+                column_unit = self.entity.columns[name].get('unit')
+                if column_unit is None:
+                    raise RequestError("Can't convert field '%s' to unit "
+                                       "'%s'. Field has no defined unit." %
+                                       (name, unit))
+                if unit != column_unit and \
+                        unit not in FORMULA.get(column_unit, {}):
+                    raise RequestError("No converter found for unit '%s' to "
+                                       "'%s' for field '%s'." %
+                                       (column_unit, unit, name))
+            if decimals is not None and not decimals.isdigit():
+                raise RequestError("Invalid decimals value: '%s' for field "
+                                   "'%s'" % (decimals, name))
+            data.append((name, agg, unit, decimals))
+        if not data:
+            raise RequestError("Must specify at least one data field")
+        return data
+
+    def is_grouped(self):
+        return self.group is not None
+
+    def is_single_group(self):
+        kind, value = self.group['type'], self.group['value']
+        return (kind == 'seconds' and not value) or \
+            (kind == 'groups' and value < 2)
+
+    def sql(self):
+        parts = ["select", self.build_selects(), self.build_from()]
+        where = self.build_where()
+        if where:
+            parts.append("where " + " and ".join(where))
+        if self.is_grouped() and not self.is_single_group():
+            parts.append("group by " + self.build_group())
+        parts.append("order by %s %s" % (self.date_time, self.order))
+        if self.limit:
+            parts.append("limit %s" % self.limit)
+        return "\n".join(parts)
+
+    def build_from(self):
+        return "from %s" % quote(self.table)
+
+    def build_where(self):
+        where = []
+        if self.start is not None:
+            where.append("%s >= %s" % (self.date_time, self.start))
+        if self.end is not None:
+            where.append("%s <= %s" % (self.date_time, self.end))
+        return where
+
+    def build_selects(self):
+        selects = []
+        if self.is_grouped() and not self.is_single_group():
+            selects.append(self.build_group_select())
+        for name, agg, unit, decimals in self.data:
+            select = quote(name)
+            if self.is_grouped():
+                select = self.build_aggregate(name, agg)
+            if unit is not None:
+                select = sql_formula(select,
+                                     self.entity.columns[name]['unit'], unit)
+            if decimals is not None:
+                select = "round(%s, %s)" % (select, decimals)
+            selects.append(select)
+        return ",\n".join(selects)
+
+    def build_aggregate(self, name, agg):
+        return "%s(%s)" % (agg, quote(name))
+
+    def build_group_select(self):
+        kind, value = self.group['type'], self.group['value']
+        if kind in ('groups', 'seconds'):
+            select = "%s * %s" % (self.build_seconds_group(),
+                                  self.seconds_group_slice())
+        elif kind == 'days':
+            select = ("unix_timestamp(concat(makedate(%s, %s * %d - %d), "
+                      "' 00:00:00'))" % (self.build_part_group('year'),
+                                         self.build_part_group('dayofyear'),
+                                         value, value - 1))
+        elif kind == 'months':
+            select = ("unix_timestamp(concat(%s, '-', %s * %d - %d, "
+                      "'-01 00:00:00'))" % (self.build_part_group('year'),
+                                            self.build_part_group('month'),
+                                            value, value - 1))
+        else:
+            select = ("unix_timestamp(concat(%s * %d - %d, "
+                      "'-01-01 00:00:00'))" %
+                      (self.build_part_group('year'), value, value - 1))
+        return sql_formula(select, 's', self.group['unit'])
+
+    def build_group(self):
+        kind = self.group['type']
+        if kind in ('groups', 'seconds'):
+            return self.build_seconds_group()
+        if kind == 'days':
+            return "%s, %s" % (self.build_part_group('year'),
+                               self.build_part_group('dayofyear'))
+        if kind == 'months':
+            return "%s, %s" % (self.build_part_group('year'),
+                               self.build_part_group('month'))
+        return self.build_part_group('year')
+
+    def build_seconds_group(self):
+        return "floor(%s / %s)" % (self.date_time, self.seconds_group_slice())
+
+    def seconds_group_slice(self):
+        if self.group['type'] != 'groups':
+            return self.group['value']
+        start = self.start
+        end = self.end
+        if start is None:
+            start = "(select min(%s) from %s)" % (self.date_time,
+                                                  quote(self.table))
+        if end is None:
+            end = "(select max(%s) from %s)" % (self.date_time,
+                                                quote(self.table))
+        # SQLite's cast is to real where MySQL's is to decimal
+        return "((%s - %s) / cast(%s as real))" % (end, start,
+                                                   self.group['value'])
+
+    def build_part_group(self, part):
+        group = "%s(from_unixtime(%s))" % (part, self.date_time)
+        kind = self.group['type']
+        value = self.group['value']
+        if value != 1 and (kind, part) in (('years', 'year'),
+                                           ('months', 'month'),
+                                           ('days', 'dayofyear')):
+            # SQLite divides integers as integers, MySQL doesn't
+            group = "ceil(%s / %s.0)" % (group, value)
+        return group
+
+
+class DownsampleQuery(AggregateQuery):
+    """The rows for a Downsampler, DownsampleQuery in AggregateQuery.class.php:
+    the dateTime as it's stored then the fields, ungrouped and oldest
+    first"""
+
+    def is_grouped(self):
+        return False
+
+    def build_selects(self):
+        return self.date_time + ",\n" + AggregateQuery.build_selects(self)
+
+    def sql(self):
+        self.order = 'asc'
+        self.limit = None
+        return AggregateQuery.sql(self)
+
+    def downsampler(self, db):
+        start, end = self.start, self.end
+        if start is None or end is None:
+            row = db.execute("select min(%s), max(%s) from %s" % (
+                             self.date_time, self.date_time,
+                             quote(self.table))).fetchone()
+            start = row[0] if start is None else start
+            end = row[1] if end is None else end
+        return Downsampler(self.group['type'], self.group['value'],
+                           start or 0, end or 0, len(self.data))
+
+
+class Downsampler(object):
+    """Picks about count rows from rows of [dateTime, value, ...] given oldest
+    first, keeping the shape of each field's line, as Downsampler.class.php.
+    The range is cut into count equal buckets of time. 'lttb' (largest
+    triangle three buckets) takes, for each field, the row of a bucket that
+    makes the largest triangle with the row taken from the bucket before and
+    the average of the bucket after. 'm4' takes the first and last row of a
+    bucket and the rows with the lowest and highest value of each field. The
+    rows taken for any field are returned whole, with the first and last
+    row, so there can be more than count rows with several fields."""
+
+    def __init__(self, mode, count, start, end, fields):
+        self.mode = mode
+        self.count = max(1, count)
+        self.start = start
+        self.slice = (end - start) / float(self.count)
+        self.fields = fields
+        # [bucket index, rows] of the buckets not yet done with, at most two
+        self.buckets = []
+        # (dateTime, value) of the row last taken for each field
+        self.taken = [None] * fields
+        self.first = None
+        self.last = None
+
+    def bucket(self, date_time):
+        if self.slice <= 0:
+            return 0
+        return min(self.count - 1,
+                   int(math.floor((date_time - self.start) / self.slice)))
+
+    def add(self, row):
+        """The rows picked on adding row, oldest first"""
+        picked = []
+        if self.first is None:
+            # the first row is always taken
+            self.first = row
+            picked.append(row)
+            for f in range(self.fields):
+                if row[f + 1] is not None:
+                    self.taken[f] = (row[0], row[f + 1])
+        self.last = row
+        index = self.bucket(row[0])
+        if self.buckets and self.buckets[-1][0] == index:
+            self.buckets[-1][1].append(row)
+            return picked
+        self.buckets.append([index, [row]])
+        if self.mode == 'm4' and len(self.buckets) == 2:
+            picked.extend(self.without_first(self.pick_m4(
+                          self.buckets.pop(0)[1])))
+        elif len(self.buckets) == 3:
+            rows = self.buckets.pop(0)[1]
+            picked.extend(self.without_first(self.pick_lttb(
+                          rows, self.buckets[0][1])))
+        return picked
+
+    def flush(self):
+        """The rest of the rows picked, ending with the last"""
+        picked = []
+        while self.buckets:
+            rows = self.buckets.pop(0)[1]
+            if self.mode == 'm4':
+                picked.extend(self.pick_m4(rows))
+            else:
+                # the last row stands in for the bucket after the last
+                after = self.buckets[0][1] if self.buckets else [self.last]
+                picked.extend(self.pick_lttb(rows, after))
+        picked = self.without_first(picked)
+        # as is the last row
+        if self.last is not None and self.last is not self.first and \
+                (not picked or picked[-1] is not self.last):
+            picked.append(self.last)
+        return picked
+
+    def without_first(self, rows):
+        return [r for r in rows if r is not self.first]
+
+    def pick_lttb(self, rows, after):
+        picked = []
+        for f in range(self.fields):
+            column = f + 1
+            values = [r for r in after if r[column] is not None]
+            if not values:
+                continue
+            cx = sum(r[0] for r in values) / float(len(values))
+            cy = sum(r[column] for r in values) / float(len(values))
+            ax, ay = self.taken[f] if self.taken[f] is not None else (cx, cy)
+            best, best_area = None, -1.0
+            for r in rows:
+                if r[column] is None:
+                    continue
+                area = abs((ax - cx) * (r[column] - ay) -
+                           (ax - r[0]) * (cy - ay))
+                if area > best_area:
+                    best, best_area = r, area
+            if best is not None:
+                self.taken[f] = (best[0], best[column])
+                picked.append(best)
+        return self.in_order(picked)
+
+    def pick_m4(self, rows):
+        picked = [rows[0], rows[-1]]
+        for f in range(self.fields):
+            column = f + 1
+            values = [r for r in rows if r[column] is not None]
+            if values:
+                picked.append(min(values, key=lambda r: r[column]))
+                picked.append(max(values, key=lambda r: r[column]))
+        return self.in_order(picked)
+
+    @staticmethod
+    def in_order(rows):
+        unique = dict((id(r), r) for r in rows)
+        return sorted(unique.values(), key=lambda r: r[0])
+
+
+class RollupAggregateQuery(AggregateQuery):
+    """AggregateQuery answered from a RollupService table, as in
+    AggregateQuery.class.php. The records of the buckets cut by the start
+    (up to head_end) or the end (from tail_start) come from the entity's
+    table."""
+
+    def __init__(self, entity, params, rollup_table, head_end=None,
+                 tail_start=None):
+        AggregateQuery.__init__(self, entity, params)
+        self.table = rollup_table
+        self.head_end = head_end
+        self.tail_start = tail_start
+
+    def build_from(self):
+        if self.head_end is None and self.tail_start is None:
+            return AggregateQuery.build_from(self)
+        rollup_selects = [self.date_time]
+        entity_selects = [self.date_time]
+        for name in sorted(set(d[0] for d in self.data)):
+            for agg in ('min', 'max', 'sum'):
+                rollup_selects.append(quote(name + '_' + agg))
+                entity_selects.append("%s %s" % (quote(name),
+                                                 quote(name + '_' + agg)))
+            rollup_selects.append(quote(name + '_count'))
+            entity_selects.append("case when %s is null then 0 else 1 end %s"
+                                  % (quote(name), quote(name + '_count')))
+        entity_where = []
+        if self.head_end is not None:
+            entity_where.append("(%s >= %s and %s < %s)" % (
+                                self.date_time, self.start, self.date_time,
+                                self.head_end))
+        if self.tail_start is not None:
+            entity_where.append("(%s >= %s and %s <= %s)" % (
+                                self.date_time, self.tail_start,
+                                self.date_time, self.end))
+        bucket_where = self.bucket_where()
+        return ("from (select %s %s%s\nunion all\nselect %s from %s where "
+                "%s) %s" % (", ".join(rollup_selects),
+                            AggregateQuery.build_from(self),
+                            " where " + " and ".join(bucket_where)
+                            if bucket_where else "",
+                            ", ".join(entity_selects),
+                            quote(self.entity.table),
+                            " or ".join(entity_where), quote(self.table)))
+
+    def build_where(self):
+        if self.head_end is None and self.tail_start is None:
+            return AggregateQuery.build_where(self)
+        # it's in the from
+        return []
+
+    def bucket_where(self):
+        """The buckets wholly within the range"""
+        where = []
+        if self.start is not None:
+            where.append("%s >= %s" % (self.date_time, self.start))
+        if self.tail_start is not None:
+            where.append("%s < %s" % (self.date_time, self.tail_start))
+        elif self.end is not None:
+            where.append("%s <= %s" % (self.date_time, self.end))
+        return where
+
+    def build_aggregate(self, name, agg):
+        total = "sum(%s)" % quote(name + '_sum')
+        count = "sum(%s)" % quote(name + '_count')
+        if agg == 'avg':
+            return "%s / nullif(%s, 0)" % (total, count)
+        if agg == 'sum':
+            return "(case when %s > 0 then %s end)" % (count, total)
+        return "%s(%s)" % (agg, quote(name + '_' + agg))
+
+
+# AggregateQueryPlanner, coarsest first
+ROLLUPS = (('day', 86400), ('3600', 3600), ('300', 300))
+MIN_BUCKETS_PER_GROUP = 4
+
+
+def tile_span(group_seconds):
+    for span in TILE_SPANS:
+        if span % group_seconds == 0 and \
+                span // group_seconds <= TILE_MAX_GROUPS:
+            return span
+    return None
+
+
+def plan_query(db, entity, params):
+    """AggregateQueryPlanner::plan()"""
+    query = AggregateQuery(entity, params)
+    if query.is_grouped() and query.group['type'] in DOWNSAMPLE_TYPES:
+        return DownsampleQuery(entity, params)
+    prefix = entity.config.get('rollupTablePrefix')
+    if prefix is None or not query.is_grouped():
+        return query
+    kind, value = query.group['type'], query.group['value']
+    suffix = None
+    if kind in ('days', 'months', 'years'):
+        suffix = 'day'
+    elif kind == 'seconds' and not query.is_single_group():
+        for candidate, seconds in ROLLUPS:
+            if candidate != 'day' and value % seconds == 0:
+                suffix = candidate
+                break
+    else:
+        start, end = query.start, query.end
+        if start is None or end is None:
+            row = db.execute("select min(%s), max(%s) from %s" % (
+                             query.date_time, query.date_time,
+                             quote(entity.table))).fetchone()
+            if row[0] is None:
+                return query
+            start = row[0] if start is None else start
+            end = row[1] if end is None else end
+        groups = max(value, 1) if kind == 'groups' else 1
+        slice_seconds = (end - start) / float(groups)
+        for candidate, seconds in ROLLUPS:
+            if seconds * MIN_BUCKETS_PER_GROUP <= slice_seconds:
+                suffix = candidate
+                break
+    if suffix is None:
+        return query
+    try:
+        row = db.execute("select value from %s where name = 'watermark'" %
+                         quote(prefix + '_state')).fetchone()
+    except sqlite3.OperationalError:
+        return query
+    latest = db.execute("select max(%s) from %s" % (
+                        query.date_time, quote(entity.table))).fetchone()
+    if row is None or (latest[0] is not None and row[0] <= latest[0]):
+        return query
+    table = "%s_%s" % (prefix, suffix)
+    if suffix == 'day' and not rollup_days_aligned(db, query, table):
+        return query
+    edges = rollup_edges(db, query, table)
+    if edges is None:
+        return query
+    return RollupAggregateQuery(entity, params, table, *edges)
+
+
+def rollup_days_aligned(db, query, table):
+    """AggregateQueryPlanner::isDayAligned(), whether the first and last
+    daily rollup rows start a day as from_unixtime() has it"""
+    starts_day = []
+    for agg in ('min', 'max'):
+        bucket = "(select %s(%s) from %s)" % (agg, query.date_time,
+                                              quote(table))
+        starts_day.append("dayofyear(from_unixtime(%s - 1)) <> "
+                          "dayofyear(from_unixtime(%s))" % (bucket, bucket))
+    try:
+        row = db.execute("select " + " and ".join(starts_day)).fetchone()
+    except sqlite3.OperationalError:
+        return False
+    return bool(row[0])
+
+
+def rollup_edges(db, query, table):
+    """AggregateQueryPlanner::getEdges(), (head_end, tail_start) or None if
+    no bucket of table is wholly within the range"""
+    date_time, rollup = query.date_time, quote(table)
+    entity = quote(query.entity.table)
+    start, end = query.start, query.end
+    try:
+        first = db.execute("select min(%s) from %s%s" % (
+                           date_time, rollup, "" if start is None else
+                           " where %s >= %s" % (date_time, start))
+                           ).fetchone()[0]
+        last = db.execute("select max(%s) from %s%s" % (
+                          date_time, rollup, "" if end is None else
+                          " where %s <= %s" % (date_time, end))).fetchone()[0]
+        if first is None or last is None or first > last:
+            return None
+        head_end = None
+        if start is not None and db.execute(
+                "select 1 from %s where %s >= %s and %s < %s limit 1" % (
+                entity, date_time, start, date_time, first)).fetchone():
+            head_end = first
+        tail_start = None
+        if end is not None:
+            following = db.execute("select min(%s) from %s where %s > %s" % (
+                                   date_time, rollup, date_time, end)
+                                   ).fetchone()[0]
+            if db.execute("select 1 from %s where %s > %s%s limit 1" % (
+                          entity, date_time, end, "" if following is None
+                          else " and %s < %s" % (date_time, following))
+                          ).fetchone():
+                if first >= last:
+                    return None
+                tail_start = last
+    except sqlite3.OperationalError:
+        return None
+    return head_end, tail_start
+
+
+def format_number(value):
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def query_data(db, config, params, engine=None):
+    """data.php, returns the rows, the SQL and the Cache-Control of a tile
+    that's over, None otherwise. The grouping is left to engine, a mesowx_arrays.ArrayEngine, where
+    it can."""
+    if not params.get('entity_id'):
+        raise RequestError("Must specify a entity_id")
+    entity = TableEntity(params['entity_id'], config)
+    query = plan_query(db, entity, params)
+    sql = query.sql()
+    try:
+        if engine is not None and engine.can_aggregate(query):
+            rows, sql = engine.aggregate(db, query)
+        else:
+            rows = db.execute(sql)
+    except sqlite3.OperationalError as e:
+        if isinstance(query, RollupAggregateQuery):
+            query = AggregateQuery(entity, params)
+            sql = query.sql()
+            rows = db.execute(sql)
+        elif 'no such table' in str(e):
+            entity.create_table(db)
+            rows = db.execute(sql)
+        else:
+            raise
+    if isinstance(query, DownsampleQuery):
+        rows = downsample(rows, query.downsampler(db),
+                          entity.columns[entity.primary_key].get('unit'),
+                          query.group['unit'])
+    rows = [[format_number(v) for v in row] for row in rows]
+    cache_control = None
+    if query.tile is not None:
+        latest = db.execute("select max(%s) from %s" % (
+                            query.date_time, quote(entity.table))).fetchone()
+        if latest[0] is not None and latest[0] > query.tile:
+            # as TimeTile::isComplete()
+            watermark = entity.watermark(db)
+            if entity.config.get('tileWatermark') == 'latest' or \
+                    (watermark is not None and watermark >= query.tile):
+                cache_control = 'public, max-age=31536000, immutable'
+            else:
+                cache_control = 'public, max-age=%d' % UNCONFIRMED_MAX_AGE
+    return rows, sql, cache_control
+
+
+def downsample(rows, sampler, date_time_unit, unit):
+    picked = []
+    for row in rows:
+        picked.extend(sampler.add(row))
+    picked.extend(sampler.flush())
+    return [[convert(row[0], date_time_unit, unit)] + list(row[1:])
+            for row in picked]
+
+
+def column_decimals(config, params):
+    """The decimals of each column of data.php's rows, None where none were
+    asked for. A group's time is to the whole ms or s."""
+    query = AggregateQuery(TableEntity(params['entity_id'], config), params)
+    decimals = [None if d is None else int(d) for n, a, u, d in query.data]
+    if query.is_grouped() and (query.group['type'] in DOWNSAMPLE_TYPES or
+                               not query.is_single_group()):
+        decimals.insert(0, 0)
+    return decimals
+
+
+def encode_columns(rows, decimals):
+    """data.php's rows in the binary columnar form, as ColumnEncoder"""
+    columns = [[row[i] for row in rows] for i in range(len(decimals))]
+    parts = [COLUMNS_MAGIC, struct.pack('<BBHII', 1, len(columns), 0,
+                                        len(rows), 0)]
+    for values, places in zip(columns, decimals):
+        kind, width, places, payload = encode_column(values, places)
+        parts.append(struct.pack('<BBbBI', kind, width, places, 0,
+                                 len(payload)))
+        parts.append(payload + b'\0' * (-len(payload) % 8))
+    return b''.join(parts)
+
+
+def encode_column(values, decimals):
+    """The kind, width, decimals and bytes of a column: the differences from
+    the first value if there are no nulls and they fit, otherwise the values,
+    both as int16 or int32 of value * 10^decimals, or failing that float64.
+    Without decimals the values are only quantized if they're whole."""
+    present = [v for v in values if v is not None]
+    if decimals is None and all(float(v).is_integer() for v in present):
+        decimals = 0
+    # any more decimals than that are as good as float64
+    if decimals is not None and decimals <= COLUMN_MAX_DECIMALS:
+        scale = 10 ** decimals
+        ints = [None if v is None else int(math.floor(abs(v) * scale + 0.5)) *
+                (-1 if v < 0 else 1) for v in values]
+        if ints and None not in ints:
+            deltas = [b - a for a, b in zip(ints, ints[1:])]
+            width = int_width(deltas)
+            if width:
+                return COLUMN_DELTA, width, decimals, \
+                    struct.pack('<d', ints[0]) + int_bytes(deltas, width)
+        width = int_width([i for i in ints if i is not None])
+        if width:
+            # the lowest of the width is null
+            null = -(1 << (8 * width - 1))
+            return COLUMN_QUANTIZED, width, decimals, int_bytes(
+                [null if i is None else i for i in ints], width)
+    doubles = array.array('d', [float('nan') if v is None else v
+                                for v in values])
+    if sys.byteorder != 'little':
+        doubles.byteswap()
+    return COLUMN_FLOAT, 8, 0, doubles.tobytes()
+
+
+def int_width(ints):
+    """2 or 4 bytes for ints, the lowest of each left for null, or None"""
+    low = min(ints) if ints else 0
+    high = max(ints) if ints else 0
+    for width in (2, 4):
+        limit = (1 << (8 * width - 1)) - 1
+        if -limit <= low and high <= limit:
+            return width
+    return None
+
+
+def int_bytes(ints, width):
+    values = array.array('h' if width == 2 else 'i', ints)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+def query_stats(db, config, params, engine=None):
+    """stats.php, returns the stats and a description of the queries. The
+    records not covered by the extremes table are scanned by engine, a
+    mesowx_arrays.ArrayEngine, if given."""
+    if 'entityId' not in params:
+        raise RequestError("Must specify an entityId")
+    entity = TableEntity(params['entityId'], config)
+    time_unit = params.get('timeUnit')
+    date_time_unit = entity.primary_key_unit
+    start = params.get('start') or None
+    end = params.get('end') or None
+    if start is not None and start < 0:
+        start = time.time() + start
+    if end is not None and end < 0:
+        end = time.time() + end
+    range_start, range_end = start, end
+    if time_unit:
+        range_start = convert(start, time_unit, date_time_unit)
+        range_end = convert(end, time_unit, date_time_unit)
+    fields = [field['fieldId'] for field in params['data']]
+    # [min, minTime, max, maxTime] by field
+    trackers = dict((f, [None, None, None, None]) for f in fields)
+    queries = []
+
+    def test(field, low, low_time, high, high_time):
+        tracker = trackers[field]
+        if low is not None and (tracker[0] is None or low < tracker[0]):
+            tracker[0], tracker[1] = low, low_time
+        if high is not None and (tracker[2] is None or high > tracker[2]):
+            tracker[2], tracker[3] = high, high_time
+
+    def scan(low, high, high_inclusive):
+        if engine is not None:
+            found, sql = engine.extremes(db, entity.table, entity.primary_key,
+                                         fields, low, high, high_inclusive)
+            queries.append("%s (start: %s, end: %s)" % (sql, low, high))
+            for field, extremes in found.items():
+                test(field, *extremes)
+            return
+        pk = quote(entity.primary_key)
+        sql = "select %s, %s from %s" % (pk, ', '.join(quote(f) for f in
+                                                       fields),
+                                         quote(entity.table))
+        where, args = [], []
+        if low is not None:
+            where.append("%s >= ?" % pk)
+            args.append(low)
+        if high is not None:
+            where.append("%s %s ?" % (pk, "<=" if high_inclusive else "<"))
+            args.append(high)
+        if where:
+            sql += " where " + " and ".join(where)
+        queries.append("%s (start: %s, end: %s)" % (sql, low, high))
+        for row in db.execute(sql, args):
+            for field, value in zip(fields, row[1:]):
+                if value is not None:
+                    test(field, value, row[0], value, row[0])
+
+    def cover(low, high, high_inclusive, periods):
+        if low is not None and high is not None and \
+                (low > high if high_inclusive else low >= high):
+            return
+        if not periods:
+            scan(low, high, high_inclusive)
+            return
+        period = periods[0]
+        sql = ("select field, periodStart, periodEnd, min, minTime, max, "
+               "maxTime from %s where period = ? and field in (%s)" %
+               (quote(extremes_table), ','.join('?' * len(fields))))
+        args = [period] + fields
+        if low is not None:
+            sql += " and periodStart >= ?"
+            args.append(low)
+        if high is not None:
+            sql += " and periodEnd <= ?"
+            args.append(high + 1 if high_inclusive else high)
+        queries.append("%s (start: %s, end: %s)" % (period, low, high))
+        covered_start = covered_end = None
+        for field, p_start, p_end, low_v, low_t, high_v, high_t in \
+                db.execute(sql, args):
+            test(field, low_v, low_t, high_v, high_t)
+            covered_start = p_start if covered_start is None else \
+                min(covered_start, p_start)
+            covered_end = p_end if covered_end is None else \
+                max(covered_end, p_end)
+        if covered_start is None:
+            cover(low, high, high_inclusive, periods[1:])
+        else:
+            cover(low, covered_start, False, periods[1:])
+            cover(covered_end, high, high_inclusive, periods[1:])
+
+    extremes_table = entity.config.get('extremesTable')
+    watermark = None
+    if extremes_table:
+        try:
+            done = dict(db.execute("select field, periodEnd from %s where "
+                                   "period = 'a'" % quote(extremes_table)))
+            if all(f in done for f in fields):
+                watermark = min(done[f] for f in fields)
+        except sqlite3.OperationalError:
+            pass
+    if watermark is None:
+        scan(range_start, range_end, True)
+    elif range_end is None or range_end >= watermark:
+        cover(range_start, watermark, False, ['a', 'y', 'm', 'd'])
+        scan(watermark if range_start is None or range_start < watermark
+             else range_start, range_end, True)
+    else:
+        cover(range_start, range_end, True, ['a', 'y', 'm', 'd'])
+
+    result = {}
+    for field in params['data']:
+        field_id = field['fieldId']
+        tracker = trackers[field_id]
+        stats = {}
+        for stat, value, date_time in (('min', tracker[0], tracker[1]),
+                                       ('max', tracker[2], tracker[3])):
+            if stat not in field.get('stats', []):
+                continue
+            if value is None:
+                # what the trackers start out as in stats.php
+                value = 1e99 if stat == 'min' else -1e99
+            if field.get('unit'):
+                entity_unit = entity.columns[field_id].get('unit')
+                if not entity_unit:
+                    raise RequestError("Can't convert fieldId %s to unit %s: "
+                                       "entity has no unit defined" %
+                                       (field_id, field['unit']))
+                value = convert(value, entity_unit, field['unit'])
+            if 'decimals' in field:
+                value = round(value, field['decimals'])
+            if date_time is not None:
+                date_time = convert(date_time, date_time_unit, time_unit)
+            stats[stat] = [format_number(value), format_number(date_time)]
+        result[field_id] = stats
+    return result, queries
+
+
+def check_sender(config, params):
+    """The entity to update, once the security_key matches"""
+    if 'entity_id' not in params:
+        raise RequestError("Must specify an entity_id")
+    if 'security_key' not in params:
+        raise RequestError("Must specify a security_key")
+    entity = TableEntity(params['entity_id'], config)
+    entity.can_update(params['security_key'])
+    return entity
+
+
+def update_data(db, config, params):
+    """updateData.php"""
+    entity = check_sender(config, params)
+    if 'data' not in params:
+        raise RequestError("Must specify data")
+    try:
+        data = json.loads(params['data'])
+    except ValueError as e:
+        raise RequestError("Unable to parse data as JSON: %s:%s" %
+                           (e, params['data']))
+    entity.upsert(db, data)
+    if 'complete_from' in params and 'complete_to' in params:
+        entity.extend_watermark(db, params['complete_from'],
+                                params['complete_to'])
+
+
+def prune(db, config, params):
+    """prune.php"""
+    if 'entity_id' not in params:
+        raise RequestError("Must specify an entity_id")
+    if 'security_key' not in params:
+        raise RequestError("Must specify a security_key")
+    entity = TableEntity(params['entity_id'], config)
+    entity.can_update(params['security_key'])
+    entity.apply_retention_policy(db)
+
+
+class MesoRequestHandler(SimpleHTTPRequestHandler):
+    """Answers the .php endpoints, anything else is a file under --root"""
+
+    server_version = "MesoWxServer/1.0"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            SimpleHTTPRequestHandler.log_message(self, format, *args)
+
+    def database(self):
+        local = self.server.local
+        if getattr(local, 'db', None) is None:
+            local.db = open_database(self.server.database_path)
+        return local.db
+
+    def endpoint(self):
+        path = urlsplit(self.path).path
+        name = path.rsplit('/', 1)[-1]
+        if name in ('data.php', 'stats.php', 'updateData.php', 'prune.php'):
+            return name
+        return None
+
+    def do_GET(self):
+        name = self.endpoint()
+        if name is None:
+            return SimpleHTTPRequestHandler.do_GET(self)
+        self.handle_endpoint(name, 'GET')
+
+    def do_POST(self):
+        name = self.endpoint()
+        if name is None:
+            self.send_text(405, "Method Not Allowed")
+            return
+        self.handle_endpoint(name, 'POST')
+
+    def content_encoding(self):
+        return (self.headers.get('Content-Encoding') or
+                'identity').strip().lower()
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        encoding = self.content_encoding()
+        if encoding in ('gzip', 'deflate'):
+            decompressor = zlib.decompressobj(
+                16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+            try:
+                data = decompressor.decompress(body, MAX_DECOMPRESSED_LENGTH)
+            except zlib.error:
+                raise RequestError("Unable to decompress %s request body" %
+                                   encoding)
+            if decompressor.unconsumed_tail:
+                raise TooLargeError("Request body decompresses to more than "
+                                    "%d bytes" % MAX_DECOMPRESSED_LENGTH)
+            body = data
+        elif encoding != 'identity':
+            raise RequestError("Unsupported Content-Encoding: %s" % encoding)
+        return body
+
+    def form(self, method):
+        """The request parameters, as PHP's $_REQUEST would have them"""
+        params = dict(parse_qsl(urlsplit(self.path).query))
+        if method != 'POST':
+            return params
+        body = self.read_body()
+        content_type = self.headers.get('Content-Type') or ''
+        if content_type.startswith('multipart/form-data'):
+            message = email.parser.BytesParser().parsebytes(
+                b'Content-Type: ' + content_type.encode('latin-1') +
+                b'\r\n\r\n' + body)
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                params[name] = part.get_payload(decode=True).decode('utf-8')
+        else:
+            params.update(parse_qsl(body.decode('utf-8')))
+        return params
+
+    def handle_endpoint(self, name, method):
+        config = self.server.config
+        started = time.time()
+        headers = {}
+        try:
+            if name == 'data.php':
+                params = self.form(method)
+                rows, sql, cache_control = query_data(
+                    self.database(), config, params, self.server.engine)
+                headers['X-Meso-Query'] = sql.replace("\n", " ")
+                if cache_control is not None:
+                    headers['Cache-Control'] = cache_control
+                headers['Vary'] = 'Accept'
+                if COLUMNS_TYPE in (self.headers.get('Accept') or ''):
+                    body = encode_columns(rows, column_decimals(config,
+                                                                params))
+                    content_type = COLUMNS_TYPE
+                else:
+                    body = json.dumps(rows, separators=(',', ':'))
+                    content_type = 'application/json'
+                headers['X-Meso-Query-Time'] = str(time.time() - started)
+            elif name == 'stats.php':
+                if method != 'POST':
+                    self.send_text(405, 'Request method must be a POST')
+                    return
+                try:
+                    params = json.loads(self.read_body().decode('utf-8'))
+                except ValueError:
+                    raise RequestError("Invalid request JSON")
+                stats, queries = query_stats(self.database(), config, params,
+                                             self.server.engine)
+                headers['X-Meso-Query'] = "; ".join(queries)
+                headers['X-Meso-Process-Time'] = str(time.time() - started)
+                body = json.dumps(stats, separators=(',', ':'))
+                content_type = 'application/json'
+            elif name == 'updateData.php':
+                if method == 'POST' and self.content_encoding() != 'identity':
+                    # the sender of a compressed body is checked, from the
+                    # query string, before it's decompressed
+                    check_sender(config, self.form('GET'))
+                update_data(self.database(), config, self.form(method))
+                body, content_type = '', 'text/html'
+            else:
+                if method != 'POST':
+                    self.send_text(405, 'Request method must be a POST')
+                    return
+                prune(self.database(), config, self.form(method))
+                body, content_type = '', 'text/html'
+        except RequestError as e:
+            self.send_text(400, "%s" % e)
+            return
+        except ForbiddenError as e:
+            self.send_text(403, "Unable to update entity: %s" % e)
+            return
+        except ConflictError as e:
+            self.send_text(409, "Unable to update entity: %s" % e)
+            return
+        except TooLargeError as e:
+            self.send_text(413, "%s" % e)
+            return
+        except sqlite3.IntegrityError as e:
+            # worded as MySQL would so that SyncService skips it
+            self.send_text(500, "Unable to update entity due to unexpected "
+                                "error: Duplicate entry (%s)" % e)
+            return
+        except Exception as e:
+            self.send_text(500, "Unexpected error: %s" % e)
+            return
+        self.send_text(200, body, content_type, headers)
+
+    def send_text(self, status, text, content_type='text/html',
+                  headers=None):
+        body = text if isinstance(text, bytes) else text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        headers = headers or {}
+        if 'Cache-Control' not in headers:
+            self.send_header('Cache-Control', 'no-cache, must-revalidate')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MesoServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, config, database_path, root='.',
+                 quiet=False, engine=None):
+        self.config = config
+        self.engine = engine
+        self.database_path = database_path
+        self.root = os.path.abspath(root)
+        self.quiet = quiet
+        self.local = threading.local()
+
+        def handler(*args, **kwargs):
+            return MesoRequestHandler(*args, directory=self.root, **kwargs)
+        ThreadingHTTPServer.__init__(self, address, handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve the MesoWx endpoints from SQLite")
+    parser.add_argument('--config', required=True,
+                        help="the meso/include/config.json to use")
+    parser.add_argument('--sqlite', required=True,
+                        help="the SQLite database for every entity")
+    parser.add_argument('--root', default='.',
+                        help="the directory to serve other files from")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't log each request")
+    parser.add_argument('--engine', choices=('sql', 'numpy'), default='sql',
+                        help="what groups the data.php queries and scans for "
+                        "the stats.php highs and lows")
+    args = parser.parse_args()
+    engine = None
+    if args.engine == 'numpy':
+        try:
+            import mesowx_arrays
+        except ImportError as e:
+            parser.error("--engine numpy needs NumPy: %s" % e)
+        engine = mesowx_arrays.ArrayEngine()
+    server = MesoServer((args.host, args.port), load_config(args.config),
+                        args.sqlite, args.root, args.quiet, engine)
+    print("%s serving http://%s:%d/ from %s" % (
+          datetime.now().strftime('%Y-%m-%d %H:%M:%S'), args.host, args.port,
+          args.sqlite))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()